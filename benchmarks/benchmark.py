@@ -0,0 +1,95 @@
+"""
+Benchmark inference variants of the parser against the full-precision model.
+
+The input text is sentenced and tokenized once; then each variant predicts it
+`--repeat` times and is reported with its throughput and with its UPOS and LAS
+agreement with the reference CoNLL-U (by default the expected output of the
+full-precision model on the alienista fixture, so the baseline scores 100%).
+
+Usage:
+    python benchmarks/benchmark.py --quantize int8 --precision bf16
+    python benchmarks/benchmark.py --compile --repeat 10
+"""
+
+import argparse
+import io
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from portparser_v2.core import LATINPIPE_DIR, Parser, tokenize_sentences
+from portparser_v2.portSent import stripSents
+
+FIXTURES_DIR = Path(__file__).parent.parent / "tests" / "fixtures" / "portparser_v2"
+
+
+def _import_evaluation():
+    """Import the CoNLL 2018 UD evaluation script shipped with LatinPipe."""
+    if str(LATINPIPE_DIR) not in sys.path:
+        sys.path.insert(0, str(LATINPIPE_DIR))
+    import latinpipe_evalatin24_eval
+    return latinpipe_evalatin24_eval
+
+
+def benchmark(parser: Parser, conllu: str, reference: str, repeat: int) -> dict:
+    """Time the predictions of a parser and score them against the reference."""
+    evaluation = _import_evaluation()
+    sentences = conllu.count("# sent_id")
+
+    parser.predict(conllu)  # Warmup
+    start = time.perf_counter()
+    for _ in range(repeat):
+        predicted = parser.predict(conllu)
+    elapsed = (time.perf_counter() - start) / repeat
+
+    scores = evaluation.evaluate(evaluation.load_conllu(io.StringIO(reference)),
+                                 evaluation.load_conllu(io.StringIO(parser.postprocess(predicted))))
+    return {"seconds": elapsed, "sentences/s": sentences / elapsed,
+            "UPOS": 100 * scores["UPOS"].f1, "LAS": 100 * scores["LAS"].f1}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", default=None, choices=["onnx", "torch"], type=str, help="Benchmark another inference backend")
+    parser.add_argument("--compile", default=False, action="store_true", help="Benchmark the compiled torch backend against the eager one")
+    parser.add_argument("--input", default=str(FIXTURES_DIR / "alienista.txt"), type=str, help="Input text")
+    parser.add_argument("--reference", default=str(FIXTURES_DIR / "alienista.conllu"), type=str, help="Reference CoNLL-U")
+    parser.add_argument("--model_path", default=None, type=str, help="Model weights, downloaded if not given")
+    parser.add_argument("--precision", default=None, choices=["bf16"], type=str, help="Benchmark a reduced precision model")
+    parser.add_argument("--quantize", default=None, choices=["int8"], type=str, help="Benchmark a quantized model")
+    parser.add_argument("--repeat", default=3, type=int, help="Timed predictions per variant")
+    parser.add_argument("--threads", default=None, type=int, help="Torch threads")
+    args = parser.parse_args()
+
+    text = Path(args.input).read_text(encoding="utf-8")
+    reference = Path(args.reference).read_text(encoding="utf-8")
+    conllu = tokenize_sentences(stripSents(text))
+
+    variants = {"fp32": {}}
+    if args.quantize:
+        variants[args.quantize] = {"quantize": args.quantize}
+    if args.precision:
+        variants[args.precision] = {"precision": args.precision}
+    if args.backend:
+        variants[args.backend] = {"backend": args.backend}
+    if args.compile:
+        variants["torch"] = {"backend": "torch"}
+        variants["compiled"] = {"backend": "torch", "compile": True}
+
+    results = {}
+    for name, options in variants.items():
+        results[name] = benchmark(Parser(args.model_path, threads=args.threads, **options), conllu, reference, args.repeat)
+
+    baseline = results["fp32"]
+    print("{:<8} {:>10} {:>12} {:>8} {:>8} {:>8} {:>8} {:>8}".format(
+        "variant", "seconds", "sentences/s", "speedup", "UPOS", "ΔUPOS", "LAS", "ΔLAS"))
+    for name, result in results.items():
+        print("{:<8} {:>10.2f} {:>12.1f} {:>7.2f}x {:>8.2f} {:>+8.2f} {:>8.2f} {:>+8.2f}".format(
+            name, result["seconds"], result["sentences/s"], baseline["seconds"] / result["seconds"],
+            result["UPOS"], result["UPOS"] - baseline["UPOS"], result["LAS"], result["LAS"] - baseline["LAS"]))
+
+
+if __name__ == "__main__":
+    main()
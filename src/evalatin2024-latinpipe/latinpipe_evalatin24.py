@@ -11,494 +11,19 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import argparse
-import collections
 import datetime
-import difflib
-import io
 import json
 import os
-import pickle
-import re
-from typing import Self
+import sys
 os.environ.setdefault("KERAS_BACKEND", "torch")
 
 import keras
 import numpy as np
 import torch
 import transformers
-import ufal.chu_liu_edmonds
-
-import latinpipe_evalatin24_eval
-
-parser = argparse.ArgumentParser()
-parser.add_argument("--batch_size", default=32, type=int, help="Batch size.")
-parser.add_argument("--deprel", default="full", choices=["full", "universal"], type=str, help="Deprel kind.")
-parser.add_argument("--dev", default=[], nargs="+", type=str, help="Dev CoNLL-U files.")
-parser.add_argument("--dropout", default=0.5, type=float, help="Dropout")
-parser.add_argument("--embed_tags", default="", type=str, help="Tags to embed on input.")
-parser.add_argument("--epochs", default=30, type=int, help="Number of epochs.")
-parser.add_argument("--epochs_frozen", default=0, type=int, help="Number of epochs with frozen transformer.")
-parser.add_argument("--exp", default=None, type=str, help="Experiment name.")
-parser.add_argument("--label_smoothing", default=0.03, type=float, help="Label smoothing.")
-parser.add_argument("--learning_rate", default=2e-5, type=float, help="Learning rate.")
-parser.add_argument("--learning_rate_decay", default="cos", choices=["none", "cos"], type=str, help="Learning rate decay.")
-parser.add_argument("--learning_rate_warmup", default=2_000, type=int, help="Number of warmup steps.")
-parser.add_argument("--load", default=[], type=str, nargs="*", help="Path to load models from.")
-parser.add_argument("--max_train_sentence_len", default=150, type=int, help="Max sentence subwords in training.")
-parser.add_argument("--optimizer", default="adam", choices=["adam", "adafactor"], type=str, help="Optimizer.")
-parser.add_argument("--parse", default=1, type=int, help="Parse.")
-parser.add_argument("--parse_attention_dim", default=512, type=int, help="Parse attention dimension.")
-parser.add_argument("--rnn_dim", default=512, type=int, help="RNN layers size.")
-parser.add_argument("--rnn_layers", default=2, type=int, help="RNN layers.")
-parser.add_argument("--rnn_type", default="LSTMTorch", choices=["LSTM", "GRU", "LSTMTorch", "GRUTorch"], help="RNN type.")
-parser.add_argument("--save_checkpoint", default=False, action="store_true", help="Save checkpoint.")
-parser.add_argument("--seed", default=42, type=int, help="Initial random seed.")
-parser.add_argument("--steps_per_epoch", default=1_000, type=int, help="Steps per epoch.")
-parser.add_argument("--single_root", default=1, type=int, help="Single root allowed only.")
-parser.add_argument("--subword_combination", default="first", choices=["first", "last", "sum", "concat"], type=str, help="Subword combination.")
-parser.add_argument("--tags", default="UPOS,LEMMAS,FEATS", type=str, help="Tags to predict.")
-parser.add_argument("--task_hidden_layer", default=2_048, type=int, help="Task hidden layer size.")
-parser.add_argument("--test", default=[], nargs="+", type=str, help="Test CoNLL-U files.")
-parser.add_argument("--train", default=[], nargs="+", type=str, help="Train CoNLL-U files.")
-parser.add_argument("--train_sampling_exponent", default=0.5, type=float, help="Train sampling exponent.")
-parser.add_argument("--transformers", nargs="+", type=str, help="Transformers models to use.")
-parser.add_argument("--treebank_ids", default=False, action="store_true", help="Include treebank IDs on input.")
-parser.add_argument("--threads", default=4, type=int, help="Maximum number of threads to use.")
-parser.add_argument("--verbose", default=2, type=int, help="Verbosity")
-parser.add_argument("--wandb", default=False, action="store_true", help="Log in WandB.")
-parser.add_argument("--word_masking", default=None, type=float, help="Word masking")
-
-os.environ["PYTORCH_MPS_HIGH_WATERMARK_RATIO"] = "0.0"
-
-class UDDataset:
-    FORMS, LEMMAS, UPOS, XPOS, FEATS, HEAD, DEPREL, DEPS, MISC, FACTORS = range(10)
-    FACTORS_MAP = {"FORMS": FORMS, "LEMMAS": LEMMAS, "UPOS": UPOS, "XPOS": XPOS, "FEATS": FEATS,
-                   "HEAD": HEAD, "DEPREL": DEPREL, "DEPS": DEPS, "MISC": MISC}
-    RE_EXTRAS = re.compile(r"^#|^\d+-|^\d+\.")
-
-    class Factor:
-        def __init__(self, train_factor: Self = None):
-            self.words_map = train_factor.words_map if train_factor else {"<unk>": 0}
-            self.words = train_factor.words if train_factor else ["<unk>"]
-            self.word_ids = []
-            self.strings = []
-
-    def __init__(self, path: str, args: argparse.Namespace, treebank_id: int|None = None, train_dataset: Self = None, text: str|None = None):
-        self.path = path
-
-        # Create factors and other variables
-        self.factors = []
-        for f in range(self.FACTORS):
-            self.factors.append(self.Factor(train_dataset.factors[f] if train_dataset is not None else None))
-        self._extras = []
-
-        lemma_transforms = collections.Counter()
-
-        # Load the CoNLL-U file
-        with open(path, "r", encoding="utf-8") if text is None else io.StringIO(text) as file:
-            in_sentence = False
-            for line in file:
-                line = line.rstrip("\r\n")
-
-                if line:
-                    if self.RE_EXTRAS.match(line):
-                        if in_sentence:
-                            while len(self._extras) < len(self.factors[0].strings): self._extras.append([])
-                            while len(self._extras[-1]) <= len(self.factors[0].strings[-1]):
-                                self._extras[-1].append("")
-                        else:
-                            while len(self._extras) <= len(self.factors[0].strings): self._extras.append([])
-                            if not len(self._extras[-1]): self._extras[-1].append("")
-                        self._extras[-1][-1] += ("\n" if self._extras[-1][-1] else "") + line
-                        continue
-
-                    columns = line.split("\t")[1:]
-                    for f in range(self.FACTORS):
-                        factor = self.factors[f]
-                        if not in_sentence:
-                            factor.word_ids.append([])
-                            factor.strings.append([])
-
-                        word = columns[f]
-                        factor.strings[-1].append(word)
-
-                        # Add word to word_ids
-                        if f == self.FORMS:
-                            # For formw, we do not remap strings into IDs because the tokenizer will create the subwords IDs for us.
-                            factor.word_ids[-1].append(0)
-                        elif f == self.HEAD:
-                            factor.word_ids[-1].append(int(word) if word != "_" else -1)
-                        elif f == self.LEMMAS:
-                            factor.word_ids[-1].append(0)
-                            lemma_transforms[(columns[self.FORMS], word)] += 1
-                        else:
-                            if f == self.DEPREL and args.deprel == "universal":
-                                word = word.split(":")[0]
-                            if word not in factor.words_map:
-                                if train_dataset is not None:
-                                    word = "<unk>"
-                                else:
-                                    factor.words_map[word] = len(factor.words)
-                                    factor.words.append(word)
-                            factor.word_ids[-1].append(factor.words_map[word])
-                    in_sentence = True
-                else:
-                    in_sentence = False
-                    for factor in self.factors:
-                        if len(factor.word_ids): factor.word_ids[-1] = np.array(factor.word_ids[-1], np.int32)
-
-            # Also load the file for evaluation if it is not a training dataset
-            if train_dataset is not None:
-                file.seek(0, io.SEEK_SET)
-                self.conllu_for_eval = latinpipe_evalatin24_eval.load_conllu(file)
-
-        # Construct lemma rules
-        self.finalize_lemma_rules(lemma_transforms, create_rules=train_dataset is None)
-
-        # The dataset consists of a single treebank
-        self.treebank_ranges = [(0, len(self))]
-        self.treebank_ids = [treebank_id]
-
-        # Create an empty tokenize cache
-        self._tokenizer_cache = {}
-
-    def __len__(self):
-        return len(self.factors[0].strings)
-
-    def save_mappings(self, path: str) -> None:
-        mappings = UDDataset.__new__(UDDataset)
-        mappings.factors = []
-        for factor in self.factors:
-            mappings.factors.append(UDDataset.Factor.__new__(UDDataset.Factor))
-            mappings.factors[-1].words = factor.words
-        with open(path, "wb") as mappings_file:
-            pickle.dump(mappings, mappings_file, protocol=4)
-
-    @staticmethod
-    def from_mappings(path: str) -> Self:
-        with open(path, "rb") as mappings_file:
-            mappings = pickle.load(mappings_file)
-        for factor in mappings.factors:
-            factor.words_map = {word: i for i, word in enumerate(factor.words)}
-        return mappings
-
-    @staticmethod
-    def create_lemma_rule(form: str, lemma: str) -> str:
-        diff = difflib.SequenceMatcher(None, form.lower(), lemma.lower(), False)
-        rule, in_prefix = [], True
-        for tag, i1, i2, j1, j2 in diff.get_opcodes():
-            if i2 > len(form) // 3 and in_prefix:
-                in_prefix = False
-                if tag == "equal":
-                    mode, jd = "L" if lemma[j2 - 1].islower() else "U", j2 - 1
-                    while jd > j1 and lemma[jd - 1].islower() == lemma[j2 - 1].islower(): jd -= 1
-                    rule.extend(["l" if lemma[j].islower() else "u" for j in range(j1, jd)])
-                    rule.extend(mode * (len(form) - i2 + 1))
-                if tag in ["replace", "delete"]:
-                    rule.extend("D" * (len(form) - i2 + 1))
-                if tag in ["replace", "insert"]:
-                    rule.extend("i" + lemma[j] for j in range(j1, j2))
-            else:
-                if tag == "equal":
-                    rule.extend(["l" if lemma[j].islower() else "u" for j in range(j1, j2)])
-                if tag in ["replace", "delete"]:
-                    rule.extend("d" * (i2 - i1))
-                if tag in ["replace", "insert"]:
-                    rule.extend("i" + lemma[j] for j in range(j1, j2))
-        return "".join(rule)
-
-    @staticmethod
-    def apply_lemma_rule(rule: str, form: str) -> str:
-        def error():
-            # print("Error: cannot decode lemma rule '{}' with form '{}', copying input.".format(rule, form))
-            return form
-
-        if rule == "<unk>":
-            return form
-
-        lemma, r, i = [], 0, 0
-        while r < len(rule):
-            if rule[r] == "i":
-                if r + 1 == len(rule):
-                    return error()
-                r += 1
-                lemma.append(rule[r])
-            elif rule[r] == "d":
-                i += 1
-            elif rule[r] in ("l", "u"):
-                if i == len(form):
-                    return error()
-                lemma.append(form[i].lower() if rule[r] == "l" else form[i].upper())
-                i += 1
-            elif rule[r] in ("L", "U", "D"):
-                i2 = len(form)
-                while r + 1 < len(rule) and rule[r + 1] == rule[r]:
-                    r += 1
-                    i2 -= 1
-                if i2 < i:
-                    return error()
-                if rule[r] == "L":
-                    lemma.extend(form[i:i2].lower())
-                if rule[r] == "U":
-                    lemma.extend(form[i:i2].upper())
-                i = i2
-            else:
-                return error()
-            r += 1
-        if i != len(form) or not lemma:
-            return error()
-        return "".join(lemma)
-
-    def finalize_lemma_rules(self, lemma_transforms: collections.Counter, create_rules: bool) -> None:
-        forms, lemmas = self.factors[self.FORMS], self.factors[self.LEMMAS]
-
-        # Generate all rules
-        rules_merged, rules_all = collections.Counter(), {}
-        for form, lemma in lemma_transforms:
-            rule = self.create_lemma_rule(form, lemma)
-            rules_all[(form, lemma)] = rule
-            if create_rules:
-                rules_merged[rule] += 1
-
-        # Keep the rules that are used more than once
-        if create_rules:
-            for rule, count in rules_merged.items():
-                if count > 1:
-                    lemmas.words_map[rule] = len(lemmas.words)
-                    lemmas.words.append(rule)
-
-        # Store the rules in the dataset
-        for i in range(len(forms.strings)):
-            for j in range(len(forms.strings[i])):
-                rule = rules_all.get((forms.strings[i][j], lemmas.strings[i][j]))
-                lemmas.word_ids[i][j] = lemmas.words_map.get(rule, 0)
-
-    def tokenize(self, tokenizer: transformers.PreTrainedTokenizer) -> tuple[list[np.ndarray], list[np.ndarray]]:
-        if tokenizer not in self._tokenizer_cache:
-            assert tokenizer.cls_token_id is not None, "The tokenizer must have a CLS token"
-
-            tokenized = tokenizer(self.factors[0].strings, add_special_tokens=True, is_split_into_words=True)
-
-            tokens, word_indices = [], []
-            for i, sentence in enumerate(tokenized.input_ids):
-                offset = 0
-                if not len(sentence) or sentence[0] != tokenizer.cls_token_id:
-                    # Handle tokenizers that do not add CLS tokens, which we need for prediction
-                    # of the root nodes during parsing. For such tokenizers, we added the CLS token
-                    # manually already, but the build_inputs_with_special_tokens() might not have added it.
-                    sentence = [tokenizer.cls_token_id] + sentence
-                    offset = 1
-
-                treebank_id = None
-                for id_, (start, end) in zip(self.treebank_ids, self.treebank_ranges):
-                    if start <= i < end:
-                        treebank_id = id_
-                if treebank_id is not None:
-                    sentence.insert(1, tokenizer.additional_special_tokens_ids[treebank_id])
-                    offset += 1
-
-                tokens.append(np.array(sentence, dtype=np.int32))
-                word_indices.append([(0, 0)])
-                for j in range(len(self.factors[0].strings[i])):
-                    span = tokenized.word_to_tokens(i, j)
-                    if (span == None):
-                        print("-x-x-x-", i, j)
-                    try:
-                        word_indices[-1].append((offset + span.start, offset + span.end - 1))
-                    except:
-                        #abracadabra = 0
-                        print(treebank_id)
-                        input("??")
-                word_indices[-1] = np.array(word_indices[-1], dtype=np.int32)
-
-
-            self._tokenizer_cache[tokenizer] = (tokens, word_indices)
-
-        return self._tokenizer_cache[tokenizer]
-
-    def write_sentence(self, output: io.TextIOBase, index: int, overrides: list = None) -> None:
-        assert index < len(self.factors[0].strings), "Sentence index out of range"
-
-        for i in range(len(self.factors[0].strings[index]) + 1):
-            # Start by writing extras
-            if index < len(self._extras) and i < len(self._extras[index]) and self._extras[index][i]:
-                print(self._extras[index][i], file=output)
-            if i == len(self.factors[0].strings[index]): break
-
-            fields = []
-            fields.append(str(i + 1))
-            for f in range(self.FACTORS):
-                factor = self.factors[f]
-                field = factor.strings[index][i]
-
-                # Overrides
-                if overrides is not None and f < len(overrides) and overrides[f] is not None:
-                    override = overrides[f][i]
-                    if f == self.HEAD:
-                        field = str(override) if override >= 0 else "_"
-                    else:
-                        field = factor.words[override]
-                        if f == self.LEMMAS:
-                            field = self.apply_lemma_rule(field, self.factors[self.FORMS].strings[index][i])
-                fields.append(field)
-
-            print("\t".join(fields), file=output)
-        print(file=output)
-
-
-class UDDatasetMerged(UDDataset):
-    def __init__(self, datasets: list[UDDataset]):
-        # Create factors and other variables
-        self.factors = []
-        for f in range(self.FACTORS):
-            self.factors.append(self.Factor(None))
-
-        lemma_transforms = collections.Counter()
-
-        self.treebank_ranges, self.treebank_ids = [], []
-        for dataset in datasets:
-            assert len(dataset.treebank_ranges) == len(dataset.treebank_ids) == 1
-            self.treebank_ranges.append((len(self), len(self) + len(dataset)))
-            self.treebank_ids.append(dataset.treebank_ids[0])
-            for s in range(len(dataset)):
-                for f in range(self.FACTORS):
-                    factor = self.factors[f]
-                    factor.strings.append(dataset.factors[f].strings[s])
-                    factor.word_ids.append([])
-                    for i, word in enumerate(dataset.factors[f].strings[s]):
-                        if f == self.FORMS:
-                            # We do not remap strings into IDs because the tokenizer will create the subwords IDs for us.
-                            factor.word_ids[-1].append(0)
-                        if f == self.HEAD:
-                            factor.word_ids[-1].append(word)
-                        elif f == self.LEMMAS:
-                            factor.word_ids[-1].append(0)
-                            lemma_transforms[(dataset.factors[self.FORMS].strings[s][i], word)] += 1
-                        else:
-                            if word not in factor.words_map:
-                                factor.words_map[word] = len(factor.words)
-                                factor.words.append(word)
-                            factor.word_ids[-1].append(factor.words_map[word])
-                    self.factors[f].word_ids[-1] = np.array(self.factors[f].word_ids[-1], np.int32)
-
-        # Construct lemma rules
-        self.finalize_lemma_rules(lemma_transforms, create_rules=True)
-
-        # Create an empty tokenize cache
-        self._tokenizer_cache = {}
-
-
-class TorchUDDataset(torch.utils.data.Dataset):
-    def __init__(self, ud_dataset: UDDataset, tokenizers: list[transformers.PreTrainedTokenizer], args: argparse.Namespace, training: bool):
-        self.ud_dataset = ud_dataset
-        self.training = training
-        self._outputs_to_input = [args.tags.index(tag) for tag in args.embed_tags]
-
-        self._inputs = [ud_dataset.tokenize(tokenizer) for tokenizer in tokenizers]
-        self._outputs = [ud_dataset.factors[tag].word_ids for tag in args.tags]
-        if args.parse:
-            self._outputs.append(ud_dataset.factors[ud_dataset.HEAD].word_ids)
-            self._outputs.append(ud_dataset.factors[ud_dataset.DEPREL].word_ids)
-
-        # Trim the sentences if needed
-        if training and args.max_train_sentence_len:
-            trimmed_sentences = 0
-            for index in range(len(self)):  # Over sentences
-                max_words, need_trimming = None, False
-                for tokens, word_indices in self._inputs:  # Over transformers
-                    if max_words is None:
-                        max_words = len(word_indices[index])
-                    while word_indices[index][max_words - 1, 1] >= args.max_train_sentence_len:
-                        max_words -= 1
-                        need_trimming = True
-                assert max_words >= 2, "Sentence too short after trimming"
-
-                if need_trimming:
-                    for tokens, word_indices in self._inputs:  # Over transformers
-                        tokens[index] = tokens[index][:word_indices[index][max_words - 1, 1] + 1]
-                        word_indices[index] = word_indices[index][:max_words]
-
-                    for output in self._outputs:
-                        output[index] = output[index][:max_words - 1]  # No CLS tokens in outputs
-                    if args.parse:
-                        self._outputs[-2][index] = np.array([head if head < max_words else -1 for head in self._outputs[-2][index]], np.int32)
-
-                    trimmed_sentences += 1
-            if trimmed_sentences:
-                print("Trimmed {} out of {} sentences".format(trimmed_sentences, len(self)))
-
-    def __len__(self):
-        return len(self.ud_dataset)
-
-    def __getitem__(self, index: int):
-        inputs = []
-        for tokens, word_indices in self._inputs:
-            inputs.append(torch.from_numpy(tokens[index]))
-            inputs.append(torch.from_numpy(word_indices[index]))
-        for i in self._outputs_to_input:
-            inputs.append(torch.from_numpy(self._outputs[i][index]))
 
-        outputs = []
-        for output in self._outputs:
-            outputs.append(torch.from_numpy(output[index]))
-
-        return inputs, outputs
-
-
-class TorchUDDataLoader(torch.utils.data.DataLoader):
-    class MergedDatasetSampler(torch.utils.data.Sampler):
-        def __init__(self, ud_dataset: UDDataset, args: argparse.Namespace):
-            self._treebank_ranges = ud_dataset.treebank_ranges
-            self._sentences_per_epoch = args.steps_per_epoch * args.batch_size
-            self._generator = torch.Generator().manual_seed(args.seed)
-
-            treebank_weights = np.array([r[1] - r[0] for r in self._treebank_ranges], np.float32)
-            treebank_weights = treebank_weights ** args.train_sampling_exponent
-            treebank_weights /= np.sum(treebank_weights)
-            self._treebank_sizes = np.array(treebank_weights * self._sentences_per_epoch, np.int32)
-            self._treebank_sizes[:self._sentences_per_epoch - np.sum(self._treebank_sizes)] += 1
-            self._treebank_indices = [[] for _ in self._treebank_ranges]
-
-        def __len__(self):
-            return self._sentences_per_epoch
-
-        def __iter__(self):
-            indices = []
-            for i in range(len(self._treebank_ranges)):
-                required = self._treebank_sizes[i]
-                while required:
-                    if not len(self._treebank_indices[i]):
-                        self._treebank_indices[i] = self._treebank_ranges[i][0] + torch.randperm(
-                            self._treebank_ranges[i][1] - self._treebank_ranges[i][0], generator=self._generator)
-                    indices.append(self._treebank_indices[i][:required])
-                    required -= min(len(self._treebank_indices[i]), required)
-            indices = torch.concatenate(indices, axis=0)
-            return iter(indices[torch.randperm(len(indices), generator=self._generator)])
-
-    def _collate_fn(self, batch):
-        inputs, outputs = zip(*batch)
-
-        batch_inputs = []
-        for sequences in zip(*inputs):
-            batch_inputs.append(torch.nn.utils.rnn.pad_sequence(sequences, batch_first=True, padding_value=-1))
-
-        batch_outputs = []
-        for output in zip(*outputs):
-            batch_outputs.append(torch.nn.utils.rnn.pad_sequence(output, batch_first=True, padding_value=-1))
-
-        batch_weights = [batch_output != -1 for batch_output in batch_outputs]
-
-        return tuple(batch_inputs), tuple(batch_outputs), tuple(batch_weights)
-
-    def __init__(self, dataset: TorchUDDataset, args: argparse.Namespace, **kwargs):
-        sampler = None
-        if dataset.training:
-            if len(dataset.ud_dataset.treebank_ranges) == 1:
-                sampler = torch.utils.data.RandomSampler(dataset, generator=torch.Generator().manual_seed(args.seed))
-            else:
-                assert args.steps_per_epoch is not None, "Steps per epoch must be specified when training on multiple treebanks"
-                sampler = self.MergedDatasetSampler(dataset.ud_dataset, args)
-        super().__init__(dataset, batch_size=args.batch_size, sampler=sampler, collate_fn=self._collate_fn, **kwargs)
+from latinpipe_evalatin24_base import parser, create_transformer, evaluate_conllu, pool_subwords, predict_conllu, predict_overrides, predicted_labels, sentence_confidences, shutdown_decoding_pool, task_outputs, TorchUDDataLoader, TorchUDDataset, UDDataset, UDDatasetMerged
+from latinpipe_evalatin24_torch import LatinPipeModelTorch
 
 
 class LatinPipeModel(keras.Model):
@@ -516,28 +41,12 @@ class LatinPipeModel(keras.Model):
                 inputs = (1 - mask) * inputs + mask * self._mask_token_id
             if (training or False) != self._transformer.training:
                 self._transformer.train(training or False)
-            if self._subword_combination != "last":
-                first_subwords = keras.ops.take_along_axis(
-                    self._transformer(keras.ops.maximum(inputs, 0), attention_mask=inputs > -1).last_hidden_state,
-                    keras.ops.expand_dims(keras.ops.maximum(word_indices[..., 0], 0), axis=-1),
-                    axis=1,
-                )
-            if self._subword_combination != "first":
-                last_subwords = keras.ops.take_along_axis(
-                    self._transformer(keras.ops.maximum(inputs, 0), attention_mask=inputs > -1).last_hidden_state,
-                    keras.ops.expand_dims(keras.ops.maximum(word_indices[..., 1], 0), axis=-1),
-                    axis=1,
-                )
-            if self._subword_combination == "first":
-                return first_subwords
-            elif self._subword_combination == "last":
-                return last_subwords
-            elif self._subword_combination == "sum":
-                return first_subwords + last_subwords
-            elif self._subword_combination == "concat":
-                return keras.ops.concatenate([first_subwords, last_subwords], axis=-1)
-            else:
-                raise ValueError("Unknown subword combination '{}'".format(self._subword_combination))
+            hidden_states = self._transformer(keras.ops.maximum(inputs, 0), attention_mask=inputs > -1).last_hidden_state
+            return pool_subwords(hidden_states, word_indices, self._subword_combination)
+
+        def quantize_dynamic(self) -> None:
+            transformer = getattr(self._transformer, "module", self._transformer)
+            torch.ao.quantization.quantize_dynamic(transformer, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
 
     class LSTMTorch(keras.layers.Layer):
         def __init__(self, units: int, **kwargs):
@@ -549,8 +58,12 @@ class LatinPipeModel(keras.Model):
 
         def call(self, inputs, lengths):
             packed_result, _ = self._lstm.module(torch.nn.utils.rnn.pack_padded_sequence(inputs, lengths.cpu(), batch_first=True, enforce_sorted=False))
-            unpacked_result = torch.nn.utils.rnn.unpack_sequence(packed_result)
-            return torch.nn.utils.rnn.pad_sequence(unpacked_result, batch_first=True, padding_value=0)
+            if torch.onnx.is_in_onnx_export():
+                # The same padded result, without the Python loop over the batch that tracing would unroll
+                return torch.nn.utils.rnn.pad_packed_sequence(packed_result, batch_first=True, padding_value=0)[0]
+            # Pad back to the input length, which the longest sentence need not reach, e.g., for the
+            # sentences escalated by a selective ensemble
+            return torch.nn.utils.rnn.pad_packed_sequence(packed_result, batch_first=True, padding_value=0, total_length=inputs.shape[1])[0]
 
     class GRUTorch(keras.layers.Layer):
         def __init__(self, units: int, **kwargs):
@@ -561,9 +74,8 @@ class LatinPipeModel(keras.Model):
             self._gru = torch.nn.GRU(input_shape[-1], self._units, batch_first=True, bidirectional=True)
 
         def call(self, inputs, lengths):
-            packed_result, _ = self._gru(torch.nn.utils.rnn.pack_padded_sequence(inputs, lengths.cpu(), batch_first=True, enforce_sorted=False))
-            unpacked_result = torch.nn.utils.rnn.unpack_sequence(packed_result)
-            return torch.nn.utils.rnn.pad_sequence(unpacked_result, batch_first=True, padding_value=0)
+            packed_result, _ = self._gru.module(torch.nn.utils.rnn.pack_padded_sequence(inputs, lengths.cpu(), batch_first=True, enforce_sorted=False))
+            return torch.nn.utils.rnn.pad_packed_sequence(packed_result, batch_first=True, padding_value=0, total_length=inputs.shape[1])[0]
 
     class ParsingHead(keras.layers.Layer):
         def __init__(self, num_deprels: int, task_hidden_layer: int, parse_attention_dim: int, dropout: float, **kwargs):
@@ -607,38 +119,14 @@ class LatinPipeModel(keras.Model):
     def __init__(self, dataset: UDDataset, args: argparse.Namespace):
         self._dataset = dataset
         self._args = args
+        self._task_functions = {}
 
         # Create the transformer models
         self._tokenizers, self._transformers = [], []
         for name in args.transformers:
-            self._tokenizers.append(transformers.AutoTokenizer.from_pretrained(name, add_prefix_space=True))
-
-            transformer, transformer_opts = transformers.AutoModel, {}
-            if "mt5" in name.lower():
-                transformer = transformers.MT5EncoderModel
-            if name.endswith(("LaTa", "PhilTa")):
-                transformer = transformers.T5EncoderModel
-            if name.endswith(("LaBerta", "PhilBerta")):
-                transformer_opts["add_pooling_layer"] = False
-
-            if args.load:
-                transformer = transformer.from_config(transformers.AutoConfig.from_pretrained(name), **transformer_opts)
-            else:
-                transformer = transformer.from_pretrained(name, **transformer_opts)
-
-            # Create additional tokens
-            additional_tokens = {}
-            if args.treebank_ids:
-                additional_tokens["additional_special_tokens"] = ["[TREEBANK_ID_{}]".format(i) for i in range(len(dataset.treebank_ids))]
-            if self._tokenizers[-1].cls_token_id is None:  # Generate CLS token if not present (for representing sentence root in parsing).
-                additional_tokens["cls_token"] = "[CLS]"
-            if additional_tokens:
-                self._tokenizers[-1].add_special_tokens(additional_tokens)
-                transformer.resize_token_embeddings(len(self._tokenizers[-1]))
-            if args.treebank_ids:
-                assert len(self._tokenizers[-1].additional_special_tokens) == len(dataset.treebank_ids)
-
-            self._transformers.append(self.HFTransformerLayer(transformer, args.subword_combination, args.word_masking, self._tokenizers[-1].mask_token_id))
+            tokenizer, transformer = create_transformer(name, dataset, args)
+            self._tokenizers.append(tokenizer)
+            self._transformers.append(self.HFTransformerLayer(transformer, args.subword_combination, args.word_masking, tokenizer.mask_token_id))
 
         # Create the network
         inputs = []
@@ -685,6 +173,8 @@ class LatinPipeModel(keras.Model):
         super().__init__(inputs=inputs, outputs=outputs)
         if args.load:
             self.load_weights(args.load[0])
+            if args.quantize != "none":
+                self.quantize_for_inference(args.quantize)
 
     def compile(self, epoch_batches: int, frozen: bool):
         args = self._args
@@ -713,111 +203,176 @@ class LatinPipeModel(keras.Model):
             loss=self.SparseCategoricalCrossentropyWithLabelSmoothing(from_logits=True, label_smoothing=args.label_smoothing),
         )
 
+    def quantize_for_inference(self, mode: str) -> None:
+        # Dynamic quantization of the transformer linear layers, and Keras quantization of the Dense
+        # layers of the tagging and parsing heads; the weights cannot be loaded or trained afterwards.
+        if mode != "int8":
+            raise ValueError("Unknown quantization mode '{}'".format(mode))
+        for layer in self._flatten_layers():
+            if isinstance(layer, self.HFTransformerLayer):
+                layer.quantize_dynamic()
+            elif isinstance(layer, keras.layers.Dense):
+                layer.quantize(mode)
+
     @property
     def tokenizers(self) -> list[transformers.PreTrainedTokenizer]:
         return self._tokenizers
 
+    def export_onnx(self, path: str) -> None:
+        # Trace the network on two sentences of different lengths, with dynamic batch and sequence axes.
+        sample = UDDataset("<sample>", self._args, train_dataset=self._dataset, text="".join(
+            "".join("{}\t{}{}\n".format(i + 1, word, "\t_" * 8) for i, word in enumerate(sentence.split())) + "\n"
+            for sentence in ["Sample sentence .", "Second sample sentence for tracing ."]))
+        batch_inputs, _, _ = next(iter(TorchUDDataLoader(TorchUDDataset(sample, self._tokenizers, self._args, training=False), self._args)))
+
+        input_names, dynamic_axes = [], {}
+        for i in range(len(self._tokenizers)):
+            input_names.extend(["tokens_{}".format(i), "word_indices_{}".format(i)])
+            dynamic_axes["tokens_{}".format(i)] = {0: "batch", 1: "subwords_{}".format(i)}
+            dynamic_axes["word_indices_{}".format(i)] = {0: "batch", 1: "words_with_root"}
+        for tag in self._args.embed_tags:
+            input_names.append("embed_tag_{}".format(tag))
+            dynamic_axes[input_names[-1]] = {0: "batch", 1: "words"}
+        output_names = ["tag_{}".format(tag) for tag in self._args.tags] + (["heads", "deprels"] if self._args.parse else [])
+        for name in output_names:
+            dynamic_axes[name] = {0: "batch", 1: "words"}
+        if self._args.parse:
+            dynamic_axes["heads"][2] = "words_with_root"
+
+        self.eval()
+        with torch.no_grad():
+            torch.onnx.export(self, (list(batch_inputs),), path, input_names=input_names, output_names=output_names,
+                              dynamic_axes=dynamic_axes, dynamo=False)
+        for i, tokenizer in enumerate(self._tokenizers):
+            tokenizer.save_pretrained("{}.tokenizer_{}".format(path, i))
+
+    def predict_on_batch(self, x):
+        # With bf16 precision, the network runs under autocast, but the returned scores are float32 numpy
+        # arrays, so the log-softmax and the MST decoding in predict keep their full precision.
+        with torch.autocast("cpu", dtype=torch.bfloat16, enabled=self._args.precision == "bf16"):
+            predictions = super().predict_on_batch(x)
+        return keras.tree.map_structure(lambda prediction: np.asarray(prediction, dtype=np.float32), predictions)
+
+    def predict_labels_on_batch(self, x, args: argparse.Namespace|None = None):
+        # As predict_on_batch, but returns the predicted labels instead of the tagging and deprel scores.
+        # When `args` request only some of the tags or no parsing, only the sub-graph of the network
+        # computing the requested outputs is run, so that, e.g., tagging skips the RNNs and ParsingHead.
+        args = self._args if args is None else args
+        outputs = tuple(task_outputs(self._args, args))
+        if not outputs:
+            return []
+        with torch.no_grad(), torch.autocast("cpu", dtype=torch.bfloat16, enabled=self._args.precision == "bf16"):
+            if outputs == tuple(range(len(self.outputs))):
+                predictions = self(list(x), training=False)
+            else:
+                if outputs not in self._task_functions:
+                    self._task_functions[outputs] = keras.Function(self.inputs, [self.outputs[output] for output in outputs])
+                predictions = self._task_functions[outputs](list(x))
+        return predicted_labels(keras.tree.flatten(predictions), args)
+
     def predict(self, dataloader: TorchUDDataLoader, save_as: str|None = None, args_override: argparse.Namespace|None = None) -> str:
-        ud_dataset = dataloader.dataset.ud_dataset
-        args = self._args if args_override is None else args_override
-        conllu, sentence = io.StringIO(), 0
-
-        for batch_inputs, _, _ in dataloader:
-            predictions = self.predict_on_batch(batch_inputs)
-            for b in range(len(batch_inputs[0])):
-                sentence_len = len(ud_dataset.factors[ud_dataset.FORMS].strings[sentence])
-                overrides = [None] * ud_dataset.FACTORS
-                for tag, prediction in zip(args.tags, predictions):
-                    overrides[tag] = np.argmax(prediction[b, :sentence_len], axis=-1)
-                if args.parse:
-                    heads, deprels = predictions[-2:]
-                    padded_heads = np.zeros([sentence_len + 1, sentence_len + 1], dtype=np.float64)
-                    padded_heads[1:] = heads[b, :sentence_len, :sentence_len + 1]
-                    padded_heads[1:] -= np.max(padded_heads[1:], axis=-1, keepdims=True)
-                    padded_heads[1:] -= np.log(np.sum(np.exp(padded_heads[1:]), axis=-1, keepdims=True))
-                    if args.single_root:
-                        selected_root = 1 + np.argmax(padded_heads[1:, 0])
-                        padded_heads[:, 0] = np.nan
-                        padded_heads[selected_root, 0] = 0
-                    chosen_heads, _ = ufal.chu_liu_edmonds.chu_liu_edmonds(padded_heads)
-                    overrides[ud_dataset.HEAD] = chosen_heads[1:]
-                    overrides[ud_dataset.DEPREL] = np.argmax(deprels[b, :sentence_len], axis=-1)
-                ud_dataset.write_sentence(conllu, sentence, overrides)
-                sentence += 1
-
-        conllu = conllu.getvalue()
-        if save_as is not None:
-            os.makedirs(os.path.dirname(save_as), exist_ok=True)
-            with open(save_as, "w", encoding="utf-8") as conllu_file:
-                conllu_file.write(conllu)
-        return conllu
+        return predict_conllu(self, dataloader, self._args if args_override is None else args_override, save_as=save_as)
 
     def evaluate(self, dataloader: TorchUDDataLoader, save_as: str|None = None, args_override: argparse.Namespace|None = None) -> tuple[str, dict[str, float]]:
-        conllu = self.predict(dataloader, save_as=save_as, args_override=args_override)
-        evaluation = latinpipe_evalatin24_eval.evaluate(dataloader.dataset.ud_dataset.conllu_for_eval, latinpipe_evalatin24_eval.load_conllu(io.StringIO(conllu)))
-        if save_as is not None:
-            os.makedirs(os.path.dirname(save_as), exist_ok=True)
-            with open(save_as + ".eval", "w", encoding="utf-8") as eval_file:
-                for metric, score in evaluation.items():
-                    print("{}: {:.2f}%".format(metric, 100 * score.f1), file=eval_file)
-        return conllu, evaluation
+        return evaluate_conllu(self, dataloader, save_as=save_as, args_override=args_override)
 
 
 class LatinPipeModelEnsemble:
-    def __init__(self, latinpipe_model: LatinPipeModel, args: argparse.Namespace):
-        self._latinpipe_model = latinpipe_model
+    # All members stay loaded and every batch runs through all of them, so their summed log-probabilities
+    # are decoded batch by batch exactly as the predictions of a single model. With --ensemble_threshold,
+    # only the sentences the first member is not confident about are predicted by the other members.
+    def __init__(self, members: list, args: argparse.Namespace):
+        self._members = members
         self._args = args
+        self.sentences, self.escalated_sentences = 0, 0
+
+    @property
+    def tokenizers(self) -> list[transformers.PreTrainedTokenizer]:
+        return self._members[0].tokenizers
+
+    def predict_labels_on_batch(self, x, args: argparse.Namespace|None = None):
+        args = self._args if args is None else args
+        outputs = task_outputs(self._args, args)
+        if not outputs:
+            return []
+
+        def log_probabilities(member, x):
+            predictions = member.predict_on_batch(x)
+            return [torch.log_softmax(torch.from_numpy(predictions[output]).double(), dim=-1) for output in outputs]
+
+        scores = log_probabilities(self._members[0], x)
+        escalated = slice(None)
+        if args.ensemble_threshold is not None:
+            lengths = torch.sum(torch.as_tensor(x[1])[..., 0] > -1, dim=-1) - 1
+            escalated = torch.nonzero(sentence_confidences(scores, lengths, args) < args.ensemble_threshold)[:, 0]
+            self.sentences += len(lengths)
+            self.escalated_sentences += len(escalated)
+        if len(self._members) > 1 and len(scores[0][escalated]):
+            x_escalated = [torch.as_tensor(inputs)[escalated] for inputs in x]
+            for member in self._members[1:]:
+                for score, log_probability in zip(scores, log_probabilities(member, x_escalated)):
+                    score[escalated] += log_probability
+
+        labels = [torch.argmax(score, dim=-1).numpy() for score in scores[:len(args.tags)]]
+        if args.parse:
+            labels.append(scores[-2].numpy())
+            labels.append(torch.argmax(scores[-1], dim=-1).numpy())
+        return labels
 
-    def predict(self, dataloader: TorchUDDataLoader, save_as: str|None = None) -> str:
-        def log_softmax(logits):
-            logits -= np.max(logits, axis=-1, keepdims=True)
-            logits -= np.log(np.sum(np.exp(logits), axis=-1, keepdims=True))
-            return logits
-        ud_dataset = dataloader.dataset.ud_dataset
-
-        # First compute all predictions
-        overrides = [[0] * len(ud_dataset) if tag in self._args.tags + ([ud_dataset.HEAD, ud_dataset.DEPREL] if self._args.parse else []) else None
-                     for tag in range(ud_dataset.FACTORS)]
-        for path in self._args.load:
-            self._latinpipe_model.load_weights(path)
-            sentence = 0
-            for batch_inputs, _, _ in dataloader:
-                predictions = self._latinpipe_model.predict_on_batch(batch_inputs)
-                for b in range(len(batch_inputs[0])):
-                    sentence_len = len(ud_dataset.factors[ud_dataset.FORMS].strings[sentence])
-                    for tag, prediction in zip(self._args.tags, predictions):
-                        overrides[tag][sentence] += log_softmax(prediction[b, :sentence_len])
-                    if self._args.parse:
-                        overrides[ud_dataset.HEAD][sentence] += log_softmax(predictions[-2][b, :sentence_len, :sentence_len + 1])
-                        overrides[ud_dataset.DEPREL][sentence] += log_softmax(predictions[-1][b, :sentence_len])
-                    sentence += 1
-
-        # Predict the most likely class and generate CoNLL-U output
-        conllu = io.StringIO()
-        for sentence in range(len(ud_dataset)):
-            sentence_overrides = [None] * ud_dataset.FACTORS
-            for tag in self._args.tags:
-                sentence_overrides[tag] = np.argmax(overrides[tag][sentence], axis=-1)
-            if self._args.parse:
-                padded_heads = np.pad(overrides[ud_dataset.HEAD][sentence], [(1, 0), (0, 0)]).astype(np.float64)
-                if self._args.single_root:
-                    selected_root = 1 + np.argmax(padded_heads[1:, 0])
-                    padded_heads[:, 0] = np.nan
-                    padded_heads[selected_root, 0] = 0
-                chosen_heads, _ = ufal.chu_liu_edmonds.chu_liu_edmonds(padded_heads)
-                sentence_overrides[ud_dataset.HEAD] = chosen_heads[1:]
-                sentence_overrides[ud_dataset.DEPREL] = np.argmax(overrides[ud_dataset.DEPREL][sentence], axis=-1)
-            ud_dataset.write_sentence(conllu, sentence, sentence_overrides)
-
-        conllu = conllu.getvalue()
-        if save_as is not None:
-            os.makedirs(os.path.dirname(save_as), exist_ok=True)
-            with open(save_as, "w", encoding="utf-8") as conllu_file:
-                conllu_file.write(conllu)
+    def predict(self, dataloader: TorchUDDataLoader, save_as: str|None = None, args_override: argparse.Namespace|None = None) -> str:
+        args = self._args if args_override is None else args_override
+        sentences, escalated_sentences = self.sentences, self.escalated_sentences
+        conllu = predict_conllu(self, dataloader, args, save_as=save_as)
+        if args.ensemble_threshold is not None:
+            sentences, escalated_sentences = self.sentences - sentences, self.escalated_sentences - escalated_sentences
+            print("Escalated {} of {} sentences ({:.1f}%) of {} to the whole ensemble".format(
+                escalated_sentences, sentences, 100 * escalated_sentences / max(sentences, 1), dataloader.dataset.ud_dataset.path), file=sys.stderr)
         return conllu
 
-    def evaluate(self, dataloader: TorchUDDataLoader, save_as: str|None = None) -> tuple[str, dict[str, float]]:
-        return LatinPipeModel.evaluate(self, dataloader, save_as=save_as)
+    def evaluate(self, dataloader: TorchUDDataLoader, save_as: str|None = None, args_override: argparse.Namespace|None = None) -> tuple[str, dict[str, float]]:
+        return evaluate_conllu(self, dataloader, save_as=save_as, args_override=args_override)
+
+
+class LatinPipeModelONNX:
+    # Runs the model.onnx exported by LatinPipeModel.export_onnx with onnxruntime on CPU,
+    # with the same decoding as LatinPipeModel.predict.
+    def __init__(self, dataset: UDDataset, args: argparse.Namespace):
+        import onnxruntime
+
+        assert len(args.load) == 1, "The onnx backend does not support ensembles"
+        assert args.quantize == "none" and args.precision == "fp32", "The onnx backend runs the exported fp32 model"
+        self._dataset = dataset
+        self._args = args
+
+        path = os.path.join(os.path.dirname(args.load[0]), "model.onnx")
+        options = onnxruntime.SessionOptions()
+        if args.threads:
+            options.intra_op_num_threads = args.threads
+        self._session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self._input_names = [input.name for input in self._session.get_inputs()]
+        self._output_names = [output.name for output in self._session.get_outputs()]
+        self._tokenizers = [transformers.AutoTokenizer.from_pretrained("{}.tokenizer_{}".format(path, i)) for i in range(len(args.transformers))]
+
+    @property
+    def tokenizers(self) -> list[transformers.PreTrainedTokenizer]:
+        return self._tokenizers
+
+    def predict_on_batch(self, x):
+        return self._session.run(None, {name: np.asarray(inputs) for name, inputs in zip(self._input_names, x)})
+
+    def predict_labels_on_batch(self, x, args: argparse.Namespace|None = None):
+        args = self._args if args is None else args
+        output_names = [self._output_names[output] for output in task_outputs(self._args, args)]
+        if not output_names:
+            return []
+        predictions = self._session.run(output_names, {name: np.asarray(inputs) for name, inputs in zip(self._input_names, x)})
+        return predicted_labels([torch.from_numpy(prediction) for prediction in predictions], args)
+
+    def predict(self, dataloader: TorchUDDataLoader, save_as: str|None = None, args_override: argparse.Namespace|None = None) -> str:
+        return LatinPipeModel.predict(self, dataloader, save_as=save_as, args_override=args_override)
+
+    def evaluate(self, dataloader: TorchUDDataLoader, save_as: str|None = None, args_override: argparse.Namespace|None = None) -> tuple[str, dict[str, float]]:
+        return LatinPipeModel.evaluate(self, dataloader, save_as=save_as, args_override=args_override)
 
 
 def main(params: list[str] | None = None) -> None:
@@ -871,8 +426,23 @@ def main(params: list[str] | None = None) -> None:
     devs = [UDDataset(path, args, treebank_id=i if args.treebank_ids else None, train_dataset=train) for i, path in enumerate(args.dev)]
     tests = [UDDataset(path, args, treebank_id=i if args.treebank_ids else None, train_dataset=train) for i, path in enumerate(args.test)]
 
-    # Create the model
-    model = LatinPipeModel(train, args)
+    # Create the model, with an ensemble keeping one loaded model per --load path
+    def create_model(args: argparse.Namespace):
+        if args.backend == "onnx":
+            assert args.load, "The onnx backend can only be used with --load."
+            return LatinPipeModelONNX(train, args)
+        elif args.backend == "torch":
+            assert args.load, "The torch backend can only be used with --load."
+            return LatinPipeModelTorch(train, args)
+        return LatinPipeModel(train, args)
+    if len(args.load) > 1:
+        model = LatinPipeModelEnsemble([create_model(argparse.Namespace(**{**vars(args), "load": [path]})) for path in args.load], args)
+    else:
+        model = create_model(args)
+    if args.export_onnx:
+        assert len(args.load) == 1, "Only a single loaded model can be exported."
+        model.export_onnx(os.path.join(os.path.dirname(args.load[0]), "model.onnx"))
+        return
 
     # Create the dataloaders
     if not args.load:
@@ -882,8 +452,6 @@ def main(params: list[str] | None = None) -> None:
 
     # Perform prediction if requested
     if args.load:
-        if len(args.load) > 1:
-            model = LatinPipeModelEnsemble(model, args)
         for dataloader in dev_dataloaders:
             model.evaluate(dataloader, save_as=os.path.splitext(
                 os.path.join(args.exp, os.path.basename(dataloader.dataset.ud_dataset.path)) if args.exp else dataloader.dataset.ud_dataset.path
@@ -0,0 +1,805 @@
+# This file is part of LatinPipe EvaLatin 24
+# <https://github.com/ufal/evalatin2024-latinpipe>.
+#
+# Copyright 2024 Institute of Formal and Applied Linguistics, Faculty of
+# Mathematics and Physics, Charles University in Prague, Czech Republic.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# The keras-free parts of LatinPipe: the options, the datasets and data loaders, and the decoding
+# of the network predictions, shared by the Keras model and the PyTorch inference runtime.
+
+import argparse
+import atexit
+import collections
+import concurrent.futures
+import difflib
+import io
+import multiprocessing
+import os
+import pickle
+import re
+from typing import Iterable, Self
+
+import numpy as np
+import torch
+import transformers
+import ufal.chu_liu_edmonds
+
+import latinpipe_evalatin24_eval
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--backend", default="keras", choices=["keras", "onnx", "torch"], type=str, help="Inference backend, onnx runs the exported model.onnx, torch a keras-free mirror.")
+parser.add_argument("--batch_size", default=32, type=int, help="Batch size.")
+parser.add_argument("--batch_tokens", default=None, type=int, help="If given, batch by maximum padded subwords instead of batch size.")
+parser.add_argument("--compile", default=0, type=int, help="Compile the torch backend network with torch.compile.")
+parser.add_argument("--compile_buckets", default=[32, 64, 128, 256], nargs="+", type=int, help="Padded lengths to compile for, longer batches run eagerly.")
+parser.add_argument("--decoding_processes", default=0, type=int, help="Processes running the tree decoding alongside the network, 0 decodes in-process.")
+parser.add_argument("--deprel", default="full", choices=["full", "universal"], type=str, help="Deprel kind.")
+parser.add_argument("--dev", default=[], nargs="+", type=str, help="Dev CoNLL-U files.")
+parser.add_argument("--dropout", default=0.5, type=float, help="Dropout")
+parser.add_argument("--embed_tags", default="", type=str, help="Tags to embed on input.")
+parser.add_argument("--ensemble_confidence", default="margin", choices=["margin", "entropy"], type=str, help="Sentence confidence measure of selective ensembling.")
+parser.add_argument("--ensemble_threshold", default=None, type=float, help="If given, only sentences with lower confidence of the first model are predicted by the whole ensemble.")
+parser.add_argument("--epochs", default=30, type=int, help="Number of epochs.")
+parser.add_argument("--epochs_frozen", default=0, type=int, help="Number of epochs with frozen transformer.")
+parser.add_argument("--export_onnx", default=0, type=int, help="Export the loaded model to model.onnx.")
+parser.add_argument("--exp", default=None, type=str, help="Experiment name.")
+parser.add_argument("--label_smoothing", default=0.03, type=float, help="Label smoothing.")
+parser.add_argument("--length_sorted_batches", default=1, type=int, help="Batch inference sentences of similar subword lengths.")
+parser.add_argument("--learning_rate", default=2e-5, type=float, help="Learning rate.")
+parser.add_argument("--learning_rate_decay", default="cos", choices=["none", "cos"], type=str, help="Learning rate decay.")
+parser.add_argument("--learning_rate_warmup", default=2_000, type=int, help="Number of warmup steps.")
+parser.add_argument("--load", default=[], type=str, nargs="*", help="Path to load models from.")
+parser.add_argument("--max_train_sentence_len", default=150, type=int, help="Max sentence subwords in training.")
+parser.add_argument("--optimizer", default="adam", choices=["adam", "adafactor"], type=str, help="Optimizer.")
+parser.add_argument("--parse", default=1, type=int, help="Parse.")
+parser.add_argument("--parse_attention_dim", default=512, type=int, help="Parse attention dimension.")
+parser.add_argument("--precision", default="fp32", choices=["fp32", "bf16"], type=str, help="Inference precision, bf16 runs the network under CPU autocast.")
+parser.add_argument("--quantize", default="none", choices=["none", "int8"], type=str, help="Quantize the loaded model for inference.")
+parser.add_argument("--rnn_dim", default=512, type=int, help="RNN layers size.")
+parser.add_argument("--rnn_layers", default=2, type=int, help="RNN layers.")
+parser.add_argument("--rnn_type", default="LSTMTorch", choices=["LSTM", "GRU", "LSTMTorch", "GRUTorch"], help="RNN type.")
+parser.add_argument("--save_checkpoint", default=False, action="store_true", help="Save checkpoint.")
+parser.add_argument("--seed", default=42, type=int, help="Initial random seed.")
+parser.add_argument("--steps_per_epoch", default=1_000, type=int, help="Steps per epoch.")
+parser.add_argument("--single_root", default=1, type=int, help="Single root allowed only.")
+parser.add_argument("--subword_combination", default="first", choices=["first", "last", "mean", "sum", "concat"], type=str, help="Subword combination.")
+parser.add_argument("--tags", default="UPOS,LEMMAS,FEATS", type=str, help="Tags to predict.")
+parser.add_argument("--task_hidden_layer", default=2_048, type=int, help="Task hidden layer size.")
+parser.add_argument("--test", default=[], nargs="+", type=str, help="Test CoNLL-U files.")
+parser.add_argument("--train", default=[], nargs="+", type=str, help="Train CoNLL-U files.")
+parser.add_argument("--train_sampling_exponent", default=0.5, type=float, help="Train sampling exponent.")
+parser.add_argument("--transformers", nargs="+", type=str, help="Transformers models to use.")
+parser.add_argument("--treebank_ids", default=False, action="store_true", help="Include treebank IDs on input.")
+parser.add_argument("--threads", default=4, type=int, help="Maximum number of threads to use.")
+parser.add_argument("--verbose", default=2, type=int, help="Verbosity")
+parser.add_argument("--wandb", default=False, action="store_true", help="Log in WandB.")
+parser.add_argument("--word_masking", default=None, type=float, help="Word masking")
+
+os.environ["PYTORCH_MPS_HIGH_WATERMARK_RATIO"] = "0.0"
+
+class UDDataset:
+    FORMS, LEMMAS, UPOS, XPOS, FEATS, HEAD, DEPREL, DEPS, MISC, FACTORS = range(10)
+    FACTORS_MAP = {"FORMS": FORMS, "LEMMAS": LEMMAS, "UPOS": UPOS, "XPOS": XPOS, "FEATS": FEATS,
+                   "HEAD": HEAD, "DEPREL": DEPREL, "DEPS": DEPS, "MISC": MISC}
+    RE_EXTRAS = re.compile(r"^#|^\d+-|^\d+\.")
+
+    class Factor:
+        def __init__(self, train_factor: Self = None):
+            self.words_map = train_factor.words_map if train_factor else {"<unk>": 0}
+            self.words = train_factor.words if train_factor else ["<unk>"]
+            self.word_ids = []
+            self.strings = []
+
+    def __init__(self, path: str, args: argparse.Namespace, treebank_id: int|None = None, train_dataset: Self = None, text: str|None = None,
+                 sentences: list[list[list[str]]]|None = None):
+        self.path = path
+
+        # Create factors and other variables
+        self.factors = []
+        for f in range(self.FACTORS):
+            self.factors.append(self.Factor(train_dataset.factors[f] if train_dataset is not None else None))
+        self._extras = []
+
+        lemma_transforms = collections.Counter()
+
+        # Load the sentences given as lists of the word columns, or the CoNLL-U file
+        if sentences is not None:
+            for sentence in sentences:
+                # An empty sentence would be silently skipped, shifting the predictions of the following ones
+                assert len(sentence), "Every sentence must contain at least one word"
+                for i, columns in enumerate(sentence):
+                    self._add_word(columns, i == 0, args, train_dataset, lemma_transforms)
+                self._finish_sentence()
+            # Such sentences come without the gold data, so they cannot be evaluated
+            self.conllu_for_eval = None
+        else:
+            with open(path, "r", encoding="utf-8") if text is None else io.StringIO(text) as file:
+                in_sentence = False
+                for line in file:
+                    line = line.rstrip("\r\n")
+
+                    if line:
+                        if self.RE_EXTRAS.match(line):
+                            if in_sentence:
+                                while len(self._extras) < len(self.factors[0].strings): self._extras.append([])
+                                while len(self._extras[-1]) <= len(self.factors[0].strings[-1]):
+                                    self._extras[-1].append("")
+                            else:
+                                while len(self._extras) <= len(self.factors[0].strings): self._extras.append([])
+                                if not len(self._extras[-1]): self._extras[-1].append("")
+                            self._extras[-1][-1] += ("\n" if self._extras[-1][-1] else "") + line
+                            continue
+
+                        self._add_word(line.split("\t")[1:], not in_sentence, args, train_dataset, lemma_transforms)
+                        in_sentence = True
+                    else:
+                        in_sentence = False
+                        self._finish_sentence()
+
+                # Also load the file for evaluation if it is not a training dataset
+                if train_dataset is not None:
+                    file.seek(0, io.SEEK_SET)
+                    self.conllu_for_eval = latinpipe_evalatin24_eval.load_conllu(file)
+
+        # Construct lemma rules
+        self.finalize_lemma_rules(lemma_transforms, create_rules=train_dataset is None)
+
+        # The dataset consists of a single treebank
+        self.treebank_ranges = [(0, len(self))]
+        self.treebank_ids = [treebank_id]
+
+        # Create an empty tokenize cache
+        self._tokenizer_cache = {}
+
+    def __len__(self):
+        return len(self.factors[0].strings)
+
+    def _add_word(self, columns: list[str], new_sentence: bool, args: argparse.Namespace, train_dataset: Self|None,
+                  lemma_transforms: collections.Counter) -> None:
+        for f in range(self.FACTORS):
+            factor = self.factors[f]
+            if new_sentence:
+                factor.word_ids.append([])
+                factor.strings.append([])
+
+            word = columns[f]
+            factor.strings[-1].append(word)
+
+            # Add word to word_ids
+            if f == self.FORMS:
+                # For formw, we do not remap strings into IDs because the tokenizer will create the subwords IDs for us.
+                factor.word_ids[-1].append(0)
+            elif f == self.HEAD:
+                factor.word_ids[-1].append(int(word) if word != "_" else -1)
+            elif f == self.LEMMAS:
+                factor.word_ids[-1].append(0)
+                lemma_transforms[(columns[self.FORMS], word)] += 1
+            else:
+                if f == self.DEPREL and args.deprel == "universal":
+                    word = word.split(":")[0]
+                if word not in factor.words_map:
+                    if train_dataset is not None:
+                        word = "<unk>"
+                    else:
+                        factor.words_map[word] = len(factor.words)
+                        factor.words.append(word)
+                factor.word_ids[-1].append(factor.words_map[word])
+
+    def _finish_sentence(self) -> None:
+        for factor in self.factors:
+            if len(factor.word_ids): factor.word_ids[-1] = np.array(factor.word_ids[-1], np.int32)
+
+    def save_mappings(self, path: str) -> None:
+        mappings = UDDataset.__new__(UDDataset)
+        mappings.factors = []
+        for factor in self.factors:
+            mappings.factors.append(UDDataset.Factor.__new__(UDDataset.Factor))
+            mappings.factors[-1].words = factor.words
+        with open(path, "wb") as mappings_file:
+            pickle.dump(mappings, mappings_file, protocol=4)
+
+    @staticmethod
+    def from_mappings(path: str) -> Self:
+        with open(path, "rb") as mappings_file:
+            mappings = pickle.load(mappings_file)
+        for factor in mappings.factors:
+            factor.words_map = {word: i for i, word in enumerate(factor.words)}
+        return mappings
+
+    @staticmethod
+    def create_lemma_rule(form: str, lemma: str) -> str:
+        diff = difflib.SequenceMatcher(None, form.lower(), lemma.lower(), False)
+        rule, in_prefix = [], True
+        for tag, i1, i2, j1, j2 in diff.get_opcodes():
+            if i2 > len(form) // 3 and in_prefix:
+                in_prefix = False
+                if tag == "equal":
+                    mode, jd = "L" if lemma[j2 - 1].islower() else "U", j2 - 1
+                    while jd > j1 and lemma[jd - 1].islower() == lemma[j2 - 1].islower(): jd -= 1
+                    rule.extend(["l" if lemma[j].islower() else "u" for j in range(j1, jd)])
+                    rule.extend(mode * (len(form) - i2 + 1))
+                if tag in ["replace", "delete"]:
+                    rule.extend("D" * (len(form) - i2 + 1))
+                if tag in ["replace", "insert"]:
+                    rule.extend("i" + lemma[j] for j in range(j1, j2))
+            else:
+                if tag == "equal":
+                    rule.extend(["l" if lemma[j].islower() else "u" for j in range(j1, j2)])
+                if tag in ["replace", "delete"]:
+                    rule.extend("d" * (i2 - i1))
+                if tag in ["replace", "insert"]:
+                    rule.extend("i" + lemma[j] for j in range(j1, j2))
+        return "".join(rule)
+
+    @staticmethod
+    def apply_lemma_rule(rule: str, form: str) -> str:
+        def error():
+            # print("Error: cannot decode lemma rule '{}' with form '{}', copying input.".format(rule, form))
+            return form
+
+        if rule == "<unk>":
+            return form
+
+        lemma, r, i = [], 0, 0
+        while r < len(rule):
+            if rule[r] == "i":
+                if r + 1 == len(rule):
+                    return error()
+                r += 1
+                lemma.append(rule[r])
+            elif rule[r] == "d":
+                i += 1
+            elif rule[r] in ("l", "u"):
+                if i == len(form):
+                    return error()
+                lemma.append(form[i].lower() if rule[r] == "l" else form[i].upper())
+                i += 1
+            elif rule[r] in ("L", "U", "D"):
+                i2 = len(form)
+                while r + 1 < len(rule) and rule[r + 1] == rule[r]:
+                    r += 1
+                    i2 -= 1
+                if i2 < i:
+                    return error()
+                if rule[r] == "L":
+                    lemma.extend(form[i:i2].lower())
+                if rule[r] == "U":
+                    lemma.extend(form[i:i2].upper())
+                i = i2
+            else:
+                return error()
+            r += 1
+        if i != len(form) or not lemma:
+            return error()
+        return "".join(lemma)
+
+    def finalize_lemma_rules(self, lemma_transforms: collections.Counter, create_rules: bool) -> None:
+        forms, lemmas = self.factors[self.FORMS], self.factors[self.LEMMAS]
+
+        # Generate all rules
+        rules_merged, rules_all = collections.Counter(), {}
+        for form, lemma in lemma_transforms:
+            rule = self.create_lemma_rule(form, lemma)
+            rules_all[(form, lemma)] = rule
+            if create_rules:
+                rules_merged[rule] += 1
+
+        # Keep the rules that are used more than once
+        if create_rules:
+            for rule, count in rules_merged.items():
+                if count > 1:
+                    lemmas.words_map[rule] = len(lemmas.words)
+                    lemmas.words.append(rule)
+
+        # Store the rules in the dataset
+        for i in range(len(forms.strings)):
+            for j in range(len(forms.strings[i])):
+                rule = rules_all.get((forms.strings[i][j], lemmas.strings[i][j]))
+                lemmas.word_ids[i][j] = lemmas.words_map.get(rule, 0)
+
+    def tokenize(self, tokenizer: transformers.PreTrainedTokenizer) -> tuple[list[np.ndarray], list[np.ndarray]]:
+        if tokenizer not in self._tokenizer_cache:
+            assert tokenizer.cls_token_id is not None, "The tokenizer must have a CLS token"
+
+            tokenized = tokenizer(self.factors[0].strings, add_special_tokens=True, is_split_into_words=True)
+
+            tokens, word_indices = [], []
+            for i, sentence in enumerate(tokenized.input_ids):
+                offset = 0
+                if not len(sentence) or sentence[0] != tokenizer.cls_token_id:
+                    # Handle tokenizers that do not add CLS tokens, which we need for prediction
+                    # of the root nodes during parsing. For such tokenizers, we added the CLS token
+                    # manually already, but the build_inputs_with_special_tokens() might not have added it.
+                    sentence = [tokenizer.cls_token_id] + sentence
+                    offset = 1
+
+                treebank_id = None
+                for id_, (start, end) in zip(self.treebank_ids, self.treebank_ranges):
+                    if start <= i < end:
+                        treebank_id = id_
+                if treebank_id is not None:
+                    sentence.insert(1, tokenizer.additional_special_tokens_ids[treebank_id])
+                    offset += 1
+
+                tokens.append(np.array(sentence, dtype=np.int32))
+                word_indices.append([(0, 0)])
+                for j in range(len(self.factors[0].strings[i])):
+                    span = tokenized.word_to_tokens(i, j)
+                    if (span == None):
+                        print("-x-x-x-", i, j)
+                    try:
+                        word_indices[-1].append((offset + span.start, offset + span.end - 1))
+                    except:
+                        #abracadabra = 0
+                        print(treebank_id)
+                        input("??")
+                word_indices[-1] = np.array(word_indices[-1], dtype=np.int32)
+
+
+            self._tokenizer_cache[tokenizer] = (tokens, word_indices)
+
+        return self._tokenizer_cache[tokenizer]
+
+    def write_sentence(self, output: io.TextIOBase, index: int, overrides: list = None) -> None:
+        assert index < len(self.factors[0].strings), "Sentence index out of range"
+
+        for i in range(len(self.factors[0].strings[index]) + 1):
+            # Start by writing extras
+            if index < len(self._extras) and i < len(self._extras[index]) and self._extras[index][i]:
+                print(self._extras[index][i], file=output)
+            if i == len(self.factors[0].strings[index]): break
+
+            fields = []
+            fields.append(str(i + 1))
+            for f in range(self.FACTORS):
+                factor = self.factors[f]
+                field = factor.strings[index][i]
+
+                # Overrides
+                if overrides is not None and f < len(overrides) and overrides[f] is not None:
+                    override = overrides[f][i]
+                    if f == self.HEAD:
+                        field = str(override) if override >= 0 else "_"
+                    else:
+                        field = factor.words[override]
+                        if f == self.LEMMAS:
+                            field = self.apply_lemma_rule(field, self.factors[self.FORMS].strings[index][i])
+                fields.append(field)
+
+            print("\t".join(fields), file=output)
+        print(file=output)
+
+
+class UDDatasetMerged(UDDataset):
+    def __init__(self, datasets: list[UDDataset]):
+        # Create factors and other variables
+        self.factors = []
+        for f in range(self.FACTORS):
+            self.factors.append(self.Factor(None))
+
+        lemma_transforms = collections.Counter()
+
+        self.treebank_ranges, self.treebank_ids = [], []
+        for dataset in datasets:
+            assert len(dataset.treebank_ranges) == len(dataset.treebank_ids) == 1
+            self.treebank_ranges.append((len(self), len(self) + len(dataset)))
+            self.treebank_ids.append(dataset.treebank_ids[0])
+            for s in range(len(dataset)):
+                for f in range(self.FACTORS):
+                    factor = self.factors[f]
+                    factor.strings.append(dataset.factors[f].strings[s])
+                    factor.word_ids.append([])
+                    for i, word in enumerate(dataset.factors[f].strings[s]):
+                        if f == self.FORMS:
+                            # We do not remap strings into IDs because the tokenizer will create the subwords IDs for us.
+                            factor.word_ids[-1].append(0)
+                        if f == self.HEAD:
+                            factor.word_ids[-1].append(word)
+                        elif f == self.LEMMAS:
+                            factor.word_ids[-1].append(0)
+                            lemma_transforms[(dataset.factors[self.FORMS].strings[s][i], word)] += 1
+                        else:
+                            if word not in factor.words_map:
+                                factor.words_map[word] = len(factor.words)
+                                factor.words.append(word)
+                            factor.word_ids[-1].append(factor.words_map[word])
+                    self.factors[f].word_ids[-1] = np.array(self.factors[f].word_ids[-1], np.int32)
+
+        # Construct lemma rules
+        self.finalize_lemma_rules(lemma_transforms, create_rules=True)
+
+        # Create an empty tokenize cache
+        self._tokenizer_cache = {}
+
+
+class TorchUDDataset(torch.utils.data.Dataset):
+    def __init__(self, ud_dataset: UDDataset, tokenizers: list[transformers.PreTrainedTokenizer], args: argparse.Namespace, training: bool):
+        self.ud_dataset = ud_dataset
+        self.training = training
+        self._outputs_to_input = [args.tags.index(tag) for tag in args.embed_tags]
+
+        self._inputs = [ud_dataset.tokenize(tokenizer) for tokenizer in tokenizers]
+        self._outputs = [ud_dataset.factors[tag].word_ids for tag in args.tags]
+        if args.parse:
+            self._outputs.append(ud_dataset.factors[ud_dataset.HEAD].word_ids)
+            self._outputs.append(ud_dataset.factors[ud_dataset.DEPREL].word_ids)
+
+        # Trim the sentences if needed
+        if training and args.max_train_sentence_len:
+            trimmed_sentences = 0
+            for index in range(len(self)):  # Over sentences
+                max_words, need_trimming = None, False
+                for tokens, word_indices in self._inputs:  # Over transformers
+                    if max_words is None:
+                        max_words = len(word_indices[index])
+                    while word_indices[index][max_words - 1, 1] >= args.max_train_sentence_len:
+                        max_words -= 1
+                        need_trimming = True
+                assert max_words >= 2, "Sentence too short after trimming"
+
+                if need_trimming:
+                    for tokens, word_indices in self._inputs:  # Over transformers
+                        tokens[index] = tokens[index][:word_indices[index][max_words - 1, 1] + 1]
+                        word_indices[index] = word_indices[index][:max_words]
+
+                    for output in self._outputs:
+                        output[index] = output[index][:max_words - 1]  # No CLS tokens in outputs
+                    if args.parse:
+                        self._outputs[-2][index] = np.array([head if head < max_words else -1 for head in self._outputs[-2][index]], np.int32)
+
+                    trimmed_sentences += 1
+            if trimmed_sentences:
+                print("Trimmed {} out of {} sentences".format(trimmed_sentences, len(self)))
+
+    def __len__(self):
+        return len(self.ud_dataset)
+
+    def subword_lengths(self) -> np.ndarray:
+        return np.array([max(len(tokens[index]) for tokens, _ in self._inputs) for index in range(len(self))], np.int32)
+
+    def __getitem__(self, index: int):
+        inputs = []
+        for tokens, word_indices in self._inputs:
+            inputs.append(torch.from_numpy(tokens[index]))
+            inputs.append(torch.from_numpy(word_indices[index]))
+        for i in self._outputs_to_input:
+            inputs.append(torch.from_numpy(self._outputs[i][index]))
+
+        outputs = []
+        for output in self._outputs:
+            outputs.append(torch.from_numpy(output[index]))
+
+        return inputs, outputs
+
+
+class TorchUDDataLoader(torch.utils.data.DataLoader):
+    class MergedDatasetSampler(torch.utils.data.Sampler):
+        def __init__(self, ud_dataset: UDDataset, args: argparse.Namespace):
+            self._treebank_ranges = ud_dataset.treebank_ranges
+            self._sentences_per_epoch = args.steps_per_epoch * args.batch_size
+            self._generator = torch.Generator().manual_seed(args.seed)
+
+            treebank_weights = np.array([r[1] - r[0] for r in self._treebank_ranges], np.float32)
+            treebank_weights = treebank_weights ** args.train_sampling_exponent
+            treebank_weights /= np.sum(treebank_weights)
+            self._treebank_sizes = np.array(treebank_weights * self._sentences_per_epoch, np.int32)
+            self._treebank_sizes[:self._sentences_per_epoch - np.sum(self._treebank_sizes)] += 1
+            self._treebank_indices = [[] for _ in self._treebank_ranges]
+
+        def __len__(self):
+            return self._sentences_per_epoch
+
+        def __iter__(self):
+            indices = []
+            for i in range(len(self._treebank_ranges)):
+                required = self._treebank_sizes[i]
+                while required:
+                    if not len(self._treebank_indices[i]):
+                        self._treebank_indices[i] = self._treebank_ranges[i][0] + torch.randperm(
+                            self._treebank_ranges[i][1] - self._treebank_ranges[i][0], generator=self._generator)
+                    indices.append(self._treebank_indices[i][:required])
+                    required -= min(len(self._treebank_indices[i]), required)
+            indices = torch.concatenate(indices, axis=0)
+            return iter(indices[torch.randperm(len(indices), generator=self._generator)])
+
+    class TokenBudgetBatchSampler(torch.utils.data.Sampler):
+        # Batches with at most `args.batch_tokens` padded subwords, i.e., the longest sentence
+        # length times the number of sentences; a longer sentence forms a batch on its own.
+        def __init__(self, sampler: Iterable[int], lengths: np.ndarray, args: argparse.Namespace):
+            self._sampler = sampler
+            self._lengths = lengths
+            self._batch_tokens = args.batch_tokens
+            self._next_batches = None
+
+        def _batches(self):
+            batches, batch, batch_length = [], [], 0
+            for index in self._sampler:
+                index = int(index)
+                length = max(batch_length, self._lengths[index])
+                if batch and length * (len(batch) + 1) > self._batch_tokens:
+                    batches.append(batch)
+                    batch, length = [], self._lengths[index]
+                batch.append(index)
+                batch_length = length
+            if batch:
+                batches.append(batch)
+            return batches
+
+        def __len__(self):
+            # The number of batches depends on the order of the sentences, so generate the
+            # batches of the next epoch now and return them in the following __iter__.
+            if self._next_batches is None:
+                self._next_batches = self._batches()
+            return len(self._next_batches)
+
+        def __iter__(self):
+            batches = self._next_batches if self._next_batches is not None else self._batches()
+            self._next_batches = None
+            return iter(batches)
+
+    def _collate_fn(self, batch):
+        inputs, outputs = zip(*batch)
+
+        batch_inputs = []
+        for sequences in zip(*inputs):
+            batch_inputs.append(torch.nn.utils.rnn.pad_sequence(sequences, batch_first=True, padding_value=-1))
+
+        batch_outputs = []
+        for output in zip(*outputs):
+            batch_outputs.append(torch.nn.utils.rnn.pad_sequence(output, batch_first=True, padding_value=-1))
+
+        batch_weights = [batch_output != -1 for batch_output in batch_outputs]
+
+        return tuple(batch_inputs), tuple(batch_outputs), tuple(batch_weights)
+
+    def __init__(self, dataset: TorchUDDataset, args: argparse.Namespace, **kwargs):
+        sampler = None
+        if dataset.training:
+            if len(dataset.ud_dataset.treebank_ranges) == 1:
+                sampler = torch.utils.data.RandomSampler(dataset, generator=torch.Generator().manual_seed(args.seed))
+            else:
+                assert args.steps_per_epoch is not None, "Steps per epoch must be specified when training on multiple treebanks"
+                sampler = self.MergedDatasetSampler(dataset.ud_dataset, args)
+        elif args.length_sorted_batches:
+            # Batch sentences of similar subword lengths to minimize padding
+            sampler = np.argsort(dataset.subword_lengths(), kind="stable").tolist()
+        if args.batch_tokens:
+            batch_sampler = self.TokenBudgetBatchSampler(
+                sampler if sampler is not None else range(len(dataset)), dataset.subword_lengths(), args)
+            super().__init__(dataset, batch_sampler=batch_sampler, collate_fn=self._collate_fn, **kwargs)
+        else:
+            super().__init__(dataset, batch_size=args.batch_size, sampler=sampler, collate_fn=self._collate_fn, **kwargs)
+
+    def sentence_batches(self):
+        # The sentence indices of the batches, in the order the dataloader yields them;
+        # the inference samplers are deterministic, so this matches the dataloader iteration.
+        return iter(self.batch_sampler)
+
+
+def create_transformer(name: str, dataset: UDDataset, args: argparse.Namespace) -> tuple[transformers.PreTrainedTokenizer, transformers.PreTrainedModel]:
+    # The tokenizer and the transformer of the given name, with the additional tokens LatinPipe needs;
+    # with --load, the transformer is only configured, its weights come from the trained model.
+    tokenizer = transformers.AutoTokenizer.from_pretrained(name, add_prefix_space=True)
+
+    transformer, transformer_opts = transformers.AutoModel, {}
+    if "mt5" in name.lower():
+        transformer = transformers.MT5EncoderModel
+    if name.endswith(("LaTa", "PhilTa")):
+        transformer = transformers.T5EncoderModel
+    if name.endswith(("LaBerta", "PhilBerta")):
+        transformer_opts["add_pooling_layer"] = False
+
+    if args.load:
+        transformer = transformer.from_config(transformers.AutoConfig.from_pretrained(name), **transformer_opts)
+    else:
+        transformer = transformer.from_pretrained(name, **transformer_opts)
+
+    # Create additional tokens
+    additional_tokens = {}
+    if args.treebank_ids:
+        additional_tokens["additional_special_tokens"] = ["[TREEBANK_ID_{}]".format(i) for i in range(len(dataset.treebank_ids))]
+    if tokenizer.cls_token_id is None:  # Generate CLS token if not present (for representing sentence root in parsing).
+        additional_tokens["cls_token"] = "[CLS]"
+    if additional_tokens:
+        tokenizer.add_special_tokens(additional_tokens)
+        transformer.resize_token_embeddings(len(tokenizer))
+    if args.treebank_ids:
+        assert len(tokenizer.additional_special_tokens) == len(dataset.treebank_ids)
+
+    return tokenizer, transformer
+
+
+def pool_subwords(hidden_states: torch.Tensor, word_indices: torch.Tensor, subword_combination: str) -> torch.Tensor:
+    # Combine the transformer outputs of the subwords of every word, delimited by the indices of its first
+    # and last subword (-1 for padding), so that all combinations need just a single transformer run.
+    first_indices = torch.clamp(word_indices[..., 0:1], min=0).long()
+    last_indices = torch.clamp(word_indices[..., 1:2], min=0).long()
+    if subword_combination == "first":
+        return torch.take_along_dim(hidden_states, first_indices, dim=1)
+    elif subword_combination == "last":
+        return torch.take_along_dim(hidden_states, last_indices, dim=1)
+    elif subword_combination == "mean":
+        # The sums of the subword spans are differences of the prefix sums of the outputs
+        prefix_sums = torch.nn.functional.pad(torch.cumsum(hidden_states, dim=1), (0, 0, 1, 0))
+        span_sums = torch.take_along_dim(prefix_sums, last_indices + 1, dim=1) - torch.take_along_dim(prefix_sums, first_indices, dim=1)
+        return span_sums / (last_indices - first_indices + 1).to(span_sums.dtype)
+    elif subword_combination == "sum":
+        return torch.take_along_dim(hidden_states, first_indices, dim=1) + torch.take_along_dim(hidden_states, last_indices, dim=1)
+    elif subword_combination == "concat":
+        return torch.cat([torch.take_along_dim(hidden_states, first_indices, dim=1), torch.take_along_dim(hidden_states, last_indices, dim=1)], dim=-1)
+    else:
+        raise ValueError("Unknown subword combination '{}'".format(subword_combination))
+
+
+def task_outputs(args: argparse.Namespace, task_args: argparse.Namespace) -> list[int]:
+    # The indices of the outputs of a network trained with `args` needed by the tags and the parsing of
+    # `task_args`, in their order, so that only these outputs and the layers they depend on are computed.
+    for tag in task_args.tags:
+        if tag not in args.tags:
+            raise ValueError("The model does not predict the tag {}".format(
+                {factor: name for name, factor in UDDataset.FACTORS_MAP.items()}.get(tag, tag)))
+    if task_args.parse and not args.parse:
+        raise ValueError("The model does not parse")
+    outputs = [args.tags.index(tag) for tag in task_args.tags]
+    if task_args.parse:
+        outputs.extend([len(args.tags), len(args.tags) + 1])
+    return outputs
+
+
+def sentence_confidences(log_probabilities: list[torch.Tensor], lengths: torch.Tensor, args: argparse.Namespace) -> torch.Tensor:
+    # The confidence in [0, 1] of every sentence of a batch, the lowest confidence over its words and
+    # the tag, head and deprel distributions of `args`: with --ensemble_confidence margin, the margin between
+    # the probabilities of the two most probable labels, with entropy, one minus the normalized entropy.
+    words = torch.arange(log_probabilities[0].shape[1])[None, :] < lengths[:, None]
+    confidences = torch.ones(len(lengths), dtype=log_probabilities[0].dtype)
+    for i, log_probability in enumerate(log_probabilities):
+        if args.ensemble_confidence == "margin":
+            if log_probability.shape[-1] < 2:
+                continue
+            top_probabilities = torch.topk(log_probability, 2, dim=-1).values.exp()
+            confidence = top_probabilities[..., 0] - top_probabilities[..., 1]
+        elif args.ensemble_confidence == "entropy":
+            entropy = -torch.sum(log_probability.exp() * log_probability, dim=-1)
+            # The head distributions have a label for every word of the sentence and the root
+            labels = lengths[:, None] + 1 if args.parse and i == len(log_probabilities) - 2 else log_probability.shape[-1]
+            confidence = 1 - entropy / torch.log(torch.as_tensor(labels, dtype=entropy.dtype)).clamp(min=1e-12)
+        else:
+            raise ValueError("Unknown confidence measure '{}'".format(args.ensemble_confidence))
+        confidences = torch.minimum(confidences, torch.where(words, confidence, 1).amin(dim=-1))
+    return confidences
+
+
+def predicted_labels(predictions: list[torch.Tensor], args: argparse.Namespace) -> list[np.ndarray]:
+    # The argmax of the tagging and dependency relation scores and the log-softmax of the head scores
+    # are computed batched in torch, so that only the label indices and the head log-probabilities
+    # needed by the tree decoding leave it. The masked heads have scores -1e9, so they get no mass.
+    # The log-softmax is computed in float64 as the baseline did in numpy, so that confident heads do
+    # not round to ties that the greedy and MST decoding would break differently.
+    labels = [torch.argmax(prediction, dim=-1).cpu().numpy() for prediction in predictions[:len(args.tags)]]
+    if args.parse:
+        heads, deprels = predictions[-2:]
+        labels.append(torch.log_softmax(heads.double(), dim=-1).cpu().numpy())
+        labels.append(torch.argmax(deprels, dim=-1).cpu().numpy())
+    return labels
+
+
+def greedy_tree(scores: np.ndarray) -> list[int]|None:
+    # Return the highest-scoring head of every word if these heads already form a tree, which is then
+    # also the maximum spanning tree; otherwise return None. The NaN scores are disallowed edges.
+    scores = np.where(np.isnan(scores), -np.inf, scores)
+    np.fill_diagonal(scores, -np.inf)
+    heads = [-1] + np.argmax(scores[1:], axis=-1).tolist()
+
+    reaches_root = [True] + [False] * (len(heads) - 1)
+    for word in range(1, len(heads)):
+        path, on_path = [], set()
+        while not reaches_root[word]:
+            if word in on_path:
+                return None
+            path.append(word)
+            on_path.add(word)
+            word = heads[word]
+        for word in path:
+            reaches_root[word] = True
+    return heads
+
+
+_decoding_pool: tuple[int, int, concurrent.futures.ProcessPoolExecutor]|None = None
+
+
+def decoding_pool(processes: int) -> concurrent.futures.ProcessPoolExecutor:
+    # The Chu-Liu-Edmonds decoding holds the GIL, so it runs in a pool of processes, kept until
+    # shutdown_decoding_pool, at the latest at exit; forkserver avoids forking the multi-threaded
+    # torch process. A forked child, e.g., a server worker, starts a pool of its own.
+    global _decoding_pool
+    if _decoding_pool is None or _decoding_pool[:2] != (os.getpid(), processes):
+        shutdown_decoding_pool()
+        _decoding_pool = (os.getpid(), processes, concurrent.futures.ProcessPoolExecutor(
+            processes, mp_context=multiprocessing.get_context("forkserver")))
+    return _decoding_pool[2]
+
+
+def shutdown_decoding_pool() -> None:
+    # Shut down the decoding pool of this process, if any, leaving the pool of a parent process alone.
+    global _decoding_pool
+    if _decoding_pool is not None and _decoding_pool[0] == os.getpid():
+        _decoding_pool[2].shutdown()
+    _decoding_pool = None
+
+
+atexit.register(shutdown_decoding_pool)
+
+
+def predict_overrides(model, dataloader: TorchUDDataLoader, args: argparse.Namespace) -> list[list]:
+    # Predict the sentences of the dataloader by `model.predict_labels_on_batch`, returning for every sentence
+    # the overrides of `UDDataset.write_sentence`, i.e., the predicted ids of every factor or None when the factor
+    # was not predicted; the model computes only the tags and parsing requested by `args`.
+    ud_dataset = dataloader.dataset.ud_dataset
+    sentences_overrides = [None] * len(ud_dataset)
+    pool = decoding_pool(args.decoding_processes) if args.parse and args.decoding_processes else None
+
+    for batch_sentences, (batch_inputs, _, _) in zip(dataloader.sentence_batches(), dataloader):
+        predictions = model.predict_labels_on_batch(batch_inputs, args)
+        for b, sentence in enumerate(batch_sentences):
+            sentence_len = len(ud_dataset.factors[ud_dataset.FORMS].strings[sentence])
+            overrides = [None] * ud_dataset.FACTORS
+            for tag, prediction in zip(args.tags, predictions):
+                overrides[tag] = prediction[b, :sentence_len]
+            if args.parse:
+                heads, deprels = predictions[-2:]
+                padded_heads = np.zeros([sentence_len + 1, sentence_len + 1], dtype=np.float64)
+                padded_heads[1:] = heads[b, :sentence_len, :sentence_len + 1]
+                if args.single_root:
+                    selected_root = 1 + np.argmax(padded_heads[1:, 0])
+                    padded_heads[:, 0] = np.nan
+                    padded_heads[selected_root, 0] = 0
+                # Only the sentences whose greedy heads do not form a tree need the MST decoding,
+                # which runs in the decoding pool, if any, overlapping the following batches.
+                chosen_heads = greedy_tree(padded_heads)
+                if chosen_heads is None:
+                    if pool is not None:
+                        chosen_heads = pool.submit(ufal.chu_liu_edmonds.chu_liu_edmonds, padded_heads)
+                    else:
+                        chosen_heads, _ = ufal.chu_liu_edmonds.chu_liu_edmonds(padded_heads)
+                overrides[ud_dataset.HEAD] = chosen_heads
+                overrides[ud_dataset.DEPREL] = deprels[b, :sentence_len]
+            sentences_overrides[sentence] = overrides
+
+    # Wait for the MST decoding of the remaining sentences
+    if args.parse:
+        for overrides in sentences_overrides:
+            if isinstance(overrides[ud_dataset.HEAD], concurrent.futures.Future):
+                overrides[ud_dataset.HEAD], _ = overrides[ud_dataset.HEAD].result()
+            overrides[ud_dataset.HEAD] = overrides[ud_dataset.HEAD][1:]
+    return sentences_overrides
+
+
+def predict_conllu(model, dataloader: TorchUDDataLoader, args: argparse.Namespace, save_as: str|None = None) -> str:
+    # Predict the sentences of the dataloader by `predict_overrides` and write them as CoNLL-U.
+    ud_dataset = dataloader.dataset.ud_dataset
+    conllu = io.StringIO()
+    for sentence, overrides in enumerate(predict_overrides(model, dataloader, args)):
+        ud_dataset.write_sentence(conllu, sentence, overrides)
+
+    conllu = conllu.getvalue()
+    if save_as is not None:
+        os.makedirs(os.path.dirname(save_as), exist_ok=True)
+        with open(save_as, "w", encoding="utf-8") as conllu_file:
+            conllu_file.write(conllu)
+    return conllu
+
+
+def evaluate_conllu(model, dataloader: TorchUDDataLoader, save_as: str|None = None, args_override: argparse.Namespace|None = None) -> tuple[str, dict[str, float]]:
+    # Predict the sentences of the dataloader by `model.predict` and evaluate them against the gold data.
+    conllu = model.predict(dataloader, save_as=save_as, args_override=args_override)
+    evaluation = latinpipe_evalatin24_eval.evaluate(dataloader.dataset.ud_dataset.conllu_for_eval, latinpipe_evalatin24_eval.load_conllu(io.StringIO(conllu)))
+    if save_as is not None:
+        os.makedirs(os.path.dirname(save_as), exist_ok=True)
+        with open(save_as + ".eval", "w", encoding="utf-8") as eval_file:
+            for metric, score in evaluation.items():
+                print("{}: {:.2f}%".format(metric, 100 * score.f1), file=eval_file)
+    return conllu, evaluation
@@ -11,12 +11,17 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import argparse
+import codecs
+import concurrent.futures
 import contextlib
 import email.parser
 import http.server
 import itertools
 import json
 import os
+import queue
+import re
+import socket
 import socketserver
 import sys
 import threading
@@ -34,8 +39,14 @@ __version__ = "1.0.0-dev"
 class TooLongError(Exception):
     pass
 
+class PayloadError(Exception):
+    pass
+
 class Models:
     class Model:
+        PREDICTED_ATTRIBUTES = {UDDataset.LEMMAS: "lemma", UDDataset.UPOS: "upostag", UDDataset.XPOS: "xpostag",
+                                UDDataset.FEATS: "feats", UDDataset.HEAD: "head", UDDataset.DEPREL: "deprel"}
+
         class Network:
             _mutex = threading.Lock()
 
@@ -43,6 +54,7 @@ class Models:
                 self._path = path
                 self._server_args = server_args
                 self.network, self.args, self.train = None, None, None
+                self._requests = None
 
             def load(self):
                 if self.network is not None:
@@ -53,13 +65,102 @@ class Models:
 
                     with open(os.path.join(self._path, "options.json"), mode="r") as options_file:
                         self.args = argparse.Namespace(**json.load(options_file))
+                    self.args = latinpipe_evalatin24.parser.parse_args([], namespace=self.args)
                     self.args.batch_size = self._server_args.batch_size
+                    self.args.batch_tokens = self._server_args.batch_tokens
+                    self.args.backend = self._server_args.backend
+                    self.args.compile = self._server_args.compile
+                    self.args.decoding_processes = self._server_args.decoding_processes
+                    self.args.precision = self._server_args.precision
+                    self.args.quantize = self._server_args.quantize
                     self.args.load = [os.path.join(self._path, "model.weights.h5")]
                     self.train = latinpipe_evalatin24.UDDataset.from_mappings(os.path.join(self._path, "mappings.pkl"))
-                    self.network = latinpipe_evalatin24.LatinPipeModel(self.train, self.args)
+                    if self.args.backend == "onnx":
+                        self.network = latinpipe_evalatin24.LatinPipeModelONNX(self.train, self.args)
+                    elif self.args.backend == "torch":
+                        self.network = latinpipe_evalatin24.LatinPipeModelTorch(self.train, self.args)
+                    else:
+                        self.network = latinpipe_evalatin24.LatinPipeModel(self.train, self.args)
 
                     print("Loaded model {}".format(os.path.basename(self._path)), file=sys.stderr, flush=True)
 
+            def predict(self, words, tag, parse):
+                # Predict the given sentences, each a list of the CoNLL-U columns of its words, either directly,
+                # or with --max_wait in a batch shared with the sentences of other requests, returning
+                # the overrides of every sentence as produced by `predict_overrides`.
+                if self._server_args.max_wait is None:
+                    with self._server_args.optional_semaphore:
+                        return self._predict(words, tag, parse)
+
+                # The scheduler thread is started lazily, because forked workers do not inherit threads
+                if self._requests is None:
+                    with self._mutex:
+                        if self._requests is None:
+                            self._requests = queue.Queue()
+                            threading.Thread(target=self._schedule, daemon=True).start()
+                future = concurrent.futures.Future()
+                self._requests.put((words, tag, parse, future))
+                return future.result()
+
+            def _predict(self, words, tag, parse):
+                time_ds = time.time()
+                # Create LatinPipe2Dataset
+                dataset = latinpipe_evalatin24.UDDataset(
+                    "<web_input>", self.args, sentences=words, train_dataset=self.train)
+                dataloader = latinpipe_evalatin24.TorchUDDataLoader(latinpipe_evalatin24.TorchUDDataset(
+                    dataset, self.network.tokenizers, self.args, training=False), self.args)
+
+                # Prepare network arguments
+                current_args = argparse.Namespace(**vars(self.args))
+                if not tag: current_args.tags = []
+                if not parse: current_args.parse = 0
+
+                # Perform the prediction
+                time_nw = time.time()
+                predicted = latinpipe_evalatin24.predict_overrides(self.network, dataloader, current_args)
+                print("Batch of {} sentences, DS {:.2f}ms, NW {:.2f}ms.".format(
+                    len(words), 1000 * (time_nw - time_ds), 1000 * (time.time() - time_nw)), file=sys.stderr, flush=True)
+                return predicted
+
+            def _schedule(self):
+                while True:
+                    requests = [self._requests.get()]
+                    try:
+                        sentences = len(requests[0][0])
+
+                        # Collect more requests until the batch is full or the wait is over
+                        deadline = time.monotonic() + self._server_args.max_wait / 1000
+                        while sentences < self._server_args.batch_size:
+                            try:
+                                request = self._requests.get(timeout=max(deadline - time.monotonic(), 0))
+                            except queue.Empty:
+                                break
+                            requests.append(request)
+                            sentences += len(request[0])
+
+                        # Predict the requests of the same tasks together, scattering the results back; the batches
+                        # share the --concurrent limit with the other computations, e.g., of the other models
+                        requests_by_tasks = {}
+                        for request in requests:
+                            requests_by_tasks.setdefault(request[1:3], []).append(request)
+                        for (tag, parse), task_requests in requests_by_tasks.items():
+                            try:
+                                with self._server_args.optional_semaphore:
+                                    predicted = self._predict([sentence for request in task_requests for sentence in request[0]], tag, parse)
+                            except Exception as e:
+                                for _, _, _, future in task_requests:
+                                    future.set_exception(e)
+                                continue
+                            start = 0
+                            for words, _, _, future in task_requests:
+                                future.set_result(predicted[start:start + len(words)])
+                                start += len(words)
+                    except Exception as e:
+                        # Fail the collected requests still pending, but keep the scheduler running for the next ones
+                        for _, _, _, future in requests:
+                            if not future.done():
+                                future.set_exception(e)
+
 
         def __init__(self, names, path, network, variant, acknowledgements, server_args):
             self.names = names
@@ -74,14 +175,6 @@ class Models:
             if self._tokenizer is None:
                 raise RuntimeError("Cannot load tokenizer from {}".format(tokenizer_path))
 
-            self._conllu_input = ufal.udpipe.InputFormat.newConlluInputFormat()
-            if self._conllu_input is None:
-                raise RuntimeError("Cannot create CoNLL-U input format")
-
-            self._conllu_output = ufal.udpipe.OutputFormat.newConlluOutputFormat()
-            if self._conllu_output is None:
-                raise RuntimeError("Cannot create CoNLL-U output format")
-
             # Load the network if requested
             if names[0] in server_args.preload_models or "all" in server_args.preload_models:
                 self._network.load()
@@ -100,6 +193,22 @@ class Models:
             # Do not return a generator, but a list to raise exceptions early
             return list(self._read(text, tokenizer))
 
+        def read_stream(self, texts, input_format):
+            # As read, but lazily for texts each ending with complete sentences
+            reader = ufal.udpipe.InputFormat.newInputFormat(input_format)
+            if reader is None:
+                raise RuntimeError("Unknown input format '{}'".format(input_format))
+            for text in texts:
+                yield from self._read(text, reader)
+
+        def tokenize_stream(self, texts, tokenizer_options):
+            # As tokenize, but lazily for texts each ending with complete paragraphs
+            tokenizer = self._tokenizer.newTokenizer(tokenizer_options)
+            if tokenizer is None:
+                raise RuntimeError("Cannot create tokenizer.")
+            for text in texts:
+                yield from self._read(text, tokenizer)
+
         def _read(self, text, reader):
             sentence = ufal.udpipe.Sentence()
             processing_error = ufal.udpipe.ProcessingError()
@@ -118,48 +227,50 @@ class Models:
                 raise RuntimeError("Unknown output format '{}'".format(output_format))
             return writer
 
-        def predict(self, sentences, tag, parse, writer):
+        def predict(self, sentences, tag, parse, writer, ndjson=False):
             # Run the model
             if tag or parse:
                 # Load the network if it has not been loaded already
                 self._network.load()
 
-                conllu_input = []
-                for sentence in sentences:
-                    conllu_input.append(self._conllu_output.writeSentence(sentence))
-
-                time_ds = time.time()
-                # Create LatinPipe2Dataset
-                dataset = latinpipe_evalatin24.UDDataset(
-                    "<web_input>", self._network.args, text="".join(conllu_input), train_dataset=self._network.train)
-                dataloader = latinpipe_evalatin24.TorchUDDataLoader(latinpipe_evalatin24.TorchUDDataset(
-                    dataset, self._network.network.tokenizers, self._network.args, training=False), self._network.args)
-
-                # Prepare network arguments
-                current_args = argparse.Namespace(**vars(self._network.args))
-                if not tag: current_args.tags = []
-                if not parse: current_args.parse = 0
+                # Pass the sentences to the network as the CoNLL-U columns of their words, without
+                # serializing them to CoNLL-U; empty fields are written as underscores as in CoNLL-U
+                sentences = list(sentences)
+                words = [[[word.form or "_", word.lemma or "_", word.upostag or "_", word.xpostag or "_", word.feats or "_",
+                           str(word.head) if word.head >= 0 else "_", word.deprel or "_", word.deps or "_", word.misc or "_"]
+                          for word in sentence.words[1:]] for sentence in sentences]
 
                 # Perform the prediction
-                time_nws = time.time()
-                with self._server_args.optional_semaphore:
-                    time_nw = time.time()
-                    predicted = self._network.network.predict(dataloader, args_override=current_args)
-                    time_rd = time.time()
-
-                # Load the predicted CoNLL-U to ufal.udpipe sentences
-                sentences = self._read(predicted, self._conllu_input)
+                time_nw = time.time()
+                predicted = self._network.predict(words, tag, parse)
+                time_rd = time.time()
+
+                # Store the predictions directly in the ufal.udpipe sentences
+                factors = self._network.train.factors
+                for sentence, overrides in zip(sentences, predicted):
+                    for f, attribute in self.PREDICTED_ATTRIBUTES.items():
+                        if overrides[f] is None:
+                            continue
+                        for word, override in zip(sentence.words[1:], overrides[f]):
+                            if f == UDDataset.HEAD:
+                                value = int(override)
+                            elif f == UDDataset.LEMMAS:
+                                value = UDDataset.apply_lemma_rule(factors[f].words[override], word.form)
+                            else:
+                                value = factors[f].words[override]
+                            setattr(word, attribute, value)
 
-                print("Request, DS {:.2f}ms,".format(1000 * (time_nws - time_ds)),
-                      "NW {:.2f}+{:.2f}ms,".format(1000 * (time_rd - time_nw), 1000 * (time_nw - time_nws)),
+                print("Request, NW {:.2f}ms,".format(1000 * (time_rd - time_nw)),
                       "RD {:.2f}ms.".format(1000 * (time.time() - time_rd)),
                       file=sys.stderr, flush=True)
 
-            # Generate output
+            # Generate output, either as a single string, or as a JSON line per sentence
             output = []
             for sentence in sentences:
                 output.append(writer.writeSentence(sentence))
             output.append(writer.finishDocument())
+            if ndjson:
+                return "".join(json.dumps({"result": result}, ensure_ascii=False) + "\n" for result in output if result)
             return "".join(output)
 
     def __init__(self, server_args):
@@ -187,22 +298,147 @@ class Models:
 class LatinPipeServer(socketserver.ThreadingTCPServer):
     class LatinPipeServerRequestHandler(http.server.BaseHTTPRequestHandler):
         protocol_version = "HTTP/1.1"
-
-        def respond(request, content_type, code=200, additional_headers={}):
-            request.close_connection = True
+        timeout = 60  # Seconds a kept-alive connection may stay idle, and a single read or write may take
+
+        def handle_one_request(request):
+            # Wait for the next request as an idle connection, which is closed when the timeout expires
+            # or when the server is closed; once the request starts arriving, it is processed fully.
+            with request.server._connections_lock:
+                if request.server._closing:
+                    request.close_connection = True
+                    return
+                request.server._idle_connections.add(request.connection)
+            try:
+                request.rfile.peek(1)
+            except OSError:
+                request.close_connection = True
+                return
+            finally:
+                with request.server._connections_lock:
+                    request.server._idle_connections.discard(request.connection)
+            super().handle_one_request()
+
+        def respond(request, content_type, code=200, additional_headers={}, trailers=[]):
+            # HTTP/1.1 responses use chunked transfer encoding, so that they can be streamed, the connection
+            # can be kept alive, and the given `trailers` headers can be sent by `end_response` after the output;
+            # HTTP/1.0 responses close the connection and omit the trailers.
+            request.chunked = request.request_version == "HTTP/1.1"
+            request.trailers = trailers if request.chunked else []
+            if not request.chunked:
+                request.close_connection = True
             request.send_response(code)
-            request.send_header("Connection", "close")
+            request.send_header("Connection", "close" if request.close_connection else "keep-alive")
             request.send_header("Content-Type", content_type)
+            if request.chunked:
+                request.send_header("Transfer-Encoding", "chunked")
+            if request.trailers:
+                request.send_header("Trailer", ", ".join(request.trailers))
             request.send_header("Access-Control-Allow-Origin", "*")
             for key, value in additional_headers.items():
                 request.send_header(key, value)
             request.end_headers()
 
+        def write(request, data):
+            # An empty chunk would terminate the response
+            if not data:
+                return
+            request.output.append(b"%x\r\n%s\r\n" % (len(data), data) if request.chunked else data)
+            # Clients sending the whole payload before reading the response (e.g., http.client, urllib, or requests)
+            # would deadlock on a response filling the socket buffers, so the output is sent only after the payload
+            # has been read completely; until then, the output produced for a streamed payload is buffered.
+            if request.payload_read:
+                request.flush_output()
+
+        def flush_output(request):
+            if request.output:
+                request.wfile.write(b"".join(request.output))
+                request.output = []
+
+        def end_response(request, trailers={}):
+            if request.chunked:
+                request.output.append(b"0\r\n" + "".join(
+                    "{}: {}\r\n".format(name, trailers[name]) for name in request.trailers if name in trailers).encode("ascii") + b"\r\n")
+            request.flush_output()
+            # A payload not read completely would be parsed as the next request, so the connection is closed
+            if not request.payload_read:
+                request.close_connection = True
+
+        def read_payload(request, limit=None):
+            # Yield the payload of a POST request as it arrives, either of the given Content-Length,
+            # or in chunked Transfer-Encoding; the socket is read only when the next piece is requested.
+            def chunk_size():
+                try:
+                    size = int(request.rfile.readline().split(b";")[0], 16)
+                except ValueError:
+                    raise PayloadError("Invalid chunk size.")
+                if size < 0:
+                    raise PayloadError("Invalid chunk size.")
+                return size
+
+            chunked = request.headers.get("Transfer-Encoding", "identity").lower() == "chunked"
+            if chunked:
+                sizes = iter(chunk_size, 0)
+            else:
+                sizes = [int(request.headers["Content-Length"])]
+
+            total = 0
+            for size in sizes:
+                while size:
+                    data = request.rfile.read(min(size, 65536))
+                    if not data:
+                        raise PayloadError("The payload ended prematurely.")
+                    size -= len(data)
+                    total += len(data)
+                    if limit is not None and total > limit:
+                        raise PayloadError("The payload size is too large.")
+                    yield data
+                if chunked:
+                    request.rfile.readline()
+            if chunked:
+                while request.rfile.readline().strip():  # Skip the trailers
+                    pass
+            request.payload_read = True
+
+        PARAGRAPH_END = re.compile(r"\n[ \t\r]*\n")
+
+        def read_texts(request):
+            # Decode the streamed payload and yield it NFC-normalized up to the last blank line received, which
+            # ends both paragraphs of raw text and sentences of CoNLL-U; only the unfinished rest is kept,
+            # which must not exceed --max_request_size.
+            decoder, pending = codecs.getincrementaldecoder("utf-8")(), ""
+            try:
+                for data in request.read_payload():
+                    start, pending = max(pending.rfind("\n"), 0), pending + decoder.decode(data)
+                    end = None
+                    for end in request.PARAGRAPH_END.finditer(pending, start):
+                        pass
+                    if end is not None:
+                        yield unicodedata.normalize("NFC", pending[:end.end()])
+                        pending = pending[end.end():]
+                    elif len(pending) > request.server._server_args.max_request_size:
+                        raise PayloadError("The payload contains too long a paragraph or sentence.")
+                pending += decoder.decode(b"", final=True)
+            except UnicodeDecodeError:
+                raise PayloadError("The payload is not in UTF-8 encoding.")
+            if pending:
+                yield unicodedata.normalize("NFC", pending)
+
         def respond_error(request, message, code=400):
+            # The payload of the request might not have been read, so the connection is closed
+            request.close_connection = True
             request.respond("text/plain", code)
-            request.wfile.write(message.encode("utf-8"))
+            request.write(message.encode("utf-8"))
+            request.end_response()
+
+        PROCESS_PATHS = ["/process", "/weblicht/tokenize", "/weblicht/tag", "/weblicht/parse"]
+
+        TOKENIZER_TOO_LONG_ERROR = "During tokenization, sentence longer than 1000 words was found, aborting.\nThat should only happen with presegmented input.\nPlease make sure you do not generate such long sentences.\n"
+        INPUT_TOO_LONG_ERROR = "Sentence longer than 1000 words was found on input, aborting.\nPlease make sure the input sentences have at most 1000 words.\n"
 
         def do_GET(request):
+            request.payload_read = request.command != "POST" or request.headers.get("Content-Length") == "0"
+            request.output = []
+
             # Parse the URL
             params = {}
             try:
@@ -213,59 +449,73 @@ class LatinPipeServer(socketserver.ThreadingTCPServer):
             except:
                 return request.respond_error("Cannot parse request URL.")
 
-            # Parse the body of a POST request
+            # Parse the body of a POST request; raw text payloads are streamed, the forms are read whole
+            texts = None
             if request.command == "POST":
-                if request.headers.get("Transfer-Encoding", "identity").lower() != "identity":
-                    return request.respond_error("Only 'identity' Transfer-Encoding of payload is supported for now.")
+                if request.headers.get("Transfer-Encoding", "identity").lower() not in ["identity", "chunked"]:
+                    return request.respond_error("Only 'identity' and 'chunked' Transfer-Encoding of payload are supported.")
 
-                try:
-                    content_length = int(request.headers["Content-Length"])
-                except:
-                    return request.respond_error("The Content-Length of payload is required.")
-
-                if content_length > request.server._server_args.max_request_size:
-                    return request.respond_error("The payload size is too large.")
+                if request.headers.get("Transfer-Encoding", "identity").lower() == "identity":
+                    try:
+                        int(request.headers["Content-Length"])
+                    except:
+                        return request.respond_error("The Content-Length of payload is required.")
 
-                # Raw text on input for weblicht
+                # Raw text on input for weblicht, and for /process with a text/plain payload
                 if url.path.startswith("/weblicht/"):
                     # Ignore all but `model` GET param
                     params = {"model": params["model"]} if "model" in params else {}
-
-                    try:
-                        params["data"] = request.rfile.read(content_length).decode("utf-8")
-                    except:
-                        return request.respond_error("The payload is not in UTF-8 encoding.")
+                    texts = request.read_texts()
 
                     if url.path == "/weblicht/tokenize": params["tokenizer"] = ""
                     else: params["input"] = "conllu"
                     params["output"] = "conllu"
                     if url.path == "/weblicht/tag": params["tagger"] = ""
                     if url.path == "/weblicht/parse": params["parser"] = ""
+                elif request.headers.get("Content-Type", "").startswith("text/plain"):
+                    if url.path == "/portparser/process":
+                        # The Portparser pipeline segments the whole text as Parser.parse does, without NFC normalization
+                        try:
+                            params["data"] = b"".join(request.read_payload(limit=request.server._server_args.max_request_size)).decode("utf-8")
+                        except PayloadError as error:
+                            return request.respond_error(str(error))
+                        except UnicodeDecodeError:
+                            return request.respond_error("The payload is not in UTF-8 encoding.")
+                    else:
+                        texts = request.read_texts()
                 # multipart/form-data
                 elif request.headers.get("Content-Type", "").startswith("multipart/form-data"):
                     try:
                         parser = email.parser.BytesFeedParser()
                         parser.feed(b"Content-Type: " + request.headers["Content-Type"].encode("ascii") + b"\r\n\r\n")
-                        while content_length:
-                            parser.feed(request.rfile.read(min(content_length, 4096)))
-                            content_length -= min(content_length, 4096)
+                        for data in request.read_payload(limit=request.server._server_args.max_request_size):
+                            parser.feed(data)
                         for part in parser.close().get_payload():
                             name = part.get_param("name", header="Content-Disposition")
                             if name:
                                 params[name] = part.get_payload(decode=True).decode("utf-8")
+                    except PayloadError as error:
+                        return request.respond_error(str(error))
                     except:
                         return request.respond_error("Cannot parse the multipart/form-data payload.")
                 # application/x-www-form-urlencoded
                 elif request.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
                     try:
                         for name, value in urllib.parse.parse_qsl(
-                                request.rfile.read(content_length).decode("utf-8"), encoding="utf-8", keep_blank_values=True, errors="strict"):
+                                b"".join(request.read_payload(limit=request.server._server_args.max_request_size)).decode("utf-8"),
+                                encoding="utf-8", keep_blank_values=True, errors="strict"):
                             params[name] = value
+                    except PayloadError as error:
+                        return request.respond_error(str(error))
                     except:
                         return request.respond_error("Cannot parse the application/x-www-form-urlencoded payload.")
                 else:
                     return request.respond_error("Unsupported payload Content-Type '{}'.".format(request.headers.get("Content-Type", "<none>")))
 
+            # Only the /process endpoints read a streamed payload, the other responses leave it unread and close the connection
+            if texts is not None and url.path not in request.PROCESS_PATHS:
+                request.close_connection = True
+
             # Handle /models
             if url.path == "/models":
                 response = {
@@ -273,36 +523,44 @@ class LatinPipeServer(socketserver.ThreadingTCPServer):
                     "default_model": request.server._models.default_model,
                 }
                 request.respond("application/json")
-                request.wfile.write(json.dumps(response, indent=1).encode("utf-8"))
+                request.write(json.dumps(response, indent=1).encode("utf-8"))
+                request.end_response()
             # Handle /process
-            elif url.path in ["/process", "/weblicht/tokenize", "/weblicht/tag", "/weblicht/parse"]:
+            elif url.path in request.PROCESS_PATHS:
                 weblicht = url.path.startswith("/weblicht")
 
-                if "data" not in params:
+                if "data" not in params and texts is None:
                     return request.respond_error("The parameter 'data' is required.")
-                params["data"] = unicodedata.normalize("NFC", params["data"])
+                if "data" in params:
+                    params["data"] = unicodedata.normalize("NFC", params["data"])
 
                 model = params.get("model", request.server._models.default_model)
                 if model not in request.server._models.models_by_names:
                     return request.respond_error("The requested model '{}' does not exist.".format(model))
                 model = request.server._models.models_by_names[model]
 
-                # Start by reading and optionally tokenizing the input data.
-                if "tokenizer" in params:
+                # Start by reading and optionally tokenizing the input data; streamed payloads are read
+                # and tokenized lazily, as the sentences are needed by the processing below.
+                if texts is not None:
+                    if "tokenizer" in params:
+                        sentences = model.tokenize_stream(texts, params["tokenizer"])
+                    else:
+                        sentences = model.read_stream(texts, params.get("input", "conllu"))
+                elif "tokenizer" in params:
                     try:
                         sentences = model.tokenize(params["data"], params["tokenizer"])
                     except TooLongError:
-                        return request.respond_error("During tokenization, sentence longer than 1000 words was found, aborting.\nThat should only happen with presegmented input.\nPlease make sure you do not generate such long sentences.\n")
+                        return request.respond_error(request.TOKENIZER_TOO_LONG_ERROR)
                     except:
                         return request.respond_error("An error occured during tokenization of the input.")
                 else:
                     try:
                         sentences = model.read(params["data"], params.get("input", "conllu"))
                     except TooLongError:
-                        return request.respond_error("Sentence longer than 1000 words was found on input, aborting.\nPlease make sure the input sentences have at most 1000 words.\n")
+                        return request.respond_error(request.INPUT_TOO_LONG_ERROR)
                     except:
                         return request.respond_error("Cannot parse the input in '{}' format.".format(params.get("input", "conllu")))
-                infclen = sum(sum(len(word.form) for word in sentence.words[1:]) for sentence in sentences)
+                infclen = sum(sum(len(word.form) for word in sentence.words[1:]) for sentence in sentences) if texts is None else 0
 
                 # Create the writer
                 output_format = params.get("output", "conllu")
@@ -311,50 +569,103 @@ class LatinPipeServer(socketserver.ThreadingTCPServer):
                 except:
                     return request.respond_error("Unknown output format '{}'.".format(output_format))
 
-                # Process the data
+                # Process the data, optionally producing newline-delimited JSON with a line per sentence
                 tag, parse, output_format = "tagger" in params, "parser" in params, params.get("output", "conllu")
+                ndjson = "ndjson" in params and not weblicht
+                # The input length of a streamed payload is known only after processing it, so it is sent as a trailer
+                billing_headers = {"X-Billing-Input-NFC-Len": str(infclen)} if texts is None else {}
+                billing_trailers = ["X-Billing-Input-NFC-Len"] if texts is not None else []
                 batch, started_responding = [], False
                 try:
                     for sentence in itertools.chain(sentences, ["EOF"]):
+                        if texts is not None and sentence != "EOF":
+                            infclen += sum(len(word.form) for word in sentence.words[1:])
                         if sentence == "EOF" or len(batch) == request.server._server_args.batch_size:
-                            output = model.predict(batch, tag, parse, writer)
+                            output = model.predict(batch, tag, parse, writer, ndjson)
                             if not started_responding:
                                 # The first batch is ready, we commit to generate output.
                                 started_responding=True
                                 if weblicht:
                                     request.respond("application/conllu")
+                                elif ndjson:
+                                    request.respond("application/x-ndjson", additional_headers=billing_headers, trailers=billing_trailers)
+                                    request.write(json.dumps({
+                                        "model": model.names[0],
+                                        "acknowledgements": ["https://github.com/ufal/evalatin2024-latinpipe", model.acknowledgements],
+                                    }, ensure_ascii=False).encode("utf-8") + b"\n")
                                 else:
-                                    request.respond("application/json", additional_headers={"X-Billing-Input-NFC-Len": str(infclen)})
-                                    request.wfile.write(json.dumps({
+                                    request.respond("application/json", additional_headers=billing_headers, trailers=billing_trailers)
+                                    request.write(json.dumps({
                                         "model": model.names[0],
                                         "acknowledgements": ["https://github.com/ufal/evalatin2024-latinpipe", model.acknowledgements],
                                         "result": "",
                                     }, indent=1)[:-3].encode("utf-8"))
                                     if output_format == "conllu":
-                                        request.wfile.write(json.dumps(
+                                        request.write(json.dumps(
                                             "# generator = LatinPipe EvaLatin24, https://lindat.mff.cuni.cz/services/udpipe\n"
                                             "# latinpipe_model = {}\n"
                                             "# latinpipe_model_licence = CC BY-NC-SA\n".format(model.names[0]))[1:-1].encode("utf-8"))
-                            if weblicht:
-                                request.wfile.write(output.encode("utf-8"))
+                            if weblicht or ndjson:
+                                request.write(output.encode("utf-8"))
                             else:
-                                request.wfile.write(json.dumps(output, ensure_ascii=False)[1:-1].encode("utf-8"))
+                                request.write(json.dumps(output, ensure_ascii=False)[1:-1].encode("utf-8"))
                             batch = []
                         batch.append(sentence)
-                    if not weblicht:
-                        request.wfile.write(b'"\n}\n')
-                except:
-                    import traceback
-                    traceback.print_exc(file=sys.stderr)
-                    sys.stderr.flush()
+                    if not weblicht and not ndjson:
+                        request.write(b'"\n}\n')
+                    request.end_response({"X-Billing-Input-NFC-Len": str(infclen)})
+                except Exception as error:
+                    # Errors of streamed payloads are found only during processing
+                    if isinstance(error, TooLongError):
+                        message = request.TOKENIZER_TOO_LONG_ERROR if "tokenizer" in params else request.INPUT_TOO_LONG_ERROR
+                    elif isinstance(error, PayloadError):
+                        message = str(error)
+                    else:
+                        import traceback
+                        traceback.print_exc(file=sys.stderr)
+                        sys.stderr.flush()
+                        message = "An internal error occurred during processing."
 
                     if not started_responding:
-                        request.respond_error("An internal error occurred during processing.")
+                        request.respond_error(message)
                     else:
+                        # The response is not terminated, so that the client detects it as incomplete
+                        request.close_connection = True
+                        message = message.rstrip(".\n")
                         if weblicht:
-                            request.wfile.write(b'\n\nAn internal error occurred during processing, producing incorrect CoNLL-U!')
+                            request.write("\n\n{}, producing incorrect CoNLL-U!".format(message).encode("utf-8"))
+                        elif ndjson:
+                            request.write(json.dumps({"error": "{}, the output is incomplete!".format(message)}).encode("utf-8") + b"\n")
                         else:
-                            request.wfile.write(b'",\n"An internal error occurred during processing, producing incorrect JSON!"')
+                            request.write('",\n{}'.format(json.dumps("{}, producing incorrect JSON!".format(message))).encode("utf-8"))
+                        request.flush_output()
+            # Handle /portparser/process, running the Portuguese pipeline of Parser.parse in-process
+            elif url.path == "/portparser/process":
+                portparser = request.server._portparser
+                if portparser is None:
+                    return request.respond_error("The Portparser pipeline is not served, see --portparser.", code=404)
+                if "data" not in params:
+                    return request.respond_error("The parameter 'data' is required.")
+
+                # Run Parser.parse itself, so that the output is the same, sharing the --concurrent limit with the models
+                try:
+                    with request.server._server_args.optional_semaphore:
+                        conllu = portparser.parse(params["data"], segment="presegmented" not in params)
+                except:
+                    import traceback
+                    traceback.print_exc(file=sys.stderr)
+                    sys.stderr.flush()
+                    return request.respond_error("An internal error occurred during processing.")
+
+                if "ndjson" in params:
+                    request.respond("application/x-ndjson")
+                    request.write((json.dumps({"model": "portparser"}) + "\n" + "".join(
+                        json.dumps({"result": block + "\n\n"}, ensure_ascii=False) + "\n"
+                        for block in conllu.split("\n\n") if block.strip("\n"))).encode("utf-8"))
+                else:
+                    request.respond("application/json")
+                    request.write(json.dumps({"model": "portparser", "result": conllu}, indent=1, ensure_ascii=False).encode("utf-8"))
+                request.end_response()
             # Unknown URL
             else:
                 request.respond_error("No handler for the given URL '{}'".format(url.path), code=404)
@@ -364,18 +675,33 @@ class LatinPipeServer(socketserver.ThreadingTCPServer):
 
     daemon_threads = False
 
-    def __init__(self, server_args, models):
+    def __init__(self, server_args, models, portparser=None):
         super().__init__(("", server_args.port), self.LatinPipeServerRequestHandler)
 
         self._server_args = server_args
         self._models = models
+        self._portparser = portparser
+        self._connections_lock = threading.Lock()
+        self._idle_connections = set()
+        self._closing = False
 
     def server_bind(self):
-        import socket
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         super().server_bind()
 
+    def server_close(self):
+        # Close the idle kept-alive connections, so that their handler threads, which are joined, finish;
+        # the requests being processed are completed, and their connections closed afterwards.
+        with self._connections_lock:
+            self._closing = True
+            for connection in self._idle_connections:
+                try:
+                    connection.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+        super().server_close()
+
     def service_actions(self):
         if isinstance(getattr(self, "_threads", None), list):
             if len(self._threads) >= 1024:
@@ -391,43 +717,99 @@ if __name__ == "__main__":
     parser.add_argument("port", type=int, help="Port to use")
     parser.add_argument("default_model", type=str, help="Default model")
     parser.add_argument("models", type=str, nargs="+", help="Models to serve")
+    parser.add_argument("--backend", default="keras", choices=["keras", "onnx", "torch"], type=str, help="Inference backend")
     parser.add_argument("--batch_size", default=32, type=int, help="Batch size")
+    parser.add_argument("--batch_tokens", default=None, type=int, help="Maximum padded subwords per batch, instead of batch size")
+    parser.add_argument("--compile", default=0, type=int, help="Compile the torch backend network")
     parser.add_argument("--concurrent", default=None, type=int, help="Concurrent computations of NN")
+    parser.add_argument("--decoding_processes", default=0, type=int, help="Processes running the tree decoding")
     parser.add_argument("--logfile", default=None, type=str, help="Log path")
+    parser.add_argument("--max_wait", default=None, type=float, help="If given, batch sentences of concurrent requests, waiting at most this many ms")
     parser.add_argument("--max_request_size", default=4096*1024, type=int, help="Maximum request size")
+    parser.add_argument("--portparser", default=None, type=str, help="Serve /portparser/process with this Portparser model.weights.h5, or `download`")
     parser.add_argument("--preload_models", default=[], nargs="*", type=str, help="Models to preload, or `all`")
-    parser.add_argument("--threads", default=0, type=int, help="Threads to use")
+    parser.add_argument("--precision", default="fp32", choices=["fp32", "bf16"], type=str, help="Inference precision")
+    parser.add_argument("--quantize", default="none", choices=["none", "int8"], type=str, help="Quantize the models for inference")
+    parser.add_argument("--threads", default=0, type=int, help="Threads to use, per worker with --workers")
+    parser.add_argument("--workers", default=0, type=int, help="Worker processes forked after loading the models, sharing their weights")
     args = parser.parse_args()
 
     # Log stderr to logfile if given
     if args.logfile is not None:
         sys.stderr = open(args.logfile, "a", encoding="utf-8")
 
-    if args.threads:
+    if args.threads and not args.workers:
         # Limit the number of threads if requested
         import torch
         torch.set_num_threads(args.threads)
         torch.set_num_interop_threads(args.threads)
 
+    # With workers, all models are loaded before forking, so that the workers share their weights
+    if args.workers:
+        args.preload_models = ["all"]
+
     # Load the models
     models = Models(args)
 
-    # Create a semaphore if needed
-    args.optional_semaphore = threading.Semaphore(args.concurrent) if args.concurrent is not None else contextlib.nullcontext()
-
-    # Create the server
-    server = LatinPipeServer(args, models)
-    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
-    server_thread.start()
-
-    print("Started LatinPipe server on port {}.".format(args.port), file=sys.stderr)
-    print("To stop it gracefully, either send SIGINT (Ctrl+C) or SIGUSR1.", file=sys.stderr, flush=True)
-
-    # Wait until the server should be closed
-    signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGINT, signal.SIGUSR1])
-    signal.sigwait([signal.SIGINT, signal.SIGUSR1])
-    print("Initiating shutdown of the LatinPipe EvaLatin24 server.", file=sys.stderr, flush=True)
-    server.shutdown()
-    print("Stopped handling new requests, processing all current ones.", file=sys.stderr, flush=True)
-    server.server_close()
-    print("Finished shutdown of the LatinPipe EvaLatin24 server.", file=sys.stderr, flush=True)
+    # Load the Portparser pipeline if requested
+    portparser = None
+    if args.portparser is not None:
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        from portparser_v2.core import Parser, download_model
+        portparser = Parser(
+            download_model() if args.portparser == "download" else args.portparser, batch_tokens=args.batch_tokens,
+            quantize=None if args.quantize == "none" else args.quantize, precision=None if args.precision == "fp32" else args.precision,
+            backend=None if args.backend == "keras" else args.backend, compile=bool(args.compile), decoding_processes=args.decoding_processes)
+        print("Loaded Portparser model {}".format(portparser.model_path), file=sys.stderr, flush=True)
+
+    def serve():
+        # Create a semaphore if needed
+        args.optional_semaphore = threading.Semaphore(args.concurrent) if args.concurrent is not None else contextlib.nullcontext()
+
+        # Create the server
+        server = LatinPipeServer(args, models, portparser)
+        server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+        server_thread.start()
+
+        print("Started LatinPipe server on port {}{}.".format(args.port, " in worker {}".format(os.getpid()) if args.workers else ""), file=sys.stderr)
+        print("To stop it gracefully, either send SIGINT (Ctrl+C) or SIGUSR1.", file=sys.stderr, flush=True)
+
+        # Wait until the server should be closed
+        signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGINT, signal.SIGUSR1])
+        signal.sigwait([signal.SIGINT, signal.SIGUSR1])
+        print("Initiating shutdown of the LatinPipe EvaLatin24 server.", file=sys.stderr, flush=True)
+        server.shutdown()
+        print("Stopped handling new requests, processing all current ones.", file=sys.stderr, flush=True)
+        server.server_close()
+        print("Finished shutdown of the LatinPipe EvaLatin24 server.", file=sys.stderr, flush=True)
+
+    if not args.workers:
+        serve()
+    else:
+        # Fork the workers, which inherit the loaded models copy-on-write and bind their own sockets
+        # to the same port with SO_REUSEPORT, so that the kernel distributes the connections among them.
+        import gc
+        import torch
+        gc.freeze()
+        signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGINT, signal.SIGUSR1])
+        workers = []
+        for _ in range(args.workers):
+            pid = os.fork()
+            if pid == 0:
+                torch.set_num_threads(args.threads or max(1, (os.cpu_count() or 1) // args.workers))
+                serve()
+                latinpipe_evalatin24.shutdown_decoding_pool()
+                sys.stderr.flush()
+                os._exit(0)
+            workers.append(pid)
+
+        # Forward the shutdown signal to the workers and wait for them to finish
+        signal.sigwait([signal.SIGINT, signal.SIGUSR1])
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGUSR1)
+            except ProcessLookupError:
+                pass
+        for pid in workers:
+            os.waitpid(pid, 0)
+        print("All {} LatinPipe EvaLatin24 server workers finished.".format(args.workers), file=sys.stderr, flush=True)
@@ -0,0 +1,250 @@
+# A keras-free PyTorch inference runtime for trained LatinPipe models.
+#
+# LatinPipeModelTorch mirrors the network of latinpipe_evalatin24.LatinPipeModel
+# as a plain torch.nn.Module, loading the same model.weights.h5 and mappings,
+# and decodes its predictions with the same predict_conllu. Only the options,
+# datasets and data loaders of latinpipe_evalatin24_base are needed, so keras
+# is never imported.
+
+import argparse
+import re
+
+import h5py
+import torch
+
+# The options, datasets and data loaders are also provided for the users of this module
+from latinpipe_evalatin24_base import parser, create_transformer, evaluate_conllu, pool_subwords, predict_conllu, predicted_labels, task_outputs, TorchUDDataLoader, TorchUDDataset, UDDataset
+
+
+class LatinPipeModelTorch(torch.nn.Module):
+    class Dense(torch.nn.Module):
+        # Computes as keras.layers.Dense, with the kernel of shape [inputs, outputs].
+        def __init__(self, group: h5py.Group, activation: str|None = None):
+            super().__init__()
+            self.kernel = torch.nn.Parameter(torch.from_numpy(group["vars"]["0"][()]), requires_grad=False)
+            self.bias = torch.nn.Parameter(torch.from_numpy(group["vars"]["1"][()]), requires_grad=False)
+            self._activation = activation
+
+        def forward(self, inputs):
+            outputs = torch.matmul(inputs, self.kernel) + self.bias
+            return torch.relu(outputs) if self._activation == "relu" else outputs
+
+    class HFTransformer(torch.nn.Module):
+        def __init__(self, transformer: torch.nn.Module, subword_combination: str):
+            super().__init__()
+            self._transformer = transformer
+            self._subword_combination = subword_combination
+
+        def forward(self, inputs, word_indices):
+            hidden_states = self._transformer(torch.clamp(inputs, min=0), attention_mask=inputs > -1).last_hidden_state
+            return pool_subwords(hidden_states, word_indices, self._subword_combination)
+
+    class RNN(torch.nn.Module):
+        # Computes as LatinPipeModel.LSTMTorch and LatinPipeModel.GRUTorch.
+        def __init__(self, rnn: torch.nn.Module):
+            super().__init__()
+            self._rnn = rnn
+
+        def forward(self, inputs, lengths):
+            packed_result, _ = self._rnn(torch.nn.utils.rnn.pack_padded_sequence(inputs, lengths.cpu(), batch_first=True, enforce_sorted=False))
+            return torch.nn.utils.rnn.pad_packed_sequence(packed_result, batch_first=True, padding_value=0, total_length=inputs.shape[1])[0]
+
+    class ParsingHead(torch.nn.Module):
+        def __init__(self, group: h5py.Group):
+            super().__init__()
+            dense = LatinPipeModelTorch.Dense
+            self._head_queries_hidden = dense(group["_head_queries_hidden"], activation="relu")
+            self._head_queries_output = dense(group["_head_queries_output"])
+            self._head_keys_hidden = dense(group["_head_keys_hidden"], activation="relu")
+            self._head_keys_output = dense(group["_head_keys_output"])
+            self._deprel_hidden = dense(group["_deprel_hidden"], activation="relu")
+            self._deprel_output = dense(group["_deprel_output"])
+
+        def forward(self, embeddings, embeddings_wo_root, embeddings_mask):
+            head_queries = self._head_queries_output(self._head_queries_hidden(embeddings_wo_root))
+            head_keys = self._head_keys_output(self._head_keys_hidden(embeddings))
+            head_scores = torch.matmul(head_queries, head_keys.transpose(1, 2)) / torch.sqrt(torch.tensor(head_queries.shape[-1], dtype=torch.float32))
+
+            head_scores_mask = embeddings_mask.unsqueeze(1).to(head_scores.dtype)
+            head_scores = head_scores * head_scores_mask - 1e9 * (1 - head_scores_mask)
+
+            predicted_heads = torch.argmax(head_scores, dim=-1)
+            predicted_head_embeddings = torch.take_along_dim(embeddings, predicted_heads.unsqueeze(-1), dim=1)
+            deprel_hidden = torch.cat([embeddings_wo_root, predicted_head_embeddings], dim=-1)
+            deprel_scores = self._deprel_output(self._deprel_hidden(deprel_hidden))
+
+            return head_scores, deprel_scores
+
+    def __init__(self, dataset: UDDataset, args: argparse.Namespace):
+        super().__init__()
+        assert len(args.load) == 1, "The torch backend does not support ensembles"
+        assert args.quantize == "none", "The torch backend does not support quantization"
+        assert not args.parse or args.rnn_type in ["LSTMTorch", "GRUTorch"], "The torch backend supports only LSTMTorch and GRUTorch"
+        self._dataset = dataset
+        self._args = args
+
+        self._tokenizers, transformers = [], []
+        for name in args.transformers:
+            tokenizer, transformer = create_transformer(name, dataset, args)
+            self._tokenizers.append(tokenizer)
+            transformers.append(transformer)
+
+        with h5py.File(args.load[0], "r") as weights:
+            # Keras stores the layers of the model under their class names, numbered in the order of
+            # the model layers. The layers are ordered by depth, so the hidden layers of all tagging
+            # heads precede their output layers, and the RNN layers follow their order in the network.
+            layers = weights["layers"]
+
+            def keras_layers(name: str) -> list[h5py.Group]:
+                names = [layer for layer in layers if re.fullmatch(r"{}(_\d+)?".format(name), layer)]
+                return [layers[layer] for layer in sorted(names, key=lambda layer: int(layer[len(name) + 1:] or 0))]
+
+            for transformer, layer in zip(transformers, keras_layers("hf_transformer_layer"), strict=True):
+                self._load_torch_module(transformer, layer["_transformer"])
+            self._transformers = torch.nn.ModuleList(self.HFTransformer(transformer, args.subword_combination) for transformer in transformers)
+
+            dense = keras_layers("dense")
+            assert len(dense) == 2 * len(args.tags), "Unexpected number of Dense layers in {}".format(args.load[0])
+            self._tag_hidden = torch.nn.ModuleList(self.Dense(layer, activation="relu") for layer in dense[:len(args.tags)])
+            self._tag_output = torch.nn.ModuleList(self.Dense(layer) for layer in dense[len(args.tags):])
+            for tag, output in zip(args.tags, self._tag_output):
+                assert output.kernel.shape[-1] == len(dataset.factors[tag].words), "Unexpected Dense layer order in {}".format(args.load[0])
+
+            if args.parse:
+                self._tag_embeddings = torch.nn.ModuleList(
+                    torch.nn.Embedding.from_pretrained(torch.from_numpy(layer["vars"]["0"][()]))
+                    for layer in keras_layers("embedding"))
+                assert len(self._tag_embeddings) == len(args.embed_tags)
+
+                rnn_name, rnn_class = {"LSTMTorch": ("lstm_torch", torch.nn.LSTM), "GRUTorch": ("gru_torch", torch.nn.GRU)}[args.rnn_type]
+                self._rnns = torch.nn.ModuleList()
+                for layer in keras_layers(rnn_name):
+                    wrapped = layer["_" + rnn_name.split("_")[0]]
+                    rnn_weights = self._torch_module_weights(wrapped)
+                    input_dim = (rnn_weights["weight_ih_l0"] if isinstance(rnn_weights, dict) else rnn_weights[0]).shape[-1]
+                    rnn = rnn_class(input_dim, args.rnn_dim, batch_first=True, bidirectional=True)
+                    self._load_torch_module(rnn, wrapped)
+                    self._rnns.append(self.RNN(rnn))
+                assert len(self._rnns) == args.rnn_layers
+
+                self._parsing_head = self.ParsingHead(layers["parsing_head"])
+
+        self._all_outputs = tuple(range(len(args.tags) + 2 * bool(args.parse)))
+        self.eval()
+        self.requires_grad_(False)
+
+        self._compiled, self._buckets = None, []
+        if args.compile:
+            self._compile(sorted(args.compile_buckets))
+
+    def _compile(self, buckets: list[int]) -> None:
+        # Every bucket is a separate graph, compiled for both a single sentence and a dynamic batch size.
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 2 * len(buckets) + 2)
+        self._compiled, self._buckets = torch.compile(self.forward), buckets
+
+        # Warm up all buckets now, so that no compilation happens during prediction
+        for bucket in buckets:
+            for batch_size in [1, 2, 3]:
+                inputs = []
+                for tokenizer in self._tokenizers:
+                    inputs.append(torch.full([batch_size, bucket], tokenizer.cls_token_id, dtype=torch.int32))
+                    inputs.append(torch.arange(bucket, dtype=torch.int32)[None, :, None].expand(batch_size, bucket, 2).contiguous())
+                for _ in self._args.embed_tags:
+                    inputs.append(torch.zeros([batch_size, bucket - 1], dtype=torch.int32))
+                self.predict_on_batch(inputs)
+
+    def _bucket(self, inputs) -> int | None:
+        # The smallest bucket the batch can be padded to, or None when no bucket fits.
+        length = max(tensor.shape[1] for tensor in inputs[:2 * len(self._tokenizers)])
+        return next((bucket for bucket in self._buckets if bucket >= length), None)
+
+    def _compiled_forward(self, inputs, bucket: int):
+        padded = []
+        for tensor in inputs:
+            # Pad the sequence dimensions (the embedded tags have no root) with -1, as the data loader does
+            length = bucket - (tensor.ndim == 2 and len(padded) >= 2 * len(self._tokenizers))
+            padding = [0, 0] * (tensor.ndim - 2) + [0, length - tensor.shape[1]]
+            padded.append(torch.nn.functional.pad(tensor, padding, value=-1))
+            torch._dynamo.mark_static(padded[-1], 1)
+        return self._compiled(*padded)
+
+    @staticmethod
+    def _torch_module_weights(group: h5py.Group) -> list[torch.Tensor] | dict[str, torch.Tensor]:
+        # Keras saves the torch modules it wraps either by their state dict keys (recent versions),
+        # or as a list of variables in the order of the module parameters (older versions).
+        store = group["vars"]
+        if all(key.isdigit() for key in store):
+            return [torch.from_numpy(store[key][()]) for key in sorted(store, key=int)]
+        return {key: torch.from_numpy(store[key][()]) for key in store}
+
+    @classmethod
+    def _load_torch_module(cls, module: torch.nn.Module, group: h5py.Group) -> None:
+        weights = cls._torch_module_weights(group)
+        if isinstance(weights, dict):
+            module.load_state_dict(weights)
+        else:
+            parameters = list(module.parameters())
+            assert len(parameters) == len(weights), "Unexpected number of weights in {}".format(group.name)
+            with torch.no_grad():
+                for parameter, weight in zip(parameters, weights):
+                    parameter.copy_(weight)
+
+    @property
+    def tokenizers(self):
+        return self._tokenizers
+
+    def forward(self, *inputs, outputs: tuple[int, ...] | None = None):
+        # Only the given outputs (see `task_outputs`) are computed, by default all of them.
+        outputs = self._all_outputs if outputs is None else outputs
+        embeddings = torch.cat([
+            transformer(tokens, word_indices)
+            for tokens, word_indices, transformer in zip(inputs[0::2], inputs[1::2], self._transformers)], dim=-1)
+
+        predictions = []
+        for output in outputs:
+            if output < len(self._tag_output):
+                predictions.append(self._tag_output[output](self._tag_hidden[output](embeddings[:, 1:])))
+
+        if len(self._tag_output) in outputs:
+            if self._args.embed_tags:
+                all_embeddings = [embeddings]
+                for embedding, input_tags in zip(self._tag_embeddings, inputs[-len(self._args.embed_tags):]):
+                    all_embeddings.append(embedding(torch.nn.functional.pad(input_tags.long() + 1, (1, 0))))
+                embeddings = torch.cat(all_embeddings, dim=-1)
+
+            embeddings_mask = inputs[1][..., 0] > -1
+            lengths = torch.sum(embeddings_mask, dim=-1)
+            for i, rnn in enumerate(self._rnns):
+                hidden = rnn(embeddings, lengths)
+                embeddings = hidden + (embeddings if i else 0)
+
+            predictions.extend(self._parsing_head(embeddings, embeddings[:, 1:], embeddings_mask))
+        return predictions
+
+    def _forward_batch(self, x, outputs: tuple[int, ...] | None = None):
+        # Only the network computing all outputs is compiled and warmed up, so the sub-graphs computing
+        # some of them, which skip the layers of the others, run eagerly.
+        with torch.autocast("cpu", dtype=torch.bfloat16, enabled=self._args.precision == "bf16"):
+            bucket = self._bucket(x) if self._compiled is not None and outputs is None else None
+            if bucket is not None:
+                return self._compiled_forward(x, bucket)
+            return self(*x, outputs=outputs)
+
+    def predict_on_batch(self, x):
+        with torch.inference_mode():
+            predictions = self._forward_batch(x)
+            return [prediction.float().numpy() for prediction in predictions]
+
+    def predict_labels_on_batch(self, x, args: argparse.Namespace|None = None):
+        args = self._args if args is None else args
+        outputs = tuple(task_outputs(self._args, args))
+        if not outputs:
+            return []
+        with torch.inference_mode():
+            return predicted_labels(self._forward_batch(x, None if outputs == self._all_outputs else outputs), args)
+
+    def predict(self, dataloader: TorchUDDataLoader, save_as: str|None = None, args_override: argparse.Namespace|None = None) -> str:
+        return predict_conllu(self, dataloader, self._args if args_override is None else args_override, save_as=save_as)
+
+    def evaluate(self, dataloader: TorchUDDataLoader, save_as: str|None = None, args_override: argparse.Namespace|None = None) -> tuple[str, dict[str, float]]:
+        return evaluate_conllu(self, dataloader, save_as=save_as, args_override=args_override)
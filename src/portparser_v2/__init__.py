@@ -1,7 +1,9 @@
 """Portparser v2 - A parsing model for Brazilian Portuguese."""
 
-from portparser_v2.core import parse, parse_text, parse_file
+from portparser_v2.core import Parser, parse, parse_text, parse_file, parse_stream
+from portparser_v2.batching import parse_async
+from portparser_v2.cache import SentenceCache
 
 __version__ = "0.1.0"
-__all__ = ["parse", "parse_text", "parse_file"]
+__all__ = ["Parser", "parse", "parse_text", "parse_file", "parse_stream", "parse_async", "SentenceCache"]
 
@@ -0,0 +1,140 @@
+"""
+Portparser v2 Micro-Batching
+
+Callers that parse one or two sentences at a time waste most of a forward pass
+on batches of one. This module runs the model in a single worker thread that
+coalesces the tokenized sentences of concurrent requests into shared batches
+(bounded by a maximum batch size and a maximum wait), and scatters the
+predicted sentences back to each caller.
+"""
+
+import asyncio
+import queue
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import Future
+from typing import Optional
+
+from portparser_v2.core import Parser, download_model, get_parser, split_conllu_sentences, tokenize_sentences
+
+
+# Longest time a request waits for others to share its batch, in seconds
+DEFAULT_MAX_WAIT = 0.005
+
+
+class MicroBatcher:
+    """
+    Single model worker that merges concurrent requests into shared batches.
+
+    Requests are tokenized CoNLL-U contents. The worker waits at most max_wait
+    seconds after the first pending request for more requests, until
+    max_batch_size sentences are collected, then predicts all of them at once.
+    """
+
+    def __init__(self, predict: Callable[[str], str], max_batch_size: int, max_wait: float = DEFAULT_MAX_WAIT):
+        """
+        Start the model worker.
+
+        Args:
+            predict: Prediction stage, run in the worker thread (e.g. Parser.predict)
+            max_batch_size: Maximum number of sentences predicted at once
+            max_wait: Maximum time in seconds a request waits for others to join its batch
+        """
+        self._predict = predict
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="portparser-model", daemon=True)
+        self._thread.start()
+
+    def submit(self, conllu: str) -> Future:
+        """Queue tokenized CoNLL-U content for prediction, returning a future of the predicted content."""
+        future: Future = Future()
+        sentences = len(split_conllu_sentences(conllu))
+        if not sentences:
+            future.set_result("")
+        else:
+            self._queue.put((conllu, sentences, future))
+        return future
+
+    def close(self) -> None:
+        """Stop the worker once the already queued requests are predicted."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+            requests, sentences = [request], request[1]
+
+            # Collect more requests until the batch is full or the wait is over
+            deadline = time.monotonic() + self._max_wait
+            while sentences < self._max_batch_size:
+                try:
+                    request = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    self._queue.put(None)
+                    break
+                requests.append(request)
+                sentences += request[1]
+
+            self._predict_batch(requests)
+
+    def _predict_batch(self, requests: list[tuple[str, int, Future]]) -> None:
+        try:
+            predicted = split_conllu_sentences(self._predict("".join(conllu for conllu, _, _ in requests)))
+        except Exception as e:
+            for _, _, future in requests:
+                future.set_exception(e)
+            return
+
+        # Scatter the predicted sentences back to their requests
+        start = 0
+        for _, sentences, future in requests:
+            future.set_result("".join(predicted[start:start + sentences]))
+            start += sentences
+
+
+# Batchers shared by parse_async, keyed by model path
+_batchers: dict[str, tuple[Parser, MicroBatcher]] = {}
+_batchers_lock = threading.Lock()
+
+
+def get_batcher(model_path: Optional[str] = None) -> tuple[Parser, MicroBatcher]:
+    """Return the shared Parser and MicroBatcher for the given model, loading it on first use."""
+    if model_path is None:
+        model_path = download_model()
+    with _batchers_lock:
+        if model_path not in _batchers:
+            parser = get_parser(model_path)
+            _batchers[model_path] = parser, MicroBatcher(parser.predict, parser.args.batch_size)
+        return _batchers[model_path]
+
+
+async def parse_async(text: str, segment: bool = True, model_path: Optional[str] = None) -> str:
+    """
+    Parse text without blocking the event loop - returns the CoNLL-U content.
+
+    Sentences of concurrent calls are predicted together in shared batches by a
+    single model worker; sentencing, tokenization and postprocessing run in
+    threads of the default executor.
+
+    Args:
+        text: Input text to parse
+        segment: Whether to segment sentences (default True for raw text)
+        model_path: Optional path to model weights. If None, downloads from HuggingFace.
+
+    Returns:
+        Parsed CoNLL-U content as string
+    """
+    parser, batcher = await asyncio.to_thread(get_batcher, model_path)
+
+    conllu_content = await asyncio.to_thread(
+        lambda: tokenize_sentences(parser.split_sentences(text, segment)))
+    predicted_content = await asyncio.wrap_future(batcher.submit(conllu_content))
+    return await asyncio.to_thread(parser.postprocess, predicted_content)
@@ -0,0 +1,172 @@
+"""
+Portparser v2 Sentence Cache
+
+Content-addressed cache of predicted sentences. A sentence is identified by a
+hash of its tokenized CoNLL-U (which covers the sentence text and the result
+of the tokenizer options) and of the model identity, ignoring its sentence ID.
+Cached sentences skip the model entirely and only get their sentence ID
+rewritten.
+
+The cache has an in-process LRU tier and an optional persistent tier in a
+SQLite database, both evicting their least recently used entries once they
+exceed a size budget.
+"""
+
+import collections
+import hashlib
+import sqlite3
+import threading
+import time
+from collections.abc import Callable
+from typing import Optional
+
+from portparser_v2.core import split_conllu_sentences
+
+
+# Size budgets of the cache tiers, in characters of cached CoNLL-U
+DEFAULT_MEMORY_SIZE = 64 * 1024 * 1024
+DEFAULT_DISK_SIZE = 1024 * 1024 * 1024
+
+SENT_ID_PREFIX = "# sent_id = "
+
+
+def _split_sent_id(sentence: str) -> tuple[str, str]:
+    """Split a CoNLL-U sentence into its sentence ID line and the remaining lines."""
+    lines = sentence.split("\n")
+    for i, line in enumerate(lines):
+        if line.startswith(SENT_ID_PREFIX):
+            return line + "\n", "\n".join(lines[:i] + lines[i + 1:])
+    return "", sentence
+
+
+class SentenceCache:
+    """
+    Two-tier cache of predicted sentences.
+
+    The hits and misses counters count the sentences looked up through
+    predict; disk_hits counts the lookups served by the SQLite tier.
+    """
+
+    def __init__(
+        self,
+        memory_size: int = DEFAULT_MEMORY_SIZE,
+        path: Optional[str] = None,
+        disk_size: int = DEFAULT_DISK_SIZE,
+    ):
+        """
+        Create the cache.
+
+        Args:
+            memory_size: Maximum size of the in-process tier, in characters
+            path: Optional path to the SQLite database of the persistent tier.
+                If None, only the in-process tier is used.
+            disk_size: Maximum size of the persistent tier, in characters
+        """
+        self._memory: collections.OrderedDict[str, str] = collections.OrderedDict()
+        self._memory_size = memory_size
+        self._memory_used = 0
+        self._disk_size = disk_size
+        self._lock = threading.Lock()
+        self.hits, self.disk_hits, self.misses = 0, 0, 0
+
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS sentences "
+                             "(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS sentences_used ON sentences (used)")
+            self._db.commit()
+            self._disk_used = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM sentences").fetchone()[0]
+
+    @staticmethod
+    def key(sentence: str, model_id: str) -> str:
+        """Return the cache key of a tokenized CoNLL-U sentence for the given model."""
+        _, content = _split_sent_id(sentence)
+        return hashlib.sha256(f"{model_id}\n{content}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached value of a key, or None if absent."""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+            if self._db is None:
+                return None
+            row = self._db.execute("SELECT value FROM sentences WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE sentences SET used = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            self.disk_hits += 1
+            self._put_memory(key, row[0])
+            return row[0]
+
+    def put(self, key: str, value: str) -> None:
+        """Store a value in both tiers, evicting the least recently used entries if needed."""
+        with self._lock:
+            self._put_memory(key, value)
+            if self._db is None:
+                return
+            previous = self._db.execute("SELECT size FROM sentences WHERE key = ?", (key,)).fetchone()
+            self._disk_used += len(value) - (previous[0] if previous else 0)
+            self._db.execute("INSERT OR REPLACE INTO sentences VALUES (?, ?, ?, ?)", (key, value, len(value), time.time()))
+            while self._disk_used > self._disk_size:
+                oldest = self._db.execute("SELECT key, size FROM sentences ORDER BY used LIMIT 1").fetchone()
+                if oldest is None:
+                    break
+                self._db.execute("DELETE FROM sentences WHERE key = ?", (oldest[0],))
+                self._disk_used -= oldest[1]
+            self._db.commit()
+
+    def _put_memory(self, key: str, value: str) -> None:
+        if key in self._memory:
+            self._memory_used -= len(self._memory.pop(key))
+        self._memory[key] = value
+        self._memory_used += len(value)
+        while self._memory_used > self._memory_size and self._memory:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_used -= len(evicted)
+
+    def stats(self) -> dict[str, int]:
+        """Return the hit and miss counters."""
+        return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses}
+
+    def close(self) -> None:
+        """Close the persistent tier."""
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def predict(self, conllu: str, predict: Callable[[str], str], model_id: str) -> str:
+        """
+        Predict tokenized CoNLL-U content, running only uncached sentences through predict.
+
+        Args:
+            conllu: Tokenized CoNLL-U content
+            predict: Prediction stage for the uncached sentences (e.g. the model)
+            model_id: Identity of the model behind predict
+
+        Returns:
+            Predicted CoNLL-U content, with the sentence IDs of the input
+        """
+        sentences = split_conllu_sentences(conllu)
+        keys = [self.key(sentence, model_id) for sentence in sentences]
+        predicted: list[Optional[str]] = [None] * len(sentences)
+
+        missing = []
+        for i, key in enumerate(keys):
+            cached = self.get(key)
+            if cached is None:
+                missing.append(i)
+            else:
+                predicted[i] = _split_sent_id(sentences[i])[0] + cached
+        with self._lock:
+            self.hits += len(sentences) - len(missing)
+            self.misses += len(missing)
+
+        if missing:
+            for i, sentence in zip(missing, split_conllu_sentences(predict("".join(sentences[i] for i in missing)))):
+                predicted[i] = sentence
+                self.put(keys[i], _split_sent_id(sentence)[1])
+
+        return "".join(predicted)
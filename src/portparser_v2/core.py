@@ -6,16 +6,25 @@ It orchestrates: sentencing -> tokenization -> prediction -> postprocessing.
 """
 
 import os
+import sys
+import json
+import argparse
 import datetime
 import random
+import itertools
+import warnings
+from collections.abc import Iterable, Iterator
 from pathlib import Path
 from tempfile import mkdtemp
-from typing import Optional
+from typing import Optional, TYPE_CHECKING
 
 from huggingface_hub import hf_hub_download
 
-from portparser_v2.portSent import stripSents
-from portparser_v2.portTok import processSentences
+from portparser_v2.portSent import stripSents, streamSents
+from portparser_v2.portTok import processSentences, nextName
+
+if TYPE_CHECKING:
+    from portparser_v2.cache import SentenceCache
 
 
 # Default model repository
@@ -23,8 +32,17 @@ DEFAULT_MODEL_REPO = "lucelene/Portparser.v2-latinpipe-core"
 
 # Paths relative to project root
 SCRIPT_DIR = Path(__file__).parent
-PARSER_SCRIPT = SCRIPT_DIR.parent / "evalatin2024-latinpipe" / "latinpipe_evalatin24.py"
-POSTPROC_SCRIPT = SCRIPT_DIR.parent / "postproc" / "postprocess.py"
+LATINPIPE_DIR = SCRIPT_DIR.parent / "evalatin2024-latinpipe"
+POSTPROC_DIR = SCRIPT_DIR.parent / "postproc"
+
+# Sentences run through the pipeline at once when streaming. Batches are formed
+# by subword length within each window, so they differ from those of a whole-file
+# parse; the output does not depend on them, which test_parse_alienista_stream
+# checks with windows of 32 sentences.
+DEFAULT_WINDOW_SIZE = 1024
+
+# Options stored with a trained model that must not override inference settings
+_IGNORED_MODEL_OPTIONS = ["dev", "exp", "load", "test", "threads", "verbose"]
 
 
 def _generate_code() -> str:
@@ -45,19 +63,391 @@ def download_model(repo_id: str = DEFAULT_MODEL_REPO) -> str:
     return model_weights
 
 
+def _output_path(output_path: Optional[str], work_dir: Optional[str]) -> str:
+    """Return the final CoNLL-U path, inventing one in work_dir (or a temp dir) if needed."""
+    if output_path is not None:
+        return output_path
+    if work_dir is None:
+        work_dir = mkdtemp()
+    else:
+        os.makedirs(work_dir, exist_ok=True)
+    return os.path.join(work_dir, f"{_generate_code()}_parsed.conllu")
+
+
+def _iter_lines(chunks: Iterable[str]) -> Iterator[str]:
+    """Regroup text chunks of arbitrary sizes into lines, without the line breaks."""
+    pending: list[str] = []
+    for chunk in chunks:
+        lines = chunk.split("\n")
+        if len(lines) == 1:
+            pending.append(chunk)
+            continue
+        pending.append(lines[0])
+        yield "".join(pending)
+        yield from lines[1:-1]
+        pending = [lines[-1]]
+    last = "".join(pending)
+    if last:
+        yield last
+
+
+def _sentence_windows(sentences: Iterable[str], window_size: int) -> Iterator[tuple[list[str], str]]:
+    """Group sentences into windows, each with the sentence ID model to start from."""
+    sid = "S000000"
+    for window in itertools.batched(sentences, window_size):
+        yield list(window), sid
+        for _ in window:
+            sid = nextName(sid)
+
+
+def split_conllu_sentences(conllu: str) -> list[str]:
+    """Split CoNLL-U content into sentences, each ending with its blank line."""
+    return [block + "\n\n" for block in conllu.split("\n\n") if block.strip("\n")]
+
+
+# Inference options of the LatinPipe arguments that change the predictions of the same weights
+_PREDICTION_OPTIONS = ["backend", "compile", "precision", "quantize"]
+
+
+def _model_identity(model_path: str, args: argparse.Namespace) -> str:
+    """Identify a model by the resolved path, size and mtime of its weights and its inference options."""
+    stat = os.stat(model_path)
+    options = ",".join(f"{option}={getattr(args, option)}" for option in _PREDICTION_OPTIONS)
+    return f"{os.path.realpath(model_path)}:{stat.st_size}:{stat.st_mtime_ns}:{options}"
+
+
 def tokenize_sentences(sentences: list[str], start_id: str = "S000000") -> str:
     """Tokenize sentences into CoNLL-U format."""
     return processSentences(sentences, sid_start=start_id, preserve=True, match=True, trim=False)
 
 
+def _import_postprocess():
+    """Import the postprocessing module, which lives outside the package."""
+    if str(POSTPROC_DIR) not in sys.path:
+        sys.path.insert(0, str(POSTPROC_DIR))
+    import postprocess
+    return postprocess
+
+
+def _import_stage_modules(backend: Optional[str] = None):
+    """
+    Import the LatinPipe and postprocessing modules, which live outside the package.
+
+    The torch backend uses the keras-free LatinPipe runtime, so keras is not imported.
+    """
+    if str(LATINPIPE_DIR) not in sys.path:
+        sys.path.insert(0, str(LATINPIPE_DIR))
+    if backend == "torch":
+        import latinpipe_evalatin24_torch as latinpipe_evalatin24
+    else:
+        import latinpipe_evalatin24
+    return latinpipe_evalatin24, _import_postprocess()
+
+
+def postprocess_conllu(conllu: str, usual_abbr: list) -> str:
+    """Fix lemmas and features of predicted CoNLL-U content."""
+    postprocess = _import_postprocess()
+    from conlluFile import ConlluFile
+
+    return postprocess.fixLemmaFeatures(ConlluFile(text=conllu), usual_abbr).output
+
+
+class Parser:
+    """
+    In-process parsing pipeline that keeps the LatinPipe model loaded.
+
+    The model, its transformer tokenizer and the training mappings are built
+    once in the constructor; every call then runs sentencing, tokenization,
+    prediction and postprocessing in the current process.
+    """
+
+    def __init__(self, model_path: Optional[str] = None, threads: Optional[int] = None,
+                 cache: Optional["SentenceCache"] = None, batch_tokens: Optional[int] = None,
+                 quantize: Optional[str] = None, precision: Optional[str] = None,
+                 backend: Optional[str] = None, compile: bool = False,
+                 decoding_processes: Optional[int] = None):
+        """
+        Load the model.
+
+        Args:
+            model_path: Optional path to model weights. If None, downloads from HuggingFace.
+            threads: Optional number of torch threads. If None, keeps the torch default.
+            cache: Optional SentenceCache; cached sentences skip the model.
+            batch_tokens: Optional maximum of padded subwords per inference batch. If None,
+                batches have the batch size of the trained model.
+            quantize: Optional quantization of the loaded model for faster CPU inference
+                ("int8"). If None, the model runs in full precision.
+            precision: Optional inference precision; "bf16" runs the network under bfloat16
+                autocast on CPU, while the final log-softmax and tree decoding stay in full
+                precision. If None, the model runs in fp32.
+            backend: Optional inference backend; "onnx" runs the model.onnx exported next to
+                the weights with onnxruntime, "torch" a keras-free PyTorch mirror of the model.
+                If None, the Keras model is used.
+            compile: Whether to compile the network of the torch backend with torch.compile,
+                warming it up for padded length buckets when loading.
+            decoding_processes: Optional number of processes running the maximum spanning
+                tree decoding of the sentences whose greedy heads do not form a tree, in
+                parallel with the network. If None, these are decoded in-process.
+        """
+        if model_path is None:
+            model_path = download_model()
+        self.model_path = model_path
+        self.cache = cache
+
+        self._latinpipe, self._postprocess = _import_stage_modules(backend)
+
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+            torch.set_num_interop_threads(threads)
+
+        # Load the configuration of the trained model, as `latinpipe_evalatin24.main` does
+        model_dir = os.path.dirname(model_path)
+        with open(os.path.join(model_dir, "options.json"), "r") as options_file:
+            args = argparse.Namespace(**{k: v for k, v in json.load(options_file).items()
+                                         if k not in _IGNORED_MODEL_OPTIONS})
+        self.args = self._latinpipe.parser.parse_args([], namespace=args)
+        self.args.load = [model_path]
+        if batch_tokens:
+            self.args.batch_tokens = batch_tokens
+        if quantize:
+            self.args.quantize = quantize
+        if precision:
+            self.args.precision = precision
+        if backend:
+            self.args.backend = backend
+        if compile:
+            if self.args.backend != "torch":
+                raise ValueError("Compilation requires the torch backend")
+            self.args.compile = 1
+        if decoding_processes:
+            self.args.decoding_processes = decoding_processes
+        self.args.threads = threads or 0
+        self.model_id = _model_identity(model_path, self.args)
+
+        self._train = self._latinpipe.UDDataset.from_mappings(os.path.join(model_dir, "mappings.pkl"))
+        if self.args.backend == "onnx":
+            self._model = self._latinpipe.LatinPipeModelONNX(self._train, self.args)
+        elif self.args.backend == "torch":
+            self._model = self._latinpipe.LatinPipeModelTorch(self._train, self.args)
+        else:
+            self._model = self._latinpipe.LatinPipeModel(self._train, self.args)
+        self._usual_abbr = self._postprocess.getUsualAbbr()
+
+    def split_sentences(self, text: str, segment: bool) -> list[str]:
+        """Segment raw text into sentences, or take one sentence per line."""
+        if segment:
+            return stripSents(text)
+        return [line for line in text.split('\n') if line.strip()]
+
+    def stream_sentences(self, chunks: Iterable[str], segment: bool) -> Iterator[str]:
+        """Lazily segment text chunks into sentences, or take one sentence per line."""
+        lines = _iter_lines(chunks)
+        if segment:
+            return streamSents(lines)
+        return (line for line in lines if line.strip())
+
+    def predict(self, conllu: str) -> str:
+        """Run the model on tokenized CoNLL-U content and return the predicted CoNLL-U."""
+        if self.cache is not None:
+            return self.cache.predict(conllu, self._predict, self.model_id)
+        return self._predict(conllu)
+
+    def _predict(self, conllu: str) -> str:
+        dataset = self._latinpipe.UDDataset("<input>", self.args, text=conllu, train_dataset=self._train)
+        dataloader = self._latinpipe.TorchUDDataLoader(self._latinpipe.TorchUDDataset(
+            dataset, self._model.tokenizers, self.args, training=False), self.args)
+        return self._model.predict(dataloader)
+
+    def postprocess(self, conllu: str) -> str:
+        """Fix lemmas and features of predicted CoNLL-U content."""
+        return postprocess_conllu(conllu, self._usual_abbr)
+
+    def parse(self, text: str, segment: bool = True) -> str:
+        """
+        Parse text entirely in memory - returns the CoNLL-U content directly.
+
+        Args:
+            text: Input text to parse
+            segment: Whether to segment sentences (default True for raw text)
+
+        Returns:
+            Parsed CoNLL-U content as string
+        """
+        # Step 1: Sentence segmentation
+        sentences = self.split_sentences(text, segment)
+
+        # Step 2: Tokenization
+        conllu_content = tokenize_sentences(sentences)
+
+        # Step 3: Parsing/Prediction
+        predicted_content = self.predict(conllu_content)
+
+        # Step 4: Post-processing
+        return self.postprocess(predicted_content)
+
+    def parse_stream(
+        self,
+        chunks: Iterable[str],
+        segment: bool = True,
+        window_size: int = DEFAULT_WINDOW_SIZE,
+        workers: int = 0,
+    ) -> Iterator[str]:
+        """
+        Parse a stream of text with bounded memory - yields CoNLL-U content incrementally.
+
+        Sentences are run through tokenization, prediction and postprocessing in
+        windows of window_size sentences, so memory use does not grow with the input.
+
+        Args:
+            chunks: Input text in chunks of any size, e.g. an open file
+            segment: Whether to segment sentences (default True for raw text)
+            window_size: Number of sentences processed at once
+            workers: If nonzero, tokenize and postprocess in this many worker processes,
+                overlapping with the prediction of other windows (see pipeline.run_pipelined)
+
+        Returns:
+            Iterator over the parsed CoNLL-U content of each window
+        """
+        windows = _sentence_windows(self.stream_sentences(chunks, segment), window_size)
+        if workers:
+            from portparser_v2.pipeline import run_pipelined
+            yield from run_pipelined(self.predict, windows, workers)
+            return
+
+        for sentences, start_id in windows:
+            yield self.postprocess(self.predict(tokenize_sentences(sentences, start_id=start_id)))
+
+    def parse_text(
+        self,
+        text: str,
+        output_path: Optional[str] = None,
+        work_dir: Optional[str] = None,
+        segment_sentences: bool = False,
+    ) -> str:
+        """
+        Parse Brazilian Portuguese text through the full pipeline.
+
+        Intermediate results are handed between the stages in memory; only the
+        final CoNLL-U output is written to disk.
+
+        Args:
+            text: Input text to parse
+            output_path: Optional path for final CoNLL-U output. If None, uses temp file.
+            work_dir: Optional working directory for the output file. If None and no
+                output_path is given, creates temp dir.
+            segment_sentences: If True, run sentencer first. If False, assume one sentence per line.
+
+        Returns:
+            Path to the final parsed CoNLL-U file
+        """
+        output_path = _output_path(output_path, work_dir)
+        conllu_content = self.parse(text, segment=segment_sentences)
+        with open(output_path, "w", encoding="utf-8") as f:
+            f.write(conllu_content)
+
+        return output_path
+
+    def parse_file(
+        self,
+        input_path: str,
+        output_path: Optional[str] = None,
+        work_dir: Optional[str] = None,
+        segment_sentences: bool = False,
+        stream: bool = False,
+        workers: int = 0,
+    ) -> str:
+        """
+        Parse Brazilian Portuguese text from a file through the full pipeline.
+
+        Args:
+            input_path: Path to input text file
+            output_path: Optional path for final CoNLL-U output. If None, uses temp file.
+            work_dir: Optional working directory for the output file. If None and no
+                output_path is given, creates temp dir.
+            segment_sentences: If True, run sentencer first. If False, assume one sentence per line.
+            stream: If True, read, parse and write the file in windows of sentences
+                (see parse_stream) instead of loading it whole.
+            workers: With stream, number of worker processes for tokenization and
+                postprocessing (0 runs every stage in the current process).
+
+        Returns:
+            Path to the final parsed CoNLL-U file
+        """
+        if stream:
+            output_path = _output_path(output_path, work_dir)
+            with open(input_path, "r", encoding="utf-8") as f, open(output_path, "w", encoding="utf-8") as output:
+                for conllu_content in self.parse_stream(f, segment=segment_sentences, workers=workers):
+                    output.write(conllu_content)
+            return output_path
+
+        with open(input_path, "r", encoding="utf-8") as f:
+            text = f.read()
+
+        return self.parse_text(
+            text=text,
+            output_path=output_path,
+            work_dir=work_dir,
+            segment_sentences=segment_sentences,
+        )
+
+
+# Parsers shared by the module-level functions, keyed by model path
+_parsers: dict[str, Parser] = {}
+
+
+def get_parser(model_path: Optional[str] = None) -> Parser:
+    """Return a shared Parser for the given model, loading it on first use."""
+    if model_path is None:
+        model_path = download_model()
+    if model_path not in _parsers:
+        _parsers[model_path] = Parser(model_path)
+    return _parsers[model_path]
+
+
 def run_parser(input_path: str, output_dir: str, model_path: str) -> int:
-    cmd = f"python {PARSER_SCRIPT} --load {model_path} --exp {output_dir} --test {input_path}"
-    return os.system(cmd)
+    """
+    Predict a tokenized CoNLL-U file, as the LatinPipe script called by earlier versions did.
+
+    Deprecated: use Parser.predict, which keeps the model loaded between calls.
+
+    Args:
+        input_path: Path to the tokenized CoNLL-U input
+        output_dir: Directory for the `<input name>.predicted.conllu` output
+        model_path: Path to model weights
+
+    Returns:
+        0, the exit code of the successful script
+    """
+    warnings.warn("run_parser is deprecated, use Parser.predict", DeprecationWarning, stacklevel=2)
+    with open(input_path, "r", encoding="utf-8") as f:
+        predicted = get_parser(model_path).predict(f.read())
+    os.makedirs(output_dir, exist_ok=True)
+    name = os.path.splitext(os.path.basename(input_path))[0]
+    with open(os.path.join(output_dir, f"{name}.predicted.conllu"), "w", encoding="utf-8") as f:
+        f.write(predicted)
+    return 0
 
 
 def run_postprocessor(input_path: str, output_path: str) -> int:
-    cmd = f"python {POSTPROC_SCRIPT} -o {output_path} {input_path}"
-    return os.system(cmd)
+    """
+    Postprocess a predicted CoNLL-U file, as the postprocessing script called by earlier versions did.
+
+    Deprecated: use Parser.postprocess or postprocess_conllu.
+
+    Args:
+        input_path: Path to the predicted CoNLL-U input
+        output_path: Path for the postprocessed CoNLL-U output
+
+    Returns:
+        0, the exit code of the successful script
+    """
+    warnings.warn("run_postprocessor is deprecated, use Parser.postprocess", DeprecationWarning, stacklevel=2)
+    with open(input_path, "r", encoding="utf-8") as f:
+        conllu = f.read()
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.write(postprocess_conllu(conllu, _import_postprocess().getUsualAbbr()))
+    return 0
 
 
 def parse_text(
@@ -73,50 +463,20 @@ def parse_text(
     Args:
         text: Input text to parse
         output_path: Optional path for final CoNLL-U output. If None, uses temp file.
-        work_dir: Optional working directory for temp files. If None, creates temp dir.
+        work_dir: Optional working directory for the output file. If None and no
+            output_path is given, creates temp dir.
         model_path: Optional path to model weights. If None, downloads from HuggingFace.
         segment_sentences: If True, run sentencer first. If False, assume one sentence per line.
 
     Returns:
         Path to the final parsed CoNLL-U file
     """
-    # Setup directories
-    if work_dir is None:
-        work_dir = mkdtemp()
-    else:
-        os.makedirs(work_dir, exist_ok=True)
-
-    code = _generate_code()
-
-    # Define file paths
-    path_empty_conllu = os.path.join(work_dir, f"{code}_input.conllu")
-    path_predicted_conllu = os.path.join(work_dir, f"{code}_input.predicted.conllu")
-    path_final_conllu = output_path or os.path.join(work_dir, f"{code}_parsed.conllu")
-
-    # Download model if needed
-    if model_path is None:
-        model_path = download_model()
-
-    # Step 1: Sentence segmentation
-    if segment_sentences:
-        sentences = stripSents(text)
-    else:
-        sentences = [line for line in text.split('\n') if line.strip()]
-
-    # Step 2: Tokenization
-    conllu_content = tokenize_sentences(sentences)
-
-    # Write tokenized output to file for parser
-    with open(path_empty_conllu, "w", encoding="utf-8") as f:
-        f.write(conllu_content)
-
-    # Step 3: Parsing/Prediction
-    run_parser(path_empty_conllu, work_dir, model_path)
-
-    # Step 4: Post-processing
-    run_postprocessor(path_predicted_conllu, path_final_conllu)
-
-    return path_final_conllu
+    return get_parser(model_path).parse_text(
+        text=text,
+        output_path=output_path,
+        work_dir=work_dir,
+        segment_sentences=segment_sentences,
+    )
 
 
 def parse_file(
@@ -125,6 +485,8 @@ def parse_file(
     work_dir: Optional[str] = None,
     model_path: Optional[str] = None,
     segment_sentences: bool = False,
+    stream: bool = False,
+    workers: int = 0,
 ) -> str:
     """
     Parse Brazilian Portuguese text from a file through the full pipeline.
@@ -132,25 +494,52 @@ def parse_file(
     Args:
         input_path: Path to input text file
         output_path: Optional path for final CoNLL-U output. If None, uses temp file.
-        work_dir: Optional working directory for temp files. If None, creates temp dir.
+        work_dir: Optional working directory for the output file. If None and no
+            output_path is given, creates temp dir.
         model_path: Optional path to model weights. If None, downloads from HuggingFace.
         segment_sentences: If True, run sentencer first. If False, assume one sentence per line.
+        stream: If True, read, parse and write the file in windows of sentences
+            (see parse_stream) instead of loading it whole.
+        workers: With stream, number of worker processes for tokenization and
+            postprocessing (0 runs every stage in the current process).
 
     Returns:
         Path to the final parsed CoNLL-U file
     """
-    with open(input_path, "r", encoding="utf-8") as f:
-        text = f.read()
-
-    return parse_text(
-        text=text,
+    return get_parser(model_path).parse_file(
+        input_path=input_path,
         output_path=output_path,
         work_dir=work_dir,
-        model_path=model_path,
         segment_sentences=segment_sentences,
+        stream=stream,
+        workers=workers,
     )
 
 
+def parse_stream(
+    chunks: Iterable[str],
+    segment: bool = True,
+    model_path: Optional[str] = None,
+    window_size: int = DEFAULT_WINDOW_SIZE,
+    workers: int = 0,
+) -> Iterator[str]:
+    """
+    Parse a stream of text with bounded memory - yields CoNLL-U content incrementally.
+
+    Args:
+        chunks: Input text in chunks of any size, e.g. an open file
+        segment: Whether to segment sentences (default True for raw text)
+        model_path: Optional path to model weights. If None, downloads from HuggingFace.
+        window_size: Number of sentences processed at once
+        workers: If nonzero, tokenize and postprocess in this many worker processes,
+            overlapping with the prediction of other windows
+
+    Returns:
+        Iterator over the parsed CoNLL-U content of each window
+    """
+    return get_parser(model_path).parse_stream(chunks, segment=segment, window_size=window_size, workers=workers)
+
+
 # Convenience function for quick parsing
 def parse(text: str, segment: bool = True) -> str:
     """
@@ -163,9 +552,7 @@ def parse(text: str, segment: bool = True) -> str:
     Returns:
         Parsed CoNLL-U content as string
     """
-    output_path = parse_text(text, segment_sentences=segment)
-    with open(output_path, "r", encoding="utf-8") as f:
-        return f.read()
+    return get_parser().parse(text, segment=segment)
 
 if __name__ == "__main__":
     print("Enter text to parse:")
@@ -0,0 +1,76 @@
+"""
+Portparser v2 Overlapped Pipeline
+
+Tokenization and postprocessing are pure Python, while prediction spends its
+time inside torch. This module runs the pure-Python stages in worker processes
+and connects the stages with bounded queues of pending futures, so that the
+tokenization of window k+1 and the postprocessing of window k-1 overlap with
+the prediction of window k. Wall-clock time then approaches the slowest stage
+instead of the sum of all stages.
+"""
+
+import collections
+import multiprocessing
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+
+from portparser_v2.core import _import_postprocess, postprocess_conllu, tokenize_sentences
+
+
+# Windows queued ahead of (tokenization) and behind (postprocessing) the model
+DEFAULT_DEPTH = 2
+
+# Usual abbreviations, loaded once per worker process
+_usual_abbr: list | None = None
+
+
+def _postprocess_worker(conllu: str) -> str:
+    """Postprocess predicted CoNLL-U content in a worker process."""
+    global _usual_abbr
+    if _usual_abbr is None:
+        _usual_abbr = _import_postprocess().getUsualAbbr()
+    return postprocess_conllu(conllu, _usual_abbr)
+
+
+def run_pipelined(
+    predict: Callable[[str], str],
+    windows: Iterable[tuple[list[str], str]],
+    workers: int,
+    depth: int = DEFAULT_DEPTH,
+) -> Iterator[str]:
+    """
+    Run windows of sentences through the pipeline with overlapping stages.
+
+    Args:
+        predict: Prediction stage, run in the calling process (e.g. Parser.predict)
+        windows: Windows of sentences, each with the sentence ID model to start from
+        workers: Number of worker processes for tokenization and postprocessing
+        depth: Maximum number of windows queued before and after prediction
+
+    Returns:
+        Iterator over the parsed CoNLL-U content of each window, in input order
+    """
+    # Worker processes are spawned, as forking a process running torch is unsafe
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        windows = iter(windows)
+        tokenized, postprocessed = collections.deque(), collections.deque()
+
+        def tokenize_ahead() -> None:
+            while len(tokenized) < depth:
+                window = next(windows, None)
+                if window is None:
+                    return
+                sentences, start_id = window
+                tokenized.append(pool.submit(tokenize_sentences, sentences, start_id))
+
+        tokenize_ahead()
+        while tokenized:
+            conllu_content = tokenized.popleft().result()
+            tokenize_ahead()
+            postprocessed.append(pool.submit(_postprocess_worker, predict(conllu_content)))
+            while postprocessed and (postprocessed[0].done() or len(postprocessed) > depth):
+                yield postprocessed.popleft().result()
+
+        while postprocessed:
+            yield postprocessed.popleft().result()
@@ -25,6 +25,7 @@
 import logging
 import os
 import argparse
+from collections.abc import Iterable, Iterator
 
 from lexikon.abbrev import ends_with_abbreviation
 
@@ -104,30 +105,12 @@ def _clean_sentence(sent: str) -> str | None:
 
 
 #################################################
-### função stripSents - faz de fato o sentenciamento
+### função normalizeText - substitui caracteres e normaliza os espaços
 #################################################
-def stripSents(inputText: str, limit: int = 2048, replace: bool = True) -> list[str]:
-    """
-    Segment input text into sentences.
-    
-    Args:
-        inputText: The text to segment into sentences.
-        limit: Maximum characters per sentence, 0 for no limit.
-        replace: Whether to replace non-standard characters.
-    
-    Returns:
-        A list of sentences.
-    """
-    sentences: list[str] = []
-    
-    def add_sentence(sent: str) -> None:
-        """Clean and add sentence to the list if valid."""
-        cleaned = _clean_sentence(sent)
-        if cleaned is not None:
-            sentences.append(cleaned)
-    
+def _normalize_text(inputText: str, replace: bool = True) -> str:
+    """Replace non-standard characters and collapse the whitespace of a text."""
     if (replace):
-        replaceables = [[" ", " "], \
+        replaceables = [["\u00a0", " "], \
                         ["—", "-"], ["–", "-"], \
                         ['＂', '"'], \
                         ['“', '"'], ['”', '"'], \
@@ -146,66 +129,116 @@ def stripSents(inputText: str, limit: int = 2048, replace: bool = True) -> list[
         tmp = tmp.replace(r[0], r[1])
     while (tmp.find("  ") != -1):
         tmp = tmp.replace("  "," ")
-    if (tmp[0] == " "):
-        tmp = tmp[1:]
-    bagOfChunks = tmp.split(" ")
+    return tmp
+
+#################################################
+### função segmentChunks - decide os finais de sentença, chunk a chunk
+#################################################
+def _segment_chunks(chunks: Iterable[str], limit: int = 2048) -> Iterator[str]:
+    """
+    Group whitespace-separated chunks into sentences.
+
+    Each decision only looks one chunk ahead, so sentences are yielded as soon
+    as the chunk that follows them is known.
+    """
+    chunks = (chunk for chunk in chunks if chunk != "")
     sent = ""
-    if (bagOfChunks[-1] == ""):
-        bagOfChunks.pop()
-    for i in range(len(bagOfChunks)):
+    chunk = next(chunks, None)
+    while (chunk is not None):
+        following = next(chunks, None)
         # if it is the last chunk, it is the end of sentence
-        if (i == len(bagOfChunks)-1):
-            sent += " " + bagOfChunks[i]
-            add_sentence(sent[1:])
+        if (following is None):
+            sent += " " + chunk
+            cleaned = _clean_sentence(sent[1:])
+            if cleaned is not None:
+                yield cleaned
             break
-        chunk = bagOfChunks[i]
+        ends = False
         # if there is a limit and the chunk is greater than the limit, discard it
         if (limit != 0) and (len(chunk) > limit):
-            continue
+            pass
         # if there is a limit and it is reached, ends the sentence arbitrarily
         elif (limit != 0) and (len(sent) + len(chunk) > limit):
-            add_sentence(sent[1:])
+            cleaned = _clean_sentence(sent[1:])
+            if cleaned is not None:
+                yield cleaned
             sent = chunk
         # if the chunk is too short
-        elif (len(chunk) < 3) and (len(chunk) != 0):
+        elif (len(chunk) < 3):
             sent += " " + chunk
-        # if the chunk is empty
-        elif (len(chunk) == 0):
-            continue
         # ! ? or ... always mark an end of sentence
         elif (chunk[-3:] == "...") or (chunk[-1] == "!") or (chunk[-1] == "?"):
             sent += " " + chunk
-            add_sentence(sent[1:])
-            sent = ""
+            ends = True
         # a . : or ; followed by a lowercase chunk is not an end of sentence
-        elif ((chunk[-1] == ".") or (chunk[-1] == ":") or (chunk[-1] == ";")) and (bagOfChunks[i+1][0].islower()):
+        elif ((chunk[-1] == ".") or (chunk[-1] == ":") or (chunk[-1] == ";")) and (following[0].islower()):
             sent += " " + chunk
         # a : or ; not followed by a lowercase chunk is an end of sentence
-        elif ((chunk[-1] == ":") or (chunk[-1] == ";")) and (not bagOfChunks[i+1][0].islower()):
+        elif ((chunk[-1] == ":") or (chunk[-1] == ";")) and (not following[0].islower()):
             sent += " " + chunk
-            add_sentence(sent[1:])
-            sent = ""
+            ends = True
         # chunk ends with ! or ? followed by quotations that had appear before an odd number is an end of sentence
         elif (chunk[-2:] in ["!'", '!"', "?'", '?"']):
             sent += " " + chunk
-            add_sentence(sent[1:])
-            sent = ""
+            ends = True
         elif (chunk[-2:] in [".'", '."']):
             sent += " " + chunk
-            if not ends_with_abbreviation(chunk[:-1]):
-                add_sentence(sent[1:])
-                sent = ""
+            ends = not ends_with_abbreviation(chunk[:-1])
         # a chunk not ending with ! ? ... ; : or . is not an end of sentence
         elif (chunk[-1] != "."):
             sent += " " + chunk
         # chunk ending by . is either a know abbreviation (not an end of sentence), or an end of sentence
         elif (chunk[-1] == "."):
             sent += " " + chunk
-            if not ends_with_abbreviation(chunk):
-                add_sentence(sent[1:])
-                sent = ""
+            ends = not ends_with_abbreviation(chunk)
+        if (ends):
+            cleaned = _clean_sentence(sent[1:])
+            if cleaned is not None:
+                yield cleaned
+            sent = ""
+        chunk = following
+
+#################################################
+### função stripSents - faz de fato o sentenciamento
+#################################################
+def stripSents(inputText: str, limit: int = 2048, replace: bool = True) -> list[str]:
+    """
+    Segment input text into sentences.
+    
+    Args:
+        inputText: The text to segment into sentences.
+        limit: Maximum characters per sentence, 0 for no limit.
+        replace: Whether to replace non-standard characters.
     
-    return sentences
+    Returns:
+        A list of sentences.
+    """
+    return list(_segment_chunks(_normalize_text(inputText, replace).split(" "), limit))
+
+#################################################
+### função streamSents - sentenciamento incremental, linha a linha
+#################################################
+def streamSents(lines: Iterable[str], limit: int = 2048, replace: bool = True) -> Iterator[str]:
+    """
+    Segment text read line by line into sentences, lazily.
+
+    Only the current sentence is kept in memory, so arbitrarily large inputs
+    (e.g. an open file) can be segmented. Characters are replaced line by line,
+    which only differs from `stripSents` for replacements spanning a line break.
+
+    Args:
+        lines: The lines of text to segment, with or without line breaks.
+        limit: Maximum characters per sentence, 0 for no limit.
+        replace: Whether to replace non-standard characters.
+
+    Returns:
+        An iterator over the sentences.
+    """
+    def chunks() -> Iterator[str]:
+        for line in lines:
+            yield from _normalize_text(line, replace).split(" ")
+
+    return _segment_chunks(chunks(), limit)
 
 #################################################
 ### função principal do programa - busca argumentos e chama 'stripSents' que faz de fato o sentenciamento
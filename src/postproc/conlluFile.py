@@ -5,6 +5,7 @@
 # member functions:
 #    conlluFile - the constructor from an input conllu file (name) - default no name creates an empty base
 #                                                                  - default considering contracted word (skipAg=True if not)
+#                                                                  - or from a CoNLL-U string (text) without touching the disk
 # Acessors
 #    getBase(self):              # return the whole base
 #    getHeader(self):            # return in a single string the initial lines of the conllu
@@ -44,19 +45,21 @@
     ##   each token line has 10 elements of the CoNLL-U format, plus one place holder for information
     ## b[5] status of change (a place holder for information)
 
+import io
+
 
 class ConlluFile:
-    def __init__(self, name="", skipAg=False):   # create a base from an input conllu file (name) considering contracted word or not (skipAg)
+    def __init__(self, name="", skipAg=False, text=None):   # create a base from an input conllu file (name) or string (text) considering contracted word or not (skipAg)
         # Instance variables:
         #   self.base      - the whole base
         #   self.header    - the first lines before the actual sentences
         #   self.s         - the total number of sentences
         #   self.t         - the total number of tokens
         self.base = []
-        if (name == ""):
+        if (name == "") and (text is None):
             self.header, self.s, self.t = "", 0, 0
         else:
-            infile = open(name, "r")
+            infile = open(name, "r") if (text is None) else io.StringIO(text)
             self.s, self.t = 0, 0
             SID = "HEADER"
             self.header = ""
@@ -102,7 +105,7 @@ class ConlluFile:
                     else:
                         print("Duplicated SID:", SID)
                     SID = ""
-            if (SID != ""):
+            if (SID != "") and (SID != "HEADER"):
                 if not (self.isSIDin(SID)):
                     self.base.append([SID,TEXT,tk,dumpHead,logiS])
                     self.s += 1
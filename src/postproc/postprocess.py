@@ -88,7 +88,7 @@ def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
 ### Function - read usual abbreviations
 #################################################
 def getUsualAbbr():
-    infile = open("./src/postproc/usAbbr.tsv", "r")
+    infile = open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "usAbbr.tsv"), "r")
     abbr = []
     for line in infile:
         if (line[0] == "#"):
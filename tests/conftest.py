@@ -0,0 +1,53 @@
+"""Shared fixtures for the portparser_v2 tests."""
+
+import os
+import sys
+import threading
+from pathlib import Path
+from typing import Callable
+
+import pytest
+
+# Add src to path so we can import portparser_v2, and the LatinPipe scripts, which run keras on torch
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+sys.path.insert(0, str(Path(__file__).parent.parent / "src" / "evalatin2024-latinpipe"))
+os.environ.setdefault("KERAS_BACKEND", "torch")
+
+from portparser_v2.core import split_conllu_sentences
+
+
+class FakePredict:
+    """Fake prediction stage that tags every word as NOUN and records the sentences of each call."""
+
+    def __init__(self, release: threading.Event | None = None):
+        self.calls: list[int] = []
+        self.entered = threading.Event()
+        self._release = release
+
+    def __call__(self, conllu: str) -> str:
+        self.entered.set()
+        if self._release is not None:
+            self._release.wait()
+        self.calls.append(len(split_conllu_sentences(conllu)))
+        return self.tag(conllu)
+
+    @staticmethod
+    def tag(conllu: str) -> str:
+        """The prediction of the given CoNLL-U content."""
+        return conllu.replace("\t_\t_\t_\t_\t_\t_\t_\t_\n", "\t_\tNOUN\t_\t_\t0\troot\t_\t_\n")
+
+
+@pytest.fixture
+def make_conllu() -> Callable[..., str]:
+    """Build tokenized CoNLL-U content with one single-word sentence per word."""
+    def make_conllu(*words: str, start: int = 1) -> str:
+        return "".join(
+            f"# sent_id = S{start + i:06d}\n# text = {word}\n1\t{word}\t_\t_\t_\t_\t_\t_\t_\t_\n\n"
+            for i, word in enumerate(words))
+    return make_conllu
+
+
+@pytest.fixture
+def fake_predict() -> type[FakePredict]:
+    """Factory of fake prediction stages, blocked until `release` is set if given."""
+    return FakePredict
@@ -0,0 +1,105 @@
+"""Tests for batching.py cross-call micro-batching."""
+
+import asyncio
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+# Add src to path so we can import portparser_v2
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from portparser_v2.batching import MicroBatcher, split_conllu_sentences
+
+
+class TestSplitConlluSentences:
+    """Test the split_conllu_sentences function."""
+
+    def test_splits_sentences(self, make_conllu):
+        """Each sentence keeps its blank line."""
+        assert split_conllu_sentences(make_conllu("a", "b")) == [make_conllu("a"), make_conllu("b", start=2)]
+
+    def test_empty(self):
+        """Empty or blank content has no sentences."""
+        assert split_conllu_sentences("") == []
+        assert split_conllu_sentences("\n") == []
+
+
+class TestMicroBatcher:
+    """Test the MicroBatcher model worker."""
+
+    def test_single_request(self, make_conllu, fake_predict):
+        """A lone request is predicted after the wait."""
+        predict = fake_predict()
+        batcher = MicroBatcher(predict, max_batch_size=32, max_wait=0.01)
+        assert batcher.submit(make_conllu("a", "b")).result(timeout=5) == fake_predict.tag(make_conllu("a", "b"))
+        batcher.close()
+        assert predict.calls == [2]
+
+    def test_coalesces_and_scatters(self, make_conllu, fake_predict):
+        """Pending requests share one prediction and get their own sentences back."""
+        release = threading.Event()
+        predict = fake_predict(release)
+        batcher = MicroBatcher(predict, max_batch_size=32, max_wait=0.01)
+
+        # The first request blocks the worker, so the next ones pile up
+        first = batcher.submit(make_conllu("a"))
+        predict.entered.wait(timeout=5)
+        futures = [batcher.submit(make_conllu(f"w{i}", f"x{i}")) for i in range(5)]
+        release.set()
+
+        assert first.result(timeout=5) == fake_predict.tag(make_conllu("a"))
+        for i, future in enumerate(futures):
+            assert future.result(timeout=5) == fake_predict.tag(make_conllu(f"w{i}", f"x{i}"))
+        batcher.close()
+        assert predict.calls == [1, 10]
+
+    def test_max_batch_size(self, make_conllu, fake_predict):
+        """Batches stop growing once max_batch_size sentences are collected."""
+        release = threading.Event()
+        predict = fake_predict(release)
+        batcher = MicroBatcher(predict, max_batch_size=4, max_wait=0.01)
+
+        first = batcher.submit(make_conllu("a"))
+        predict.entered.wait(timeout=5)
+        futures = [batcher.submit(make_conllu(f"w{i}", f"x{i}")) for i in range(4)]
+        release.set()
+
+        first.result(timeout=5)
+        for future in futures:
+            future.result(timeout=5)
+        batcher.close()
+        assert predict.calls == [1, 4, 4]
+
+    def test_empty_request(self, fake_predict):
+        """A request without sentences is answered without prediction."""
+        predict = fake_predict()
+        batcher = MicroBatcher(predict, max_batch_size=32)
+        assert batcher.submit("\n").result(timeout=5) == ""
+        batcher.close()
+        assert predict.calls == []
+
+    def test_exception_propagates(self, make_conllu):
+        """A failing prediction fails every request of the batch."""
+        def predict(conllu: str) -> str:
+            raise RuntimeError("model failure")
+
+        batcher = MicroBatcher(predict, max_batch_size=32)
+        with pytest.raises(RuntimeError, match="model failure"):
+            batcher.submit(make_conllu("a")).result(timeout=5)
+        batcher.close()
+
+    def test_awaitable(self, make_conllu, fake_predict):
+        """Futures can be awaited from many coroutines."""
+        predict = fake_predict()
+        batcher = MicroBatcher(predict, max_batch_size=32, max_wait=0.05)
+
+        async def main():
+            return await asyncio.gather(*(
+                asyncio.wrap_future(batcher.submit(make_conllu(f"w{i}"))) for i in range(8)))
+
+        results = asyncio.run(main())
+        batcher.close()
+        assert results == [fake_predict.tag(make_conllu(f"w{i}")) for i in range(8)]
+        assert predict.calls == [8]
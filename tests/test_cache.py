@@ -0,0 +1,78 @@
+"""Tests for cache.py sentence result cache."""
+
+import sys
+from pathlib import Path
+
+# Add src to path so we can import portparser_v2
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from portparser_v2.cache import SentenceCache
+
+
+class TestSentenceCache:
+    """Test the SentenceCache class."""
+
+    def test_miss_then_hit(self, make_conllu, fake_predict):
+        """A sentence is predicted once, then served from the cache."""
+        cache, predict = SentenceCache(), fake_predict()
+        first = cache.predict(make_conllu("gato"), predict, "model")
+        second = cache.predict(make_conllu("gato"), predict, "model")
+        assert first == second == fake_predict.tag(make_conllu("gato"))
+        assert predict.calls == [1]
+        assert cache.stats() == {"hits": 1, "disk_hits": 0, "misses": 1}
+
+    def test_sent_id_rewritten(self, make_conllu, fake_predict):
+        """Cached sentences get the sentence ID of the new request."""
+        cache, predict = SentenceCache(), fake_predict()
+        cache.predict(make_conllu("gato"), predict, "model")
+        result = cache.predict(make_conllu("cão", "gato"), predict, "model")
+        assert result == fake_predict.tag(make_conllu("cão", "gato"))
+        assert "# sent_id = S000002\n# text = gato" in result
+        assert predict.calls == [1, 1]
+
+    def test_model_identity_in_key(self, make_conllu, fake_predict):
+        """Another model does not reuse the cached sentences."""
+        cache, predict = SentenceCache(), fake_predict()
+        cache.predict(make_conllu("gato"), predict, "model")
+        cache.predict(make_conllu("gato"), predict, "other model")
+        assert predict.calls == [1, 1]
+
+    def test_key_ignores_sent_id(self, make_conllu):
+        """The key depends on the content, not on the sentence ID."""
+        assert SentenceCache.key(make_conllu("gato"), "m") == SentenceCache.key(make_conllu("gato", start=7), "m")
+        assert SentenceCache.key(make_conllu("gato"), "m") != SentenceCache.key(make_conllu("cão"), "m")
+
+    def test_memory_eviction(self):
+        """The least recently used entries are evicted beyond the memory size."""
+        cache = SentenceCache(memory_size=10)
+        cache.put("a", "12345")
+        cache.put("b", "12345")
+        cache.get("a")
+        cache.put("c", "12345")
+        assert cache.get("a") == "12345"
+        assert cache.get("b") is None
+        assert cache.get("c") == "12345"
+
+    def test_disk_tier(self, tmp_path: Path, make_conllu, fake_predict):
+        """Entries persist in the SQLite tier across cache instances."""
+        path = str(tmp_path / "cache.sqlite")
+        cache, predict = SentenceCache(path=path), fake_predict()
+        cache.predict(make_conllu("gato"), predict, "model")
+        cache.close()
+
+        cache = SentenceCache(path=path)
+        cache.predict(make_conllu("gato"), predict, "model")
+        assert predict.calls == [1]
+        assert cache.stats() == {"hits": 1, "disk_hits": 1, "misses": 0}
+        cache.close()
+
+    def test_disk_eviction(self, tmp_path: Path):
+        """The least recently used entries are evicted beyond the disk size."""
+        cache = SentenceCache(memory_size=0, path=str(tmp_path / "cache.sqlite"), disk_size=10)
+        cache.put("a", "12345")
+        cache.put("b", "12345")
+        cache.put("c", "12345")
+        assert cache.get("a") is None
+        assert cache.get("b") == "12345"
+        assert cache.get("c") == "12345"
+        cache.close()
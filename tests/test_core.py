@@ -1,5 +1,6 @@
 """Integration tests for portparser_v2 core pipeline."""
 
+import argparse
 import sys
 from pathlib import Path
 from tempfile import mkdtemp
@@ -8,7 +9,7 @@ import pytest
 
 sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
 
-from portparser_v2.core import parse_file, download_model
+from portparser_v2.core import Parser, parse_file, download_model, postprocess_conllu, run_postprocessor, _import_postprocess, _model_identity
 
 FIXTURES_DIR = Path(__file__).parent / "fixtures" / "portparser_v2"
 
@@ -43,3 +44,82 @@ def test_parse_alienista(model_path: str):
     expected = expected_file.read_text(encoding="utf-8")
 
     assert actual == expected
+
+
+@pytest.mark.slow
+def test_parser_reuses_model(model_path: str):
+    """A Parser instance parses repeatedly with the same loaded model."""
+    parser = Parser(model_path)
+    model = parser._model
+
+    first = parser.parse("O Brasil é um país tropical.")
+    second = parser.parse("O Brasil é um país tropical.")
+
+    assert parser._model is model
+    assert first == second
+    assert "# sent_id = S000001" in first
+
+
+@pytest.mark.slow
+def test_parse_alienista_stream(model_path: str):
+    """Streaming the file in small windows gives the same output as parsing it whole."""
+    input_file = FIXTURES_DIR / "alienista.txt"
+    expected_file = FIXTURES_DIR / "alienista.conllu"
+
+    parser = Parser(model_path)
+    with open(input_file, "r", encoding="utf-8") as f:
+        actual = "".join(parser.parse_stream(f, segment=True, window_size=32))
+    expected = expected_file.read_text(encoding="utf-8")
+
+    assert actual == expected
+
+
+@pytest.mark.slow
+def test_parse_alienista_pipelined(model_path: str):
+    """Overlapping the stages in worker processes does not change the output."""
+    input_file = FIXTURES_DIR / "alienista.txt"
+    expected_file = FIXTURES_DIR / "alienista.conllu"
+
+    parser = Parser(model_path)
+    with open(input_file, "r", encoding="utf-8") as f:
+        actual = "".join(parser.parse_stream(f, segment=True, window_size=32, workers=2))
+    expected = expected_file.read_text(encoding="utf-8")
+
+    assert actual == expected
+
+
+@pytest.mark.slow
+def test_parse_alienista_torch_backend(model_path: str):
+    """The keras-free PyTorch runtime gives the same output as the Keras model."""
+    input_file = FIXTURES_DIR / "alienista.txt"
+    expected_file = FIXTURES_DIR / "alienista.conllu"
+
+    parser = Parser(model_path, backend="torch")
+    actual = parser.parse(input_file.read_text(encoding="utf-8"))
+    expected = expected_file.read_text(encoding="utf-8")
+
+    assert actual == expected
+
+
+def test_model_identity_includes_inference_options(tmp_path: Path):
+    """The same weights run with other prediction-changing options get another identity."""
+    weights = tmp_path / "model.weights.h5"
+    weights.write_bytes(b"weights")
+    options = {"backend": "keras", "compile": 0, "precision": "fp32", "quantize": "none"}
+
+    identity = _model_identity(str(weights), argparse.Namespace(**options))
+    assert identity == _model_identity(str(weights), argparse.Namespace(**options, threads=4))
+    for option, value in [("backend", "onnx"), ("compile", 1), ("precision", "bf16"), ("quantize", "int8")]:
+        assert identity != _model_identity(str(weights), argparse.Namespace(**{**options, option: value}))
+
+
+def test_run_postprocessor_deprecated(tmp_path: Path):
+    """The deprecated run_postprocessor writes the output of postprocess_conllu."""
+    input_file = FIXTURES_DIR / "alienista.conllu"
+    output_path = tmp_path / "output.conllu"
+
+    with pytest.deprecated_call():
+        assert run_postprocessor(str(input_file), str(output_path)) == 0
+
+    expected = postprocess_conllu(input_file.read_text(encoding="utf-8"), _import_postprocess().getUsualAbbr())
+    assert output_path.read_text(encoding="utf-8") == expected
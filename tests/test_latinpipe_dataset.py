@@ -0,0 +1,92 @@
+"""Tests for the LatinPipe datasets."""
+
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+for module in ["torch", "transformers", "ufal.chu_liu_edmonds"]:
+    pytest.importorskip(module)
+
+import torch
+
+from latinpipe_evalatin24_base import parser, TorchUDDataLoader, UDDataset
+
+CONLLU = Path(__file__).parent / "fixtures" / "portparser_v2" / "alienista.conllu"
+
+
+def word_columns(conllu: str) -> list[list[list[str]]]:
+    """The word columns of the sentences of the given CoNLL-U content, without the comments and multiword tokens."""
+    return [[line.split("\t")[1:] for line in block.split("\n") if line and not UDDataset.RE_EXTRAS.match(line)]
+            for block in conllu.split("\n\n") if block.strip()]
+
+
+class TestSentencesDataset:
+    """Test the datasets built from the word columns of already tokenized sentences."""
+
+    def test_matches_conllu(self):
+        """The word columns are loaded as the same CoNLL-U content would be."""
+        args = parser.parse_args([])
+        conllu = CONLLU.read_text(encoding="utf-8")
+        train = UDDataset("<train>", args, text=conllu)
+
+        expected = UDDataset("<test>", args, train_dataset=train, text=conllu)
+        dataset = UDDataset("<test>", args, train_dataset=train, sentences=word_columns(conllu))
+
+        assert len(dataset) == len(expected) > 1
+        for factor, expected_factor in zip(dataset.factors, expected.factors):
+            assert factor.strings == expected_factor.strings
+            assert len(factor.word_ids) == len(expected_factor.word_ids)
+            for word_ids, expected_word_ids in zip(factor.word_ids, expected_factor.word_ids):
+                np.testing.assert_array_equal(word_ids, expected_word_ids)
+        assert dataset.conllu_for_eval is None
+
+    def test_empty_sentence(self):
+        """An empty sentence is rejected instead of shifting the following sentences."""
+        args = parser.parse_args([])
+        with pytest.raises(AssertionError):
+            UDDataset("<test>", args, sentences=[[["a"] + ["_"] * 8], []])
+
+
+class TestTokenBudgetBatchSampler:
+    """Test the batching of sentences by the maximum number of padded subwords."""
+
+    BATCH_TOKENS = 64
+
+    @pytest.fixture
+    def lengths(self) -> np.ndarray:
+        lengths = np.random.default_rng(42).integers(1, 40, size=200)
+        lengths[[17, 123]] = [self.BATCH_TOKENS + 1, 3 * self.BATCH_TOKENS]
+        return lengths
+
+    def sampler(self, lengths: np.ndarray) -> TorchUDDataLoader.TokenBudgetBatchSampler:
+        return TorchUDDataLoader.TokenBudgetBatchSampler(
+            torch.utils.data.RandomSampler(lengths, generator=torch.Generator().manual_seed(42)),
+            lengths, argparse.Namespace(batch_tokens=self.BATCH_TOKENS))
+
+    def test_budget(self, lengths):
+        """Every batch fits the budget, except for a single sentence longer than it."""
+        batches = list(self.sampler(lengths))
+        for batch in batches:
+            if max(lengths[batch]) * len(batch) > self.BATCH_TOKENS:
+                assert len(batch) == 1
+        assert [17] in batches and [123] in batches
+
+    def test_each_sentence_once_per_epoch(self, lengths):
+        """Every epoch contains every sentence exactly once, in a different order."""
+        sampler, epochs = self.sampler(lengths), []
+        for _ in range(3):
+            epochs.append([index for batch in sampler for index in batch])
+            assert sorted(epochs[-1]) == list(range(len(lengths)))
+        assert epochs[0] != epochs[1] != epochs[2]
+
+    def test_len(self, lengths):
+        """The length is the number of batches of the following epoch, whose batches it pre-generates."""
+        sampler = self.sampler(lengths)
+        for _ in range(3):
+            batches = len(sampler)
+            assert len(sampler) == batches
+            assert len(list(sampler)) == batches
+        # Without a preceding len(), the epoch generates its batches itself
+        assert sorted(index for batch in sampler for index in batch) == list(range(len(lengths)))
@@ -0,0 +1,138 @@
+"""Tests for the dependency tree decoding of LatinPipe predictions."""
+
+import argparse
+
+import numpy as np
+import pytest
+
+for module in ["torch", "transformers", "ufal.chu_liu_edmonds"]:
+    pytest.importorskip(module)
+
+import ufal.chu_liu_edmonds
+
+from latinpipe_evalatin24_base import (
+    decoding_pool, greedy_tree, parser, predict_overrides, shutdown_decoding_pool, UDDataset)
+
+
+def head_scores(scores: list[list[float]]) -> np.ndarray:
+    """Padded head log-probabilities of the given word rows, with the zero row of the root."""
+    scores = np.asarray(scores, dtype=np.float64)
+    scores = scores - np.log(np.sum(np.exp(scores), axis=-1, keepdims=True))
+    return np.concatenate([np.zeros([1, scores.shape[1]]), scores])
+
+
+def single_root(scores: np.ndarray) -> np.ndarray:
+    """Allow only the most probable root child, as the --single_root decoding does."""
+    scores = scores.copy()
+    selected_root = 1 + np.argmax(scores[1:, 0])
+    scores[:, 0] = np.nan
+    scores[selected_root, 0] = 0
+    return scores
+
+
+def mst(scores: np.ndarray) -> list[int]:
+    """The maximum spanning tree of the given scores."""
+    return list(ufal.chu_liu_edmonds.chu_liu_edmonds(scores.copy())[0])
+
+
+class TestGreedyTree:
+    """Test the greedy_tree shortcut of the maximum spanning tree decoding."""
+
+    def test_random_scores_match_mst(self):
+        """Whenever the greedy heads form a tree, it is the maximum spanning tree."""
+        generator, trees = np.random.default_rng(42), 0
+        for _ in range(500):
+            words = generator.integers(1, 12)
+            scores = head_scores(generator.normal(scale=3, size=[words, words + 1]))
+            for scores in [scores, single_root(scores)]:
+                heads = greedy_tree(scores)
+                if heads is not None:
+                    assert heads == mst(scores)
+                    trees += 1
+                else:
+                    argmax = np.argmax(np.where(np.isnan(scores), -np.inf, scores)[1:] - 1e9 * np.eye(words + 1)[1:], axis=-1)
+                    assert mst(scores)[1:] != argmax.tolist()
+        assert trees > 100
+
+    def test_argmax_cycle(self):
+        """Greedy heads forming a cycle need the maximum spanning tree decoding."""
+        scores = head_scores([[1, -5, 5, -5], [0, 5, -5, -5], [5, -5, -5, -5]])
+        assert greedy_tree(scores) is None
+        assert mst(scores) == [-1, 0, 1, 0]
+
+    def test_several_root_children(self):
+        """Without --single_root, several words can depend on the root."""
+        scores = head_scores([[5, -5, -5, -5], [5, -5, -5, -5], [5, -5, 0, -5]])
+        assert greedy_tree(scores) == mst(scores) == [-1, 0, 0, 0]
+
+    def test_single_root_column(self):
+        """The NaN root scores of --single_root leave a single root child."""
+        scores = single_root(head_scores([[5, -5, -5, -5], [4, 3, -5, -5], [3, -5, 2, -5]]))
+        assert greedy_tree(scores) == mst(scores) == [-1, 0, 1, 2]
+
+    def test_one_word(self):
+        """The only word of a sentence depends on the root."""
+        scores = head_scores([[1, 3]])
+        assert greedy_tree(scores) == mst(scores) == [-1, 0]
+        assert greedy_tree(single_root(scores)) == [-1, 0]
+
+
+def test_decoding_pool_shutdown():
+    """The decoding pool is reused until it is shut down."""
+    pool = decoding_pool(1)
+    assert decoding_pool(1) is pool
+    assert pool.submit(sum, [1, 2]).result(timeout=60) == 3
+
+    shutdown_decoding_pool()
+    with pytest.raises(RuntimeError):
+        pool.submit(sum, [1, 2])
+    assert decoding_pool(1) is not pool
+    shutdown_decoding_pool()
+
+
+class FakeModel:
+    """Fake parsing model returning the given head log-probabilities and no deprel."""
+
+    def __init__(self, heads: np.ndarray):
+        self._heads = heads
+
+    def predict_labels_on_batch(self, x, args):
+        return [self._heads[x], np.zeros(self._heads.shape[:2], np.int32)]
+
+
+class FakeDataLoader:
+    """Fake dataloader of the sentences of a dataset in batches of the given indices."""
+
+    def __init__(self, ud_dataset: UDDataset, batches: list[list[int]]):
+        self.dataset = argparse.Namespace(ud_dataset=ud_dataset)
+        self._batches = batches
+
+    def sentence_batches(self):
+        return iter(self._batches)
+
+    def __iter__(self):
+        return ((np.array(batch), None, None) for batch in self._batches)
+
+
+@pytest.mark.parametrize("decoding_processes", [0, 2])
+def test_predict_overrides_heads(decoding_processes: int):
+    """The heads are the maximum spanning trees, also when decoded in the pool."""
+    generator, lengths = np.random.default_rng(7), [5, 1, 9, 3, 12, 7, 2, 10]
+    heads = np.full([len(lengths), max(lengths), max(lengths) + 1], -1e9)
+    for i, length in enumerate(lengths):
+        heads[i, :length, :length + 1] = head_scores(generator.normal(scale=3, size=[length, length + 1]))[1:]
+
+    args = parser.parse_args(["--parse=1", "--single_root=1", "--decoding_processes={}".format(decoding_processes)])
+    args.tags = []
+    ud_dataset = UDDataset("<test>", args, sentences=[
+        [[f"w{j}"] + ["_"] * 8 for j in range(length)] for length in lengths])
+    overrides = predict_overrides(FakeModel(heads), FakeDataLoader(ud_dataset, [[2, 0, 5], [7, 1], [4, 3, 6]]), args)
+    shutdown_decoding_pool()
+
+    cycles = 0
+    for i, length in enumerate(lengths):
+        scores = np.zeros([length + 1, length + 1])
+        scores[1:] = heads[i, :length, :length + 1]
+        assert list(overrides[i][UDDataset.HEAD]) == mst(single_root(scores))[1:]
+        cycles += greedy_tree(single_root(scores)) is None
+    assert 0 < cycles < len(lengths)
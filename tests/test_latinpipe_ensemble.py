@@ -0,0 +1,104 @@
+"""Tests for the selective ensembling of LatinPipe models."""
+
+import argparse
+import math
+
+import numpy as np
+import pytest
+
+for module in ["torch", "keras", "transformers", "h5py", "ufal.chu_liu_edmonds"]:
+    pytest.importorskip(module)
+
+import torch
+
+from latinpipe_evalatin24 import LatinPipeModel, LatinPipeModelEnsemble, UDDataset, sentence_confidences
+
+
+class ConfidentMember:
+    """Fake first member, confident only about the sentences of at least `min_words` words."""
+
+    def __init__(self, min_words: int, labels: int):
+        self._min_words = min_words
+        self._labels = labels
+
+    def predict_on_batch(self, x):
+        lengths = np.sum(x[1][..., 0] > -1, axis=-1) - 1
+        logits = np.zeros([*x[1].shape[:1], x[1].shape[1] - 1, self._labels], np.float32)
+        logits[lengths >= self._min_words, :, 0] = 10
+        return [logits]
+
+
+class RNNMember:
+    """Fake member predicting its tags by the LSTMTorch layer of LatinPipeModel."""
+
+    def __init__(self, units: int):
+        self._rnn = LatinPipeModel.LSTMTorch(units)
+
+    def predict_on_batch(self, x):
+        word_indices = torch.as_tensor(x[1])
+        lengths = torch.sum(word_indices[..., 0] > -1, dim=-1)
+        hidden = self._rnn(torch.ones([*word_indices.shape[:2], 3]), lengths)
+        return [hidden[:, 1:].detach().numpy()]
+
+
+def make_inputs(lengths: list[int]) -> list[np.ndarray]:
+    """Build the batch inputs of sentences of the given lengths, padded to the longest one."""
+    word_indices = np.full([len(lengths), max(lengths) + 1, 2], -1, np.int32)
+    for i, length in enumerate(lengths):
+        word_indices[i, :length + 1] = np.arange(length + 1)[:, None]
+    return [np.zeros([len(lengths), max(lengths) + 2], np.int32), word_indices]
+
+
+def test_escalated_sentences_shorter_than_batch():
+    """Escalated sentences shorter than the longest one of the batch are predicted at the batch width."""
+    units = 2
+    args = argparse.Namespace(tags=[UDDataset.UPOS], parse=0, ensemble_confidence="margin", ensemble_threshold=0.5)
+    ensemble = LatinPipeModelEnsemble([ConfidentMember(min_words=4, labels=2 * units), RNNMember(units)], args)
+
+    labels = ensemble.predict_labels_on_batch(make_inputs([4, 2, 1]), args)
+
+    assert labels[0].shape == (3, 4)
+    assert (ensemble.sentences, ensemble.escalated_sentences) == (3, 2)
+
+
+def log_probabilities(probabilities: list) -> torch.Tensor:
+    """Log-probabilities of the given nested lists, with zero probabilities masked as by the model."""
+    probabilities = torch.as_tensor(probabilities, dtype=torch.float64)
+    return torch.log_softmax(torch.where(probabilities > 0, probabilities.log(), -1e9), dim=-1)
+
+
+def entropy(probabilities: list[float]) -> float:
+    """The natural entropy of a distribution."""
+    return -sum(p * math.log(p) for p in probabilities if p)
+
+
+def test_sentence_confidences_margin():
+    """The margin confidence is the lowest top-two margin over the words, ignoring padding."""
+    args = argparse.Namespace(ensemble_confidence="margin", parse=0)
+    tags = log_probabilities([
+        [[0.7, 0.2, 0.1], [0.5, 0.4, 0.1], [0.34, 0.33, 0.33]],
+        [[0.9, 0.05, 0.05], [0.05, 0.9, 0.05], [0.05, 0.05, 0.9]],
+    ])
+
+    confidences = sentence_confidences([tags], torch.tensor([2, 3]), args)
+
+    np.testing.assert_allclose(confidences.numpy(), [0.1, 0.85])
+
+
+def test_sentence_confidences_entropy():
+    """The entropy confidence normalizes the heads by the sentence length plus the root."""
+    args = argparse.Namespace(ensemble_confidence="entropy", parse=1)
+    heads = log_probabilities([
+        [[0.5, 0.5, 0.0], [0.2, 0.3, 0.5]],
+        [[0.25, 0.25, 0.5], [0.25, 0.5, 0.25]],
+    ])
+    deprels = log_probabilities([
+        [[0.9, 0.1], [0.5, 0.5]],
+        [[0.9, 0.1], [0.9, 0.1]],
+    ])
+
+    confidences = sentence_confidences([heads, deprels], torch.tensor([1, 2]), args)
+
+    # The one-word sentence has two possible heads, so its even head distribution has no confidence
+    np.testing.assert_allclose(confidences.numpy(), [
+        0.0, 1 - entropy([0.25, 0.25, 0.5]) / math.log(3)], atol=1e-9)
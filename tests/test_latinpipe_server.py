@@ -0,0 +1,321 @@
+"""Tests for the LatinPipe server."""
+
+import argparse
+import concurrent.futures
+import contextlib
+import http.client
+import json
+import queue
+import re
+import socket
+import threading
+import urllib.parse
+from pathlib import Path
+
+import pytest
+
+for module in ["torch", "keras", "transformers", "h5py", "ufal.udpipe", "ufal.chu_liu_edmonds"]:
+    pytest.importorskip(module)
+
+import ufal.udpipe
+
+from latinpipe_evalatin24_server import LatinPipeServer, Models
+
+CONLLU = Path(__file__).parent / "fixtures" / "portparser_v2" / "alienista.conllu"
+
+TEXT = "".join([
+    "Simão Bacamarte era médico. Estudou em Coimbra e Pádua.\n\n",
+    "Voltou ao Brasil aos trinta e quatro anos.\n\n",
+    "Casou com D. Evarista. Não teve filhos. Dedicou-se à ciência.\n\n",
+    "A Casa Verde foi inaugurada com grande pompa.",
+])
+
+
+class StubNetwork(Models.Model.Network):
+    """Network predicting every sentence as itself, recording the batches and failing those of the given parse values."""
+
+    def __init__(self, max_wait: float = 50, batch_size: int = 32, semaphore=None, fail_parse: tuple = ()):
+        super().__init__("<stub>", argparse.Namespace(
+            max_wait=max_wait, batch_size=batch_size, optional_semaphore=semaphore or contextlib.nullcontext()))
+        self.calls = []
+        self._fail_parse = fail_parse
+
+    def _predict(self, words, tag, parse):
+        self.calls.append((words, tag, parse))
+        if parse in self._fail_parse:
+            raise RuntimeError("Failed batch")
+        return [("predicted", sentence) for sentence in words]
+
+    def schedule(self, *requests: tuple) -> list[concurrent.futures.Future]:
+        """Queue the given (words, tag, parse) requests together, and only then start the scheduler."""
+        self._requests, futures = queue.Queue(), []
+        for words, tag, parse in requests:
+            futures.append(concurrent.futures.Future())
+            self._requests.put((words, tag, parse, futures[-1]))
+        threading.Thread(target=self._schedule, daemon=True).start()
+        return futures
+
+
+class TestScheduler:
+    """Test the batching of the sentences of concurrent requests with --max_wait."""
+
+    def test_grouped_by_tasks(self):
+        """The requests of the same tasks are predicted together, and every request gets its own sentences."""
+        network = StubNetwork()
+        futures = network.schedule((["a1", "a2"], 1, 1), (["b1"], 1, 0), (["c1", "c2", "c3"], 1, 1))
+
+        assert futures[0].result(timeout=10) == [("predicted", "a1"), ("predicted", "a2")]
+        assert futures[1].result(timeout=10) == [("predicted", "b1")]
+        assert futures[2].result(timeout=10) == [("predicted", "c1"), ("predicted", "c2"), ("predicted", "c3")]
+        assert network.calls == [(["a1", "a2", "c1", "c2", "c3"], 1, 1), (["b1"], 1, 0)]
+
+    def test_batch_size(self):
+        """The collection of requests stops when the batch is full."""
+        network = StubNetwork(batch_size=2)
+        futures = network.schedule((["a"], 1, 1), (["b"], 1, 1), (["c"], 1, 1))
+
+        assert [future.result(timeout=10) for future in futures] == [[("predicted", word)] for word in "abc"]
+        assert network.calls == [(["a", "b"], 1, 1), (["c"], 1, 1)]
+
+    def test_failing_batch(self):
+        """A failing batch fails only its requests, and the scheduler keeps serving the next ones."""
+        network = StubNetwork(fail_parse=(1,))
+        futures = network.schedule((["a"], 1, 1), (["b"], 1, 0), (["c"], 1, 1))
+
+        for future in [futures[0], futures[2]]:
+            with pytest.raises(RuntimeError, match="Failed batch"):
+                future.result(timeout=10)
+        assert futures[1].result(timeout=10) == [("predicted", "b")]
+
+        future = concurrent.futures.Future()
+        network._requests.put((["d"], 0, 0, future))
+        assert future.result(timeout=10) == [("predicted", "d")]
+
+    def test_concurrent_limit(self):
+        """The batches are predicted only within the --concurrent limit."""
+        semaphore = threading.Semaphore(1)
+        network = StubNetwork(max_wait=0, semaphore=semaphore)
+        semaphore.acquire()
+
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            result = executor.submit(network.predict, ["a"], 1, 1)
+            with pytest.raises(concurrent.futures.TimeoutError):
+                result.result(timeout=0.5)
+            assert network.calls == []
+
+            semaphore.release()
+            assert result.result(timeout=10) == [("predicted", "a")]
+
+
+@pytest.fixture(scope="module")
+def tokenizer(tmp_path_factory) -> Path:
+    """Directory with a tiny `test.tokenizer` UDPipe model trained on the test sentences."""
+    reader = ufal.udpipe.InputFormat.newConlluInputFormat()
+    reader.setText(CONLLU.read_text(encoding="utf-8"))
+    sentences, sentence, error = ufal.udpipe.Sentences(), ufal.udpipe.Sentence(), ufal.udpipe.ProcessingError()
+    while reader.nextSentence(sentence, error):
+        sentences.append(sentence)
+        sentence = ufal.udpipe.Sentence()
+
+    model = ufal.udpipe.Trainer.train(
+        "morphodita_parsito", sentences, ufal.udpipe.Sentences(), "epochs=1;dimension=16", "none", "none", error)
+    assert not error.occurred(), error.message
+    path = tmp_path_factory.mktemp("models")
+    (path / "test.tokenizer").write_bytes(model if isinstance(model, bytes) else model.encode("latin-1"))
+    return path
+
+
+@pytest.fixture
+def server(tokenizer: Path):
+    """A running server with a tokenize-only model, accepting connections with small socket buffers."""
+    args = argparse.Namespace(
+        port=0, default_model="test", models=["test", str(tokenizer), "test", "Test model."], preload_models=[],
+        batch_size=32, max_request_size=4096 * 1024, max_wait=None, optional_semaphore=contextlib.nullcontext())
+    server = LatinPipeServer(args, Models(args))
+    for option in [socket.SO_RCVBUF, socket.SO_SNDBUF]:
+        server.socket.setsockopt(socket.SOL_SOCKET, option, 65536)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def connect(server: LatinPipeServer, buffer_size: int | None = None) -> http.client.HTTPConnection:
+    """An HTTP/1.1 connection to the server, optionally with the given socket buffer sizes."""
+    connection = http.client.HTTPConnection("localhost", server.server_address[1], timeout=30)
+    connection.connect()
+    if buffer_size is not None:
+        for option in [socket.SO_RCVBUF, socket.SO_SNDBUF]:
+            connection.sock.setsockopt(socket.SOL_SOCKET, option, buffer_size)
+    return connection
+
+
+def raw_request(server: LatinPipeServer, request: bytes) -> bytes:
+    """Send the given raw request and return the raw response, read until the server closes the connection."""
+    with socket.create_connection(("localhost", server.server_address[1]), timeout=30) as sock:
+        sock.sendall(request)
+        response = b""
+        while data := sock.recv(65536):
+            response += data
+    return response
+
+
+def form(**params: str) -> tuple[bytes, dict[str, str]]:
+    """The body and headers of an application/x-www-form-urlencoded payload."""
+    return urllib.parse.urlencode(params).encode("utf-8"), {"Content-Type": "application/x-www-form-urlencoded"}
+
+
+class TestStreaming:
+    """Test the streamed processing of raw text payloads."""
+
+    def test_matches_unstreamed(self, server):
+        """Tokenizing a payload streamed a paragraph per chunk produces the same documents, paragraphs and sentences."""
+        connection = connect(server)
+        connection.request("POST", "/process", *form(data=TEXT, tokenizer=""))
+        expected = json.loads(connection.getresponse().read())["result"]
+
+        paragraphs = [paragraph.encode("utf-8") for paragraph in TEXT.split("\n\n")]
+        connection.request("POST", "/process?tokenizer=", iter([paragraph + b"\n\n" for paragraph in paragraphs[:-1]] + paragraphs[-1:]),
+                           {"Content-Type": "text/plain"}, encode_chunked=True)
+        result = json.loads(connection.getresponse().read())["result"]
+        connection.close()
+
+        assert result == expected
+        assert result.count("# newdoc") == 1 and result.count("# newpar") == len(paragraphs)
+        sent_ids = [int(sent_id) for sent_id in re.findall(r"^# sent_id = (\d+)$", result, flags=re.MULTILINE)]
+        assert sent_ids == list(range(1, len(sent_ids) + 1)) and len(sent_ids) > len(paragraphs)
+
+    def test_half_duplex_client(self, server):
+        """A client sending the whole multi-MB payload before reading the response does not deadlock."""
+        text = ("Simão Bacamarte era médico .\nEstudou em Coimbra e Pádua .\n\n" * 40_000).encode("utf-8")
+        assert len(text) > 2_000_000
+        connection = connect(server, buffer_size=65536)
+        connection.request("POST", "/process?input=horizontal", text, {"Content-Type": "text/plain"})
+        response = connection.getresponse()
+        result = json.loads(response.read())["result"]
+        connection.close()
+
+        assert response.status == 200
+        assert result.count("# sent_id") == 80_000
+
+    def test_billing_trailer(self, server):
+        """The input length of a streamed payload is sent in a declared trailer."""
+        connection = connect(server)
+        connection.request("POST", "/process", *form(data=TEXT, tokenizer=""))
+        expected = connection.getresponse()
+        expected.read()
+        connection.close()
+
+        payload = TEXT.encode("utf-8")
+        response = raw_request(server, b"POST /process?tokenizer= HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n"
+                               b"Content-Type: text/plain\r\nContent-Length: %d\r\n\r\n%s" % (len(payload), payload))
+        headers, body = response.split(b"\r\n\r\n", maxsplit=1)
+        assert b"\r\nTrailer: X-Billing-Input-NFC-Len\r\n" in headers
+        assert b"\r\nX-Billing-Input-NFC-Len" not in headers
+        assert body.endswith(b"\r\n0\r\nX-Billing-Input-NFC-Len: %s\r\n\r\n" % expected.headers["X-Billing-Input-NFC-Len"].encode("ascii"))
+
+    def test_invalid_chunk_size(self, server):
+        """A malformed chunk size of a streamed payload is reported as a payload error."""
+        connection = connect(server)
+        connection.putrequest("POST", "/process?tokenizer=")
+        connection.putheader("Content-Type", "text/plain")
+        connection.putheader("Transfer-Encoding", "chunked")
+        connection.endheaders()
+        connection.send(b"nonsense\r\nBacamarte\r\n0\r\n\r\n")
+        response = connection.getresponse()
+
+        assert (response.status, response.read()) == (400, b"Invalid chunk size.")
+        assert response.headers["Connection"] == "close"
+        connection.close()
+
+
+def dechunk(body: bytes) -> bytes:
+    """The content of a chunked body, which must be terminated by the last chunk without trailers."""
+    content = b""
+    while True:
+        size, body = body.split(b"\r\n", maxsplit=1)
+        if not int(size, 16):
+            assert body == b"\r\n"
+            return content
+        content, body = content + body[:int(size, 16)], body[int(size, 16):]
+        assert body.startswith(b"\r\n")
+        body = body[2:]
+
+
+class TestConnections:
+    """Test the chunked responses and the kept-alive connections."""
+
+    def test_chunked_framing(self, server):
+        """HTTP/1.1 responses are chunked and keep the connection alive."""
+        response = raw_request(server, b"GET /models HTTP/1.1\r\nHost: localhost\r\n\r\n"
+                                       b"GET /models HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+        first, second = response.split(b"HTTP/1.1 200 OK\r\n")[1:]
+        for response, connection in [(first, b"keep-alive"), (second, b"close")]:
+            headers, body = response.split(b"\r\n\r\n", maxsplit=1)
+            assert b"Transfer-Encoding: chunked" in headers.split(b"\r\n")
+            assert b"Connection: " + connection in headers.split(b"\r\n")
+            assert json.loads(dechunk(body))["default_model"] == "test"
+
+    def test_two_requests_on_one_connection(self, server):
+        """Both a request without and with a payload leave the connection open for the next one."""
+        connection = connect(server)
+        connection.request("GET", "/models")
+        sock, response = connection.sock, connection.getresponse()
+        assert (response.status, response.will_close) == (200, False)
+        assert json.loads(response.read())["default_model"] == "test"
+
+        connection.request("POST", "/process", *form(data=TEXT, tokenizer=""))
+        response = connection.getresponse()
+        assert (response.status, response.will_close) == (200, False)
+        assert "# newdoc" in json.loads(response.read())["result"]
+        assert connection.sock is sock
+        connection.close()
+
+    def test_unread_payload_closes_connection(self, server):
+        """A response leaving the payload unread closes the connection, instead of parsing the payload as a request."""
+        connection = connect(server)
+        connection.request("POST", "/models", b"x" * 100_000, {"Content-Type": "text/plain"})
+        response = connection.getresponse()
+        assert (response.status, response.headers["Connection"], response.will_close) == (200, "close", True)
+        response.read()
+        connection.close()
+
+        payload = b"GET /models HTTP/1.1\r\nHost: localhost\r\n\r\n"
+        response = raw_request(server, b"POST /models HTTP/1.1\r\nHost: localhost\r\nContent-Type: text/plain\r\n"
+                                       b"Content-Length: %d\r\n\r\n%s" % (len(payload), payload))
+        assert response.count(b"HTTP/1.1 200 OK\r\n") == 1
+
+    def test_http10(self, server):
+        """HTTP/1.0 responses are not chunked and close the connection."""
+        response = raw_request(server, b"GET /models HTTP/1.0\r\n\r\n")
+        headers, body = response.split(b"\r\n\r\n", maxsplit=1)
+        assert headers.startswith(b"HTTP/1.1 200 OK\r\n")
+        assert b"Connection: close" in headers.split(b"\r\n")
+        assert b"Transfer-Encoding: chunked" not in headers.split(b"\r\n")
+        assert json.loads(body)["default_model"] == "test"
+
+    def test_idle_timeout(self, server, monkeypatch):
+        """An idle kept-alive connection is closed when its timeout expires."""
+        monkeypatch.setattr(LatinPipeServer.LatinPipeServerRequestHandler, "timeout", 0.2)
+        connection = connect(server)
+        connection.request("GET", "/models")
+        connection.getresponse().read()
+
+        connection.sock.settimeout(10)
+        assert connection.sock.recv(1) == b""
+        connection.close()
+
+    def test_shutdown_closes_idle_connections(self, server):
+        """Closing the server does not wait for the idle kept-alive connections."""
+        connection = connect(server)
+        connection.request("GET", "/models")
+        connection.getresponse().read()
+
+        server.shutdown()
+        closing = threading.Thread(target=server.server_close)
+        closing.start()
+        closing.join(timeout=10)
+        assert not closing.is_alive()
+        assert connection.sock.recv(1) == b""
+        connection.close()
@@ -0,0 +1,56 @@
+"""Tests for the keras-free PyTorch inference runtime of LatinPipe."""
+
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+for module in ["torch", "keras", "transformers", "h5py", "ufal.chu_liu_edmonds"]:
+    pytest.importorskip(module)
+
+import transformers
+
+from latinpipe_evalatin24 import LatinPipeModel, parser, TorchUDDataLoader, TorchUDDataset, UDDataset
+from latinpipe_evalatin24_torch import LatinPipeModelTorch
+
+CONLLU = Path(__file__).parent / "fixtures" / "portparser_v2" / "alienista.conllu"
+
+
+@pytest.fixture
+def transformer(tmp_path: Path) -> str:
+    """A tiny randomly initialized BERT with a word-level vocabulary of the test sentences, saved locally."""
+    words = sorted({line.split("\t")[1] for line in CONLLU.read_text(encoding="utf-8").split("\n")
+                    if line and not UDDataset.RE_EXTRAS.match(line)})
+    path = tmp_path / "transformer"
+    path.mkdir()
+    (path / "vocab.txt").write_text("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", *words]) + "\n", encoding="utf-8")
+    tokenizer = transformers.BertTokenizerFast(str(path / "vocab.txt"))
+    tokenizer.save_pretrained(path)
+    config = transformers.BertConfig(
+        vocab_size=len(tokenizer), hidden_size=16, num_hidden_layers=1, num_attention_heads=2, intermediate_size=32)
+    transformers.BertModel(config).save_pretrained(path)
+    return str(path)
+
+
+@pytest.mark.parametrize("rnn_type", ["LSTMTorch", "GRUTorch"])
+def test_matches_keras_model(transformer: str, tmp_path: Path, rnn_type: str):
+    """The torch mirror loading the saved weights of a keras model computes the same predictions."""
+    args = parser.parse_args([
+        "--transformers", transformer, "--rnn_type", rnn_type, "--rnn_dim=8", "--task_hidden_layer=16", "--parse_attention_dim=8"])
+    args.tags = [UDDataset.FACTORS_MAP[tag] for tag in ["UPOS", "FEATS"]]
+    args.embed_tags = [UDDataset.FACTORS_MAP["UPOS"]]
+    dataset = UDDataset("<test>", args, text=CONLLU.read_text(encoding="utf-8"))
+
+    model = LatinPipeModel(dataset, args)
+    model.save_weights(str(tmp_path / "model.weights.h5"))
+    args.load = [str(tmp_path / "model.weights.h5")]
+    torch_model = LatinPipeModelTorch(dataset, args)
+
+    inputs, _, _ = next(iter(TorchUDDataLoader(TorchUDDataset(dataset, torch_model.tokenizers, args, training=False), args)))
+    predictions, torch_predictions = model.predict_on_batch(inputs), torch_model.predict_on_batch(inputs)
+    assert len(predictions) == len(torch_predictions) == len(args.tags) + 2
+    for prediction, torch_prediction in zip(predictions, torch_predictions):
+        np.testing.assert_allclose(torch_prediction, prediction, rtol=1e-5, atol=1e-5)
+
+    for labels, torch_labels in zip(model.predict_labels_on_batch(inputs), torch_model.predict_labels_on_batch(inputs)):
+        np.testing.assert_array_equal(torch_labels, labels)
@@ -8,7 +8,7 @@ import pytest
 # Add src to path so we can import portparser_v2
 sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
 
-from portparser_v2.portSent import stripSents
+from portparser_v2.portSent import stripSents, streamSents
 
 # Path to test fixtures
 FIXTURES_DIR = Path(__file__).parent / "fixtures" / "portSentencer"
@@ -213,3 +213,37 @@ class TestIntegrationAlienista:
         """Verify the number of sentences extracted."""
         sentences = stripSents(input_text, limit=2048, replace=True)
         assert len(sentences) == 49, f"Expected 49 sentences, got {len(sentences)}"
+
+
+class TestStreamSents:
+    """Test the streamSents incremental segmentation."""
+
+    def test_matches_strip_sents_across_lines(self):
+        """Sentences spanning several lines are joined as in stripSents."""
+        lines = ["Primeira frase que", "continua aqui. Segunda", "frase! Terceira"]
+        assert list(streamSents(lines)) == stripSents(" ".join(lines))
+
+    def test_is_lazy(self):
+        """Complete sentences are yielded before the input is exhausted."""
+        def lines():
+            yield "Primeira frase. Segunda frase."
+            raise AssertionError("Read past the first complete sentence")
+
+        assert next(streamSents(lines())) == "Primeira frase."
+
+    def test_empty_input(self):
+        """No lines give no sentences."""
+        assert list(streamSents([])) == []
+
+    def test_alienista_matches_strip_sents(self):
+        """Streaming the fixture line by line gives the same sentences."""
+        with open(FIXTURES_DIR / "alienista.txt", "r", encoding="utf-8") as f:
+            text = f.read()
+        lines = text.splitlines(keepends=True)
+        assert list(streamSents(lines, limit=2048, replace=True)) == stripSents(text, limit=2048, replace=True)
+
+    def test_non_breaking_space_separates_sentences(self):
+        """A non-breaking space between sentences is replaced by a plain space."""
+        text = "Ele chegou.\u00a0Depois saiu."
+        assert stripSents(text) == ["Ele chegou.", "Depois saiu."]
+        assert list(streamSents([text])) == stripSents(text)
@@ -17,6 +17,7 @@ from postprocess import (
     sepLEMMA_FEATS,
     getUsualAbbr,
 )
+from conlluFile import ConlluFile
 
 
 class TestIsAbbr:
@@ -398,3 +399,37 @@ class TestFeatsFullEdgeCases:
         result = featsFull("Abbr=Yes", abbr=False)
         assert result == "_"
 
+
+
+class TestConlluFileText:
+    """Test building a ConlluFile from a CoNLL-U string."""
+
+    CONLLU = (
+        "# sent_id = S000002\n"
+        "# text = Ele fica.\n"
+        "1\tEle\tele\tPRON\t_\t_\t2\tnsubj\t_\t_\n"
+        "2\tfica\tficar\tVERB\t_\t_\t0\troot\t_\tSpaceAfter=No\n"
+        "3\t.\t.\tPUNCT\t_\t_\t2\tpunct\t_\t_\n"
+        "\n"
+        "# sent_id = S000001\n"
+        "# text = Oi.\n"
+        "1\tOi\toi\tINTJ\t_\t_\t0\troot\t_\tSpaceAfter=No\n"
+        "2\t.\t.\tPUNCT\t_\t_\t1\tpunct\t_\t_\n"
+        "\n"
+    )
+
+    def test_reads_sentences(self):
+        """Sentences and tokens are read from the string."""
+        base = ConlluFile(text=self.CONLLU)
+        assert base.getSandT() == (2, 5)
+        assert base.getSentByID("S000002")[1] == "Ele fica."
+
+    def test_same_as_file(self, tmp_path):
+        """Reading from a string gives the same base as reading from a file."""
+        path = tmp_path / "input.conllu"
+        path.write_text(self.CONLLU)
+        assert ConlluFile(text=self.CONLLU).getBase() == ConlluFile(str(path)).getBase()
+
+    def test_empty_text(self):
+        """An empty string gives an empty base."""
+        assert ConlluFile(text="").getSandT() == (0, 0)